@@ -1,3 +1,13 @@
 from .utils import *
 from .write import *
 from .myPipe import *
+from .skymap import *
+from .transfer import *
+from .planner import *
+from .manifest import *
+from .cache import *
+from .metadata import *
+from .mosaic import *
+from .catstore import *
+from .distances import *
+from .patchindex import *
@@ -0,0 +1,177 @@
+"""
+A process-wide, memory-budgeted LRU cache for Butler datasets, so that
+objects for the same dataID are read once while they fit in the budget.
+The write and search paths, which only read the exposures and catalogs
+(write_deepCoadd_fits, write_deepCoadd_bands, MyCat, and group_search),
+use it by default; MyPipe and the pipeTools getters, whose objects may
+be modified by their callers, only use it with use_cache=True. The
+budget (1 GB by default, about four HSC patch exposures) can be set
+with the HSCANA_CACHE_BYTES environment variable.
+
+Cached objects are shared: every caller gets the same exposure or
+catalog, so they must not be modified in place.
+"""
+
+from __future__ import division, print_function
+
+__all__ = ['DataCache', 'get_data_cache', 'default_cache_bytes']
+
+import os
+import threading
+from collections import OrderedDict
+
+default_cache_bytes = int(float(os.environ.get('HSCANA_CACHE_BYTES', 1.0e9)))
+
+_data_cache = None
+
+def _sizeof(obj):
+    """
+    Estimate the memory footprint of a Butler dataset in bytes.
+    """
+    if hasattr(obj, 'getMaskedImage'):
+        mi = obj.getMaskedImage()
+        return sum(p.getArray().nbytes for p in (mi.getImage(), mi.getMask(), mi.getVariance()))
+    if hasattr(obj, 'getSchema') and hasattr(obj, '__len__'):
+        return len(obj)*obj.getSchema().getRecordSize()
+    if hasattr(obj, 'nbytes'):
+        return obj.nbytes
+    return 0
+
+class DataCache(object):
+    """
+    LRU cache of Butler datasets keyed by (tract, patch, filter,
+    dataset type), with a byte budget.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        The byte budget. The least recently used datasets are evicted
+        when the budget is exceeded. Datasets larger than the budget
+        are returned without being cached.
+    """
+
+    def __init__(self, max_bytes=default_cache_bytes):
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading = {}
+        self._nbytes = 0
+        self._stats = {'hits':0, 'misses':0, 'evictions':0}
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    @staticmethod
+    def make_key(dataset, dataID):
+        return (dataID['tract'], dataID['patch'], dataID['filter'], dataset)
+
+    def get(self, butler, dataset, dataID, key_extra=(), **kwargs):
+        """
+        Return the dataset for dataID, reading it with the butler on
+        a cache miss. Concurrent misses on the same key read it once:
+        the other threads wait for the first read. The returned object
+        is shared with other callers and must not be modified.
+
+        Parameters
+        ----------
+        butler : Butler object
+            Used to read the dataset on a miss.
+        dataset : string
+            The dataset type (e.g., 'deepCoadd_calexp').
+        dataID : dict
+            The data id with keys tract, patch, and filter.
+        key_extra : tuple, optional
+            Appended to the cache key (e.g., a cutout bounding box).
+        **kwargs : 
+            Passed to butler.get.
+        """
+        return self.get_with_status(butler, dataset, dataID, key_extra, **kwargs)[0]
+
+    def get_with_status(self, butler, dataset, dataID, key_extra=(), **kwargs):
+        """
+        Same as get, but return (obj, hit), where hit is False only if
+        this call read the dataset with the butler.
+        """
+        key = self.make_key(dataset, dataID) + tuple(key_extra)
+        while True:
+            with self._lock:
+                if key in self._data:
+                    obj, size = self._data.pop(key)
+                    self._data[key] = (obj, size)
+                    self._stats['hits'] += 1
+                    return obj, True
+                loading = self._loading.get(key)
+                if loading is None:
+                    self._loading[key] = threading.Event()
+                    self._stats['misses'] += 1
+                    break
+            # another thread is reading this key; check again when it is done
+            loading.wait()
+        try:
+            obj = butler.get(dataset, dataID, immediate=True, **kwargs)
+            self.put(key, obj)
+        finally:
+            with self._lock:
+                self._loading.pop(key).set()
+        return obj, False
+
+    def put(self, key, obj, size=None):
+        """
+        Add an object to the cache and evict as needed.
+        """
+        size = _sizeof(obj) if size is None else size
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self._nbytes -= self._data.pop(key)[1]
+            self._data[key] = (obj, size)
+            self._nbytes += size
+            self._evict()
+
+    def resize(self, max_bytes):
+        """
+        Change the byte budget, evicting as needed.
+        """
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self):
+        while self._nbytes > self.max_bytes and self._data:
+            _, (_, evicted) = self._data.popitem(last=False)
+            self._nbytes -= evicted
+            self._stats['evictions'] += 1
+
+    def clear(self):
+        """
+        Remove all cached objects (the statistics are kept).
+        """
+        with self._lock:
+            self._data.clear()
+            self._nbytes = 0
+
+    def stats(self):
+        """
+        Return the number of hits, misses, and evictions, the number of
+        cached items, and the cached and budgeted bytes.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({'items':len(self._data), 'bytes':self._nbytes, 'max_bytes':self.max_bytes})
+        return stats
+
+def get_data_cache(max_bytes=None):
+    """
+    Return the process-wide data cache. If max_bytes is given, the
+    budget is updated (evicting as needed).
+    """
+    global _data_cache
+    if _data_cache is None:
+        _data_cache = DataCache(default_cache_bytes)
+    if max_bytes is not None:
+        _data_cache.resize(max_bytes)
+    return _data_cache
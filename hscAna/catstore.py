@@ -0,0 +1,257 @@
+"""
+Columnar on-disk store for the deepCoadd_meas columns used by the UDG
+search. Each patch is a directory with one .npy file per column and a
+schema.json manifest (columns, number of rows, zero point, and WCS), so
+catalogs can be read memory-mapped, without the Butler or the LSST stack.
+
+The layout is root/HSC-band/tract/patch/{column}.npy.
+"""
+
+from __future__ import division, print_function
+
+__all__ = ['default_store_dir', 'default_columns', 'StoredCatalog', 'StoredCalib',
+           'export_catalog', 'ingest_patch', 'open_catalog']
+
+import os
+import json
+import time
+import shutil
+import numpy as np
+
+default_store_dir = os.path.join(os.path.expanduser('~'), '.hscAna', 'catstore')
+
+# the columns used by pipeTools and cuts.py; the centroids are stored
+# as x and y (from getX and getY)
+default_columns = ['id', 'parent', 'coord.ra', 'coord.dec', 'classification.extendedness',
+                   'flags.pixel.bad', 'flags.pixel.edge', 'flags.pixel.interpolated.any',
+                   'flags.pixel.cr.any', 'flags.pixel.saturated.any',
+                   'flags.pixel.bright.object.any', 'cmodel.flux',
+                   'shape.hsm.moments.xx', 'shape.hsm.moments.yy', 'shape.hsm.moments.xy']
+
+_schema_file = 'schema.json'
+
+def _patch_dir(root, tract, patch, band):
+    return os.path.join(root, 'HSC-'+band.upper(), str(tract), patch)
+
+class StoredCalib(object):
+    """
+    Photometric calibration from the stored zero point, with the
+    getMagnitude interface of an afw Calib.
+    """
+
+    def __init__(self, fluxmag0):
+        self.fluxmag0 = fluxmag0
+
+    def setThrowOnNegativeFlux(self, throw):
+        pass
+
+    def getFluxMag0(self):
+        return self.fluxmag0, 0.0
+
+    def getMagnitude(self, flux):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mag = -2.5*np.log10(np.asarray(flux, dtype=float)/self.fluxmag0)
+        return np.where(np.asarray(flux) > 0, mag, np.nan)
+
+class StoredCatalog(object):
+    """
+    A catalog read from the columnar store, with the column access
+    (get, getX, getY, len, boolean indexing, copy) that pipeTools and
+    MyCat use on a SourceCatalog. Columns are memory-mapped and only
+    read when used; indexing returns an in-memory catalog of the rows.
+
+    Parameters
+    ----------
+    path : string
+        The patch directory of the store.
+    """
+
+    def __init__(self, path, schema=None, columns=None):
+        self.path = path
+        if schema is None:
+            with open(os.path.join(path, _schema_file)) as f:
+                schema = json.load(f)
+        self.schema = schema
+        self._columns = {} if columns is None else columns
+
+    def __len__(self):
+        return self.schema['nrows']
+
+    def __contains__(self, col):
+        return col in self.schema['columns']
+
+    def get(self, col):
+        """
+        Return a column as an ndarray (memory-mapped if not yet indexed).
+        """
+        if col not in self._columns:
+            if col not in self.schema['columns']:
+                raise KeyError(col+' is not in the catalog store')
+            fn = os.path.join(self.path, self.schema['columns'][col]['file'])
+            self._columns[col] = np.load(fn, mmap_mode='r')
+        return self._columns[col]
+
+    def getX(self):
+        return self.get('x')
+
+    def getY(self):
+        return self.get('y')
+
+    def __getitem__(self, index):
+        schema = dict(self.schema)
+        columns = dict((col, np.asarray(self.get(col))[index]) for col in self.schema['columns'])
+        schema['nrows'] = len(next(iter(columns.values()))) if columns else 0
+        return StoredCatalog(self.path, schema, columns)
+
+    def copy(self, deep=True):
+        columns = dict((col, np.array(self.get(col))) for col in self.schema['columns'])
+        return StoredCatalog(self.path, dict(self.schema), columns)
+
+    def get_calib(self):
+        """
+        Return the calibration (zero point) of the patch.
+        """
+        return StoredCalib(self.schema['fluxmag0'])
+
+    def get_wcs(self):
+        """
+        Return an astropy WCS of the patch whose pixel coordinates
+        (0-indexed) are the tract coordinates of x and y.
+        """
+        from astropy.io import fits
+        from astropy.wcs import WCS
+        header = fits.Header()
+        for k, v in self.schema['wcs'].items():
+            if not k.startswith('LTV'):
+                header[k] = v
+        x0, y0 = self.schema['xy0']
+        header['CRPIX1'] += x0
+        header['CRPIX2'] += y0
+        return WCS(header)
+
+def export_catalog(cat, path, columns=default_columns, fluxmag0=None, wcs=None, xy0=(0, 0), **info):
+    """
+    Write catalog columns to a patch directory of the store. The
+    columns are written to a temporary directory that is renamed
+    when complete, so a patch is either fully stored or absent.
+
+    Parameters
+    ----------
+    cat : SourceCatalog
+        The catalog.
+    path : string
+        The patch directory.
+    columns : list of strings, optional
+        The columns to store. Columns missing from the catalog are
+        skipped with a warning. The centroids are always stored.
+    fluxmag0 : float, optional
+        The flux of a zero magnitude source.
+    wcs : dict, optional
+        WCS header cards of the calexp image.
+    xy0 : tuple of ints, optional
+        The tract pixel coordinates of the first calexp pixel.
+    **info :
+        Extra entries of the schema (e.g., tract, patch, band).
+
+    Returns
+    -------
+    schema : dict
+    """
+    if hasattr(cat, 'isContiguous') and not cat.isContiguous():
+        cat = cat.copy(deep=True)
+    tmp = path+'.tmp'
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    schema = {'nrows':len(cat), 'columns':{}, 'fluxmag0':fluxmag0, 'wcs':wcs or {},
+              'xy0':[int(v) for v in xy0], 'created':time.strftime('%Y-%m-%d %H:%M:%S')}
+    schema.update(info)
+    arrays = [(col, None) for col in columns] + [('x', cat.getX), ('y', cat.getY)]
+    for col, getter in arrays:
+        try:
+            data = np.ascontiguousarray(getter() if getter else cat.get(col))
+        except (KeyError, LookupError):
+            print('***** column', col, 'not found; skipping *****')
+            continue
+        fn = col+'.npy'
+        np.save(os.path.join(tmp, fn), data)
+        schema['columns'][col] = {'file':fn, 'dtype':data.dtype.str}
+    with open(os.path.join(tmp, _schema_file), 'w') as f:
+        json.dump(schema, f, indent=1, sort_keys=True)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.rename(tmp, path)
+    return schema
+
+def ingest_patch(tract, patch, band='I', butler=None, root=default_store_dir,
+                 columns=default_columns, overwrite=False):
+    """
+    Read the deepCoadd_meas catalog of a patch with the Butler and add
+    its columns to the store, with the zero point and WCS from the
+    calexp headers.
+
+    Parameters
+    ----------
+    tract, patch, band : int, string, string
+        The patch.
+    butler : Butler object, optional
+        If None, a butler will be created.
+    root : string, optional
+        The store directory.
+    columns : list of strings, optional
+        The columns to store.
+    overwrite : bool, optional
+        If False, patches already in the store are skipped.
+
+    Returns
+    -------
+    path : string
+        The patch directory.
+    """
+    from metadata import get_calexp_metadata
+    band = band.upper()
+    path = _patch_dir(root, tract, patch, band)
+    if os.path.isfile(os.path.join(path, _schema_file)) and not overwrite:
+        print('already stored:', 'HSC-'+band, tract, patch)
+        return path
+    if butler is None:
+        import lsst.daf.persistence
+        from myPipe import dataDIR
+        butler = lsst.daf.persistence.Butler(dataDIR)
+    dataID = {'tract':tract, 'patch':patch, 'filter':'HSC-'+band}
+    meta = get_calexp_metadata(butler.get('deepCoadd_calexp_filename', dataID)[0])
+    xy0 = -int(round(meta['wcs'].get('LTV1', 0))), -int(round(meta['wcs'].get('LTV2', 0)))
+    cat = butler.get('deepCoadd_meas', dataID, immediate=True)
+    print('storing', len(cat), 'sources of', 'HSC-'+band, tract, patch)
+    export_catalog(cat, path, columns, fluxmag0=meta['fluxmag0'], wcs=meta['wcs'], xy0=xy0,
+                   tract=tract, patch=patch, band=band)
+    return path
+
+def open_catalog(tract, patch, band='I', root=default_store_dir):
+    """
+    Open the stored catalog of a patch.
+
+    Returns
+    -------
+    cat : StoredCatalog
+
+    Raises
+    ------
+    IOError
+        If the patch is not in the store.
+    """
+    path = _patch_dir(root, tract, patch, band)
+    if not os.path.isfile(os.path.join(path, _schema_file)):
+        raise IOError('HSC-'+band.upper()+' '+str(tract)+' '+patch+' is not in the catalog store '+root)
+    return StoredCatalog(path)
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Add deepCoadd_meas catalogs to the columnar catalog store')
+    parser.add_argument('tract', type=int, help='tract of observation')
+    parser.add_argument('patches', nargs='+', help='patches of observation')
+    parser.add_argument('-b', '--band', help='observation band', default='I')
+    parser.add_argument('-r', '--root', help='store directory', default=default_store_dir)
+    args = parser.parse_args()
+    for patch in args.patches:
+        ingest_patch(args.tract, patch, args.band, root=args.root)
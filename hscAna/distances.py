@@ -0,0 +1,295 @@
+"""
+Tabulated cosmological distances for batches of galaxy groups. The
+comoving distance is computed once on a redshift grid, cached to disk,
+and evaluated for arrays of redshifts by cubic Hermite interpolation,
+on a grid refined until an analytic bound on the relative interpolation
+error (from the fourth derivative of the comoving distance) is below
+the requested tolerance. By default the cosmological parameters are read
+from toolbox.cosmo.Cosmology, the cosmology of the group catalog, and
+the table is checked against that object's own D_A and D_L.
+"""
+
+from __future__ import division, print_function
+
+__all__ = ['default_distance_dir', 'DistanceTable', 'cosmology_params', 'get_distance_table', 'skybox_angle']
+
+import os
+import numpy as np
+
+default_distance_dir = os.path.join(os.path.expanduser('~'), '.hscAna')
+
+_c = 299792.458 # km/s
+
+_distance_tables = {}
+
+# maximum relative difference from the D_A and D_L of the cosmology 
+# object that the table was built from
+_cosmo_rtol = 1.0e-5
+
+# 5-point Gauss-Legendre nodes and weights on [-1, 1]
+_gl_x, _gl_w = np.polynomial.legendre.leggauss(5)
+
+class DistanceTable(object):
+    """
+    Comoving, angular diameter, and luminosity distances in Mpc for a
+    LCDM cosmology, interpolated from a redshift grid.
+
+    Parameters
+    ----------
+    H0 : float
+        Hubble constant in km/s/Mpc.
+    Om0 : float
+        Matter density parameter.
+    Ode0 : float
+        Dark energy density parameter. The curvature is 1-Om0-Ode0.
+    zmax : float, optional
+        Maximum redshift of the table.
+    rtol : float, optional
+        Relative interpolation error tolerance of D_C. The grid is 
+        refined until the error bound (error_bound) is below rtol. 
+        The error measured at three points inside every grid interval
+        is kept in max_rel_error.
+
+    Notes
+    -----
+    Use get_distance_table to get the table for the cosmology of the
+    group catalog. Redshifts outside [0, zmax] raise a ValueError.
+
+    On a grid interval [a, b], the cubic Hermite interpolant of 
+    f = D_C differs from f by at most max|f''''|*(z-a)**2*(b-z)**2/24,
+    which is max|f''''|*h**4/384 at the midpoint. Since f' = D_H/E(z),
+    f'''' = D_H*d^3/dz^3(1/E), which is evaluated analytically on 
+    a dense sample of each interval, with a safety factor for the 
+    maximum between the samples. The relative bound uses 
+    D_C(z) >= z*D_H/max(E) over [0, z].
+    """
+
+    def __init__(self, H0, Om0, Ode0, zmax=2.0, rtol=1e-8, _grid=None):
+        self.H0, self.Om0, self.Ode0 = H0, Om0, Ode0
+        self.Ok0 = 1.0 - Om0 - Ode0
+        self.zmax, self.rtol = zmax, rtol
+        self.D_H = _c/H0
+        if _grid is None:
+            nz = 64
+            while True:
+                self.z = np.linspace(0.0, zmax, nz+1)
+                self.error_bound = self._error_bound()
+                if self.error_bound < rtol:
+                    break
+                nz *= 2
+            self._D_C = self._integrate(self.z)
+        else:
+            self.z, self._D_C = _grid
+            self.error_bound = self._error_bound()
+        self.max_rel_error = self._check()
+
+    def _E(self, z):
+        zp1 = 1.0 + np.asarray(z, dtype=float)
+        return np.sqrt(self.Om0*zp1**3 + self.Ok0*zp1**2 + self.Ode0)
+
+    def _d3_inv_E(self, z):
+        """
+        Third derivative of 1/E(z) = P**(-1/2), where P = E**2 is a 
+        cubic in (1+z).
+        """
+        zp1 = 1.0 + np.asarray(z, dtype=float)
+        P = self.Om0*zp1**3 + self.Ok0*zp1**2 + self.Ode0
+        dP = 3*self.Om0*zp1**2 + 2*self.Ok0*zp1
+        d2P = 6*self.Om0*zp1 + 2*self.Ok0
+        d3P = 6*self.Om0
+        return (-15.0/8*P**-3.5*dP**3 + 9.0/4*P**-2.5*dP*d2P - 0.5*P**-1.5*d3P)
+
+    def _error_bound(self, nsample=16, safety=1.5):
+        """
+        Return the bound on the relative interpolation error of D_C
+        on the grid self.z (see the class notes).
+        """
+        a, h = self.z[:-1], np.diff(self.z)
+        zs = a[:, np.newaxis] + h[:, np.newaxis]*np.linspace(0.0, 1.0, nsample+1)
+        # max|f''''| on each interval, and max E on [0, b]
+        f4 = safety*self.D_H*np.max(np.abs(self._d3_inv_E(zs)), axis=1)
+        E_max = np.maximum.accumulate(safety*np.max(self._E(zs), axis=1))
+        # max of (z-a)**2*(b-z)**2/z on [a, b]: at z = h/3 if a is 0
+        with np.errstate(divide='ignore'):
+            shape = np.where(a > 0, h**4/(16*a), 4*h**3/27)
+        return float(np.max(f4/24*shape*E_max/self.D_H))
+
+    def _segment(self, a, b):
+        """
+        Comoving distance from redshifts a to b (arrays) by 
+        Gauss-Legendre quadrature.
+        """
+        mid, half = (a+b)/2.0, (b-a)/2.0
+        nodes = mid[:, np.newaxis] + half[:, np.newaxis]*_gl_x
+        return half*(self.D_H/self._E(nodes)).dot(_gl_w)
+
+    def _integrate(self, z):
+        """
+        Comoving distance at the sorted redshifts z (starting at 0).
+        """
+        return np.concatenate([[0.0], np.cumsum(self._segment(z[:-1], z[1:]))])
+
+    def _check(self):
+        """
+        Return the maximum relative error of the interpolation at the
+        quarter points and midpoints of the grid intervals.
+        """
+        self._dD_C = self.D_H/self._E(self.z)
+        error = 0.0
+        for f in [0.25, 0.5, 0.75]:
+            zf = self.z[:-1] + f*np.diff(self.z)
+            exact = self._D_C[:-1] + self._segment(self.z[:-1], zf)
+            error = max(error, float(np.max(np.abs(self.D_C(zf)/exact - 1.0))))
+        return error
+
+    def _key(self):
+        return (self.H0, self.Om0, self.Ode0, self.zmax, self.rtol)
+
+    def save(self, fn):
+        np.savez(fn, key=np.array(self._key()), z=self.z, D_C=self._D_C)
+
+    @classmethod
+    def load(cls, fn):
+        data = np.load(fn)
+        H0, Om0, Ode0, zmax, rtol = data['key']
+        return cls(H0, Om0, Ode0, zmax, rtol, _grid=(data['z'], data['D_C']))
+
+    def D_C(self, z):
+        """
+        Line-of-sight comoving distance in Mpc.
+        """
+        z = np.asarray(z, dtype=float)
+        if np.any(z < 0) or np.any(z > self.zmax):
+            raise ValueError('redshifts must be in [0, '+str(self.zmax)+']')
+        i = np.clip(np.searchsorted(self.z, z, side='right')-1, 0, len(self.z)-2)
+        h = self.z[i+1] - self.z[i]
+        t = (z - self.z[i])/h
+        h00, h10 = (1+2*t)*(1-t)**2, t*(1-t)**2
+        h01, h11 = t**2*(3-2*t), t**2*(t-1)
+        return (h00*self._D_C[i] + h10*h*self._dD_C[i] +
+                h01*self._D_C[i+1] + h11*h*self._dD_C[i+1])
+
+    def D_M(self, z):
+        """
+        Transverse comoving distance in Mpc.
+        """
+        D_C = self.D_C(z)
+        if self.Ok0 > 0:
+            sk = np.sqrt(self.Ok0)
+            return self.D_H/sk*np.sinh(sk*D_C/self.D_H)
+        elif self.Ok0 < 0:
+            sk = np.sqrt(-self.Ok0)
+            return self.D_H/sk*np.sin(sk*D_C/self.D_H)
+        return D_C
+
+    def D_A(self, z):
+        """
+        Angular diameter distance in Mpc.
+        """
+        return self.D_M(z)/(1.0 + np.asarray(z, dtype=float))
+
+    def D_L(self, z):
+        """
+        Luminosity distance in Mpc.
+        """
+        return self.D_M(z)*(1.0 + np.asarray(z, dtype=float))
+
+def cosmology_params(cosmo=None):
+    """
+    Return (H0, Om0, Ode0) of a cosmology object.
+
+    Parameters
+    ----------
+    cosmo : object, optional
+        A cosmology with H0 (km/s/Mpc) or h, Om0, and Ode0 attributes,
+        e.g., astropy.cosmology.LambdaCDM. If None, use
+        toolbox.cosmo.Cosmology(), the cosmology of the group catalog.
+    """
+    if cosmo is None:
+        from toolbox.cosmo import Cosmology
+        cosmo = Cosmology()
+    def get(*names):
+        for name in names:
+            if hasattr(cosmo, name):
+                value = getattr(cosmo, name)
+                return float(getattr(value, 'value', value))
+        raise AttributeError('cosmology has no attribute '+' or '.join(names))
+    H0 = get('H0') if hasattr(cosmo, 'H0') else 100.0*get('h')
+    return H0, get('Om0', 'Om', 'OmegaM'), get('Ode0', 'Ode', 'OL', 'OmegaL')
+
+def get_distance_table(H0=None, Om0=None, Ode0=None, zmax=2.0, rtol=1e-8, outdir=default_distance_dir,
+                       cosmo=None):
+    """
+    Return the distance table for a cosmology. The table is built
+    once, saved in outdir, and kept for the rest of the process. A 
+    saved table whose grid does not meet the error bound is rebuilt.
+
+    Parameters
+    ----------
+    H0, Om0, Ode0 : float, optional
+        See DistanceTable. If any of them is None, all three are read
+        from cosmo (see cosmology_params).
+    zmax, rtol : float, optional
+        See DistanceTable.
+    outdir : string or None, optional
+        Directory of the table files. If None, the table is not saved.
+    cosmo : object, optional
+        The cosmology to read the parameters from. If None, use 
+        toolbox.cosmo.Cosmology(). 
+
+    Notes
+    -----
+    When the parameters are read from a cosmology object with D_A and
+    D_L methods, the table is compared with them at a few redshifts,
+    and a ValueError is raised if they differ by more than 1e-5, so
+    a change in that cosmology cannot silently change the distances.
+    """
+    from_cosmo = H0 is None or Om0 is None or Ode0 is None
+    if from_cosmo:
+        if cosmo is None:
+            from toolbox.cosmo import Cosmology
+            cosmo = Cosmology()
+        H0, Om0, Ode0 = cosmology_params(cosmo)
+    key = (H0, Om0, Ode0, zmax, rtol)
+    if key not in _distance_tables:
+        fn = None
+        if outdir is not None:
+            fn = os.path.join(outdir, 'distances_'+'_'.join(repr(float(k)) for k in key)+'.npz')
+        table = None
+        if fn is not None and os.path.isfile(fn):
+            table = DistanceTable.load(fn)
+            if table.error_bound >= rtol:
+                # saved before the grid was refined to the error bound
+                table = None
+        if table is None:
+            table = DistanceTable(H0, Om0, Ode0, zmax, rtol)
+            if fn is not None:
+                if not os.path.isdir(outdir):
+                    os.makedirs(outdir)
+                table.save(fn)
+        if from_cosmo:
+            _check_cosmology(table, cosmo)
+        _distance_tables[key] = table
+    return _distance_tables[key]
+
+def _check_cosmology(table, cosmo):
+    """
+    Compare the D_A and D_L of a table with those of the cosmology 
+    object it was built from, if it has them.
+    """
+    for name in ['D_A', 'D_L']:
+        if not hasattr(cosmo, name):
+            continue
+        z = np.linspace(0.0, table.zmax, 9)[1:]
+        expected = np.array([float(getattr(d, 'value', d)) for d in map(getattr(cosmo, name), z)])
+        error = np.max(np.abs(getattr(table, name)(z)/expected - 1.0))
+        if error > _cosmo_rtol:
+            raise ValueError(name+' of the distance table differs from the cosmology by '+str(error))
+
+def skybox_angle(z, box_width=3.0, **kwargs):
+    """
+    Return the angular width in degrees of a box of physical width
+    box_width (Mpc) at redshift(s) z, for all groups in one call.
+    The kwargs are passed to get_distance_table.
+    """
+    return (box_width/get_distance_table(**kwargs).D_A(z))*180.0/np.pi
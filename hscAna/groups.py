@@ -5,12 +5,12 @@ with galaxy groups.
 
 from __future__ import print_function
 
-__all__ = ['get_group_fits']
+__all__ = ['get_group_fits', 'get_group_mosaic']
 
 import numpy as np
-import imtools
 
-def get_group_fits(ra, dec, z, group_id, box_width=3.0, band='I', butler=None):
+def get_group_fits(ra, dec, z, group_id, box_width=3.0, band='I', butler=None, manifest=None, cutout=False,
+                   compress=False, compact=False, nworkers=None, nwriters=None, timing=None):
     """
     Get fits files within width/2 of the given coords.  
 
@@ -23,23 +23,157 @@ def get_group_fits(ra, dec, z, group_id, box_width=3.0, band='I', butler=None):
         The galaxy group id. 
     box_width : float, optional 
         The width of the data region in Mpc.
-    band : string, optional
-        The photometric band (GRIZY). 
+    band : string or list of strings, optional
+        The photometric band(s), e.g., 'I' or 'GRIZY'. The sky box is 
+        resolved to patches once, and the bands of each patch are 
+        extracted concurrently. 
     butler : Butler object
         If None, a butler will be created.
+    manifest : Manifest object or string, optional
+        The extraction manifest (or its file name). Patches that have 
+        already been written and transferred are skipped, so that an 
+        interrupted run can be restarted. 
+    cutout : bool, optional
+        If True, only write the part of each patch within the sky box.
+    compress : bool or dict, optional
+        Tile-compression settings (see write.write_deepCoadd_fits).
+    compact : bool, optional
+        If True, write the bad and det masks as uint8 flags.
+    nworkers : int, optional
+        The number of band workers (see write.write_deepCoadd_bands).
+    nwriters : int, optional
+        The number of threads writing the products of each band 
+        (see write.write_deepCoadd_fits).
+    timing : string, optional
+        If not None, per-stage timing and I/O records are appended to
+        this JSON lines file (see instrument.py). If instrumentation is
+        already enabled, the records go to its output instead, and it 
+        is left enabled. 
 
     Notes
     -----
     If it does not exist, a directory called group_id will 
     be created in outdir, and he fits files will be saved
-    there. 
+    there, in group_id/HSC-band/tract/patch. 
     """
     import os, shutil
     import utils
+    import instrument
     from myPipe import dataDIR
     from params.copydir import copydir
-    from write import write_deepCoadd_fits
-    from toolbox.cosmo import Cosmology
+    from write import write_deepCoadd_bands
+    from transfer import TransferQueue
+    from manifest import Manifest
+    from distances import skybox_angle
+
+    if isinstance(manifest, str):
+        manifest = Manifest(manifest)
+    # only disable the instrumentation at the end if it is enabled here
+    enabled_here = (timing is not None) and not instrument.is_enabled()
+    if enabled_here:
+        instrument.enable(timing, group=str(group_id))
+    try:
+        if butler is None:
+            import lsst.daf.persistence
+            butler = lsst.daf.persistence.Butler(dataDIR)
+        main_out = os.path.dirname(os.path.abspath(__file__))
+        main_out= os.path.join(main_out, 'output')
+
+
+        group_dir = os.path.join(main_out, 'group_'+str(group_id))
+        if not os.path.isdir(group_dir):
+            print('created', group_dir)
+            os.mkdir(group_dir)
+
+        theta = skybox_angle(z, box_width)
+        print('will extract a sky box with sides of ', theta, 'degrees')
+        box = utils.skybox(ra, dec, theta)
+        with instrument.stage('group.regions'):
+            regions = utils.get_hsc_regions(box, butler=butler)
+        print('***** found', len(regions), 'frames in region *****')
+
+        # rsync fits files to different machine due to limited disk space,
+        # while the next patch is extracted
+        transfer = TransferQueue(copydir)
+
+        bands = [b.upper() for b in band]
+        products = ['img', 'bad', 'det', 'sig', 'psf', 'wts', 'wts_bad']
+        for tract, patch in regions:
+            todo = bands
+            if manifest is not None:
+                todo = [b for b in bands if not 
+                        manifest.is_done(tract, patch, b, products, group=group_id, status='transferred')]
+                if not todo:
+                    print('already transferred:', 'HSC-'+''.join(bands)+':', tract, patch)
+                    continue
+            print('getting deepCoadds for:', 'HSC-'+''.join(todo)+':', tract, patch)
+
+            # output directories are group_dir/HSC-band/tract/patch
+            with instrument.stage('group.patch', tract=tract, patch=patch, bands=''.join(todo)):
+                stats = write_deepCoadd_bands(tract, patch, todo, root=group_dir, nworkers=nworkers, 
+                                              butler=butler, weights=True, manifest=manifest, group=group_id, 
+                                              skybox=box if cutout else None, compress=compress, compact=compact, 
+                                              nwriters=nwriters)
+            print('read', sum(stats[b]['bytes_read'] for b in todo), 'bytes, wrote', 
+                  sum(stats[b]['bytes_written'] for b in todo), 'bytes')
+
+            # files are deleted after a successful transfer
+            for b in todo:
+                outdir = os.path.join(group_dir, 'HSC-'+b, str(tract), patch[0]+'-'+patch[-1])
+                callback = None
+                if manifest is not None:
+                    callback = lambda tract=tract, patch=patch, b=b: manifest.mark_transferred(tract, patch, b, group=group_id)
+                transfer.submit(outdir, root=main_out, callback=callback)
+            print('transfer queue depth:', transfer.queue_depth())
+
+        with instrument.stage('group.transfer_wait'):
+            transfer.close()
+        stats = transfer.stats()
+        print('transferred', stats['done'], 'patches,', stats['bytes'], 'bytes at', 
+              round(stats['throughput'], 2), 'MB/s, max queue depth', stats['max_queue_depth'])
+        if transfer.failed:
+            print('***** transfer failed for', len(transfer.failed), 'patches; keeping', group_dir, '*****')
+        else:
+            print('deleting', group_dir)
+            shutil.rmtree(group_dir)
+        if timing is not None:
+            for name, total in sorted(instrument.summary().items()):
+                print('{:>22}: {:6d} calls {:9.2f} s wall {:9.2f} s cpu {:12d} bytes read {:12d} bytes written'.format(
+                      name, total['n'], total['wall'], total['cpu'], total['bytes_read'], total['bytes_written']))
+    finally:
+        if enabled_here:
+            instrument.disable()
+    print('task complete!')
+
+def get_group_mosaic(ra, dec, z, group_id, box_width=3.0, band='I', butler=None, overlap='inner'):
+    """
+    Build one image, weight, and mask mosaic of the sky box around
+    a galaxy group, instead of separate files for every patch.
+
+    Parameters
+    ----------
+    ra, dec, z : float
+        The luminosity-weighted right ascension, 
+        declination and redshift of a galaxy group.
+    group_id : int or string
+        The galaxy group id. 
+    box_width : float, optional 
+        The width of the data region in Mpc.
+    band : string, optional
+        The photometric band (GRIZY). 
+    butler : Butler object
+        If None, a butler will be created.
+    overlap : string, optional
+        How patch overlaps are resolved ('inner' or 'ivw'; 
+        see mosaic.build_mosaic).
+    """
+    import os, shutil
+    import utils
+    from myPipe import dataDIR
+    from params.copydir import copydir
+    from mosaic import build_mosaic
+    from transfer import TransferQueue
+    from distances import skybox_angle
 
     if butler is None:
         import lsst.daf.persistence
@@ -47,47 +181,20 @@ def get_group_fits(ra, dec, z, group_id, box_width=3.0, band='I', butler=None):
     main_out = os.path.dirname(os.path.abspath(__file__))
     main_out= os.path.join(main_out, 'output')
 
+    outdir = os.path.join(main_out, 'group_'+str(group_id), 'HSC-'+band)
+    if not os.path.isdir(outdir):
+        print('created', outdir)
+        os.makedirs(outdir)
 
-    group_dir = os.path.join(main_out, 'group_'+str(group_id))
-    if not os.path.isdir(group_dir):
-        print('created', group_dir)
-        os.mkdir(group_dir)
-
-    cmd = 'rsync -avc '+group_dir+' '+copydir
-
-    band_dir = os.path.join(group_dir, 'HSC-'+band)
-
-    D_A = Cosmology().D_A(z) # angular diameter distance
-    theta = (box_width/D_A)*180.0/np.pi
-    print('will extract a sky box with sides of ', theta, 'degrees')
-    regions = utils.get_hsc_regions(utils.skybox(ra, dec, theta), butler=butler)
-    print('***** found', len(regions), 'frames in region *****')
-
-    for tract, patch in regions:
-        print('getting deepCoadds for:', 'HSC-'+band+':', tract, patch)
-        outdir = group_dir
-
-        # make output directories if they don't exist
-        dirs = ['HSC-'+band, str(tract), patch[0]+'-'+patch[-1]]
-        for d in dirs:
-            outdir = os.path.join(outdir, d)
-            if not os.path.isdir(outdir):
-                print('created', outdir)
-                os.mkdir(outdir)
-
-        write_deepCoadd_fits(tract, patch, band, butler=butler, outdir=outdir)
-        imtools.sig_to_wts(os.path.join(outdir, 'sig.fits'), os.path.join(outdir, 'wts.fits'))
-        imtools.wts_with_badpix(os.path.join(outdir, 'wts.fits'), os.path.join(outdir, 'bad.fits'),
-                                os.path.join(outdir, 'wts_bad.fits'))
-
-        # rsync fits files to different machine due to limited disk space
-        os.system(cmd)
+    theta = skybox_angle(z, box_width)
+    print('will build a mosaic of a sky box with sides of ', theta, 'degrees')
+    build_mosaic(utils.skybox(ra, dec, theta), band, outdir=outdir, prefix='mosaic', 
+                 overlap=overlap, butler=butler)
 
-        # delete files
-        print('deleting', band_dir)
-        shutil.rmtree(band_dir)
-    print('deleting', group_dir)
-    shutil.rmtree(group_dir)
+    # rsync fits files to different machine due to limited disk space
+    transfer = TransferQueue(copydir)
+    transfer.submit(os.path.dirname(outdir), root=main_out)
+    transfer.close()
     print('task complete!')
 
 if __name__=='__main__':
@@ -98,6 +205,19 @@ if __name__=='__main__':
     parser.add_argument('z', type=float, help='luminosity-weighted redshift of group')
     parser.add_argument('group_id', type=str, help='group id')
     parser.add_argument('-w', '--box_width', type=float, help='width of the data region in Mpc', default=3.0)
-    parser.add_argument('-b', '--band', help='observation band', default='I')
+    parser.add_argument('-b', '--band', help='observation band(s), e.g., I or GRIZY', default='I')
+    parser.add_argument('-m', '--manifest', help='extraction manifest file for restarts', default=None)
+    parser.add_argument('-c', '--cutout', action='store_true', help='only write the sky box part of each patch')
+    parser.add_argument('--mosaic', action='store_true', help='write a single mosaic of the sky box')
+    parser.add_argument('-z', '--compress', action='store_true', help='write tile-compressed images')
+    parser.add_argument('--compact', action='store_true', help='write the bad and det masks as uint8 flags')
+    parser.add_argument('-n', '--nworkers', type=int, help='number of band workers', default=None)
+    parser.add_argument('--nwriters', type=int, help='number of product writer threads per band', default=None)
+    parser.add_argument('-t', '--timing', help='JSON lines file for per-stage timing', default=None)
     args = parser.parse_args()
-    get_group_fits(args.ra, args.dec, args.z, args.group_id, args.box_width, args.band)
+    if args.mosaic:
+        get_group_mosaic(args.ra, args.dec, args.z, args.group_id, args.box_width, args.band)
+    else:
+        get_group_fits(args.ra, args.dec, args.z, args.group_id, args.box_width, args.band, 
+                       manifest=args.manifest, cutout=args.cutout, compress=args.compress, compact=args.compact,
+                       nworkers=args.nworkers, nwriters=args.nwriters, timing=args.timing)
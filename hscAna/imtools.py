@@ -1,8 +1,49 @@
 from __future__ import print_function
 
+from contextlib import contextmanager
 from astropy.io import fits
 
-def sig_to_wts(sigfile, wfile='wts.fits'):
+def _writeto(outfile, data, header):
+    """
+    Write an image to outfile, overwriting it (without the clobber 
+    keyword, which newer versions of astropy do not accept). 
+    """
+    import os
+    if os.path.isfile(outfile):
+        os.remove(outfile)
+    fits.writeto(outfile, data, header)
+
+@contextmanager
+def _stage(name, infiles, outfile, chunk_rows):
+    """
+    Time a conversion as the instrumentation stage imtools.name, 
+    counting the bytes of the input and output files. 
+    """
+    import os
+    import instrument
+    with instrument.stage('imtools.'+name, chunked=chunk_rows is not None) as st:
+        yield
+        if instrument.is_enabled():
+            st.count(bytes_read=sum(os.path.getsize(f) for f in infiles),
+                     bytes_written=os.path.getsize(outfile))
+
+def _stream_rows(outfile, header, nrows, chunk_rows, make_chunk):
+    """
+    Write an image to outfile in blocks of chunk_rows rows, where 
+    make_chunk(r0, r1) returns rows r0 to r1 of the output image. 
+    Only one block is held in memory at a time. 
+    """
+    import os
+    if os.path.isfile(outfile):
+        os.remove(outfile)
+    shdu = fits.StreamingHDU(outfile, header)
+    try:
+        for r0 in range(0, nrows, chunk_rows):
+            shdu.write(make_chunk(r0, min(r0+chunk_rows, nrows)))
+    finally:
+        shdu.close()
+
+def sig_to_wts(sigfile, wfile='wts.fits', chunk_rows=None):
     """
     Convert sigma image to weights image, where 
     weight = 1/sigma**2. 
@@ -13,14 +54,25 @@ def sig_to_wts(sigfile, wfile='wts.fits'):
         The input sigma image file.
     wfile : string, optional
         The output weights image file.
+    chunk_rows : int, optional
+        If not None, memory-map the input and stream the output
+        in blocks of chunk_rows rows, so that peak memory is 
+        bounded by the block size. 
     """
-    sigfits = fits.open(sigfile)[0]
-    weights = 1.0/sigfits.data**2
-    print('writing', wfile)
-    fits.writeto(wfile, weights, sigfits.header, clobber=True)
-
+    with _stage('sig_to_wts', [sigfile], wfile, chunk_rows):
+        if chunk_rows is None:
+            sigfits = fits.open(sigfile)[0]
+            weights = 1.0/sigfits.data**2
+            print('writing', wfile)
+            _writeto(wfile, weights, sigfits.header)
+        else:
+            with fits.open(sigfile, memmap=True) as hdulist:
+                sig = hdulist[0].data
+                print('writing', wfile)
+                _stream_rows(wfile, hdulist[0].header, sig.shape[0], chunk_rows, 
+                             lambda r0, r1: 1.0/sig[r0:r1]**2)
 
-def wts_with_badpix(wfile, badfile, wnewfile='wts_bad.fits', flagval=-100.0):
+def wts_with_badpix(wfile, badfile, wnewfile='wts_bad.fits', flagval=-100.0, chunk_rows=None):
     """
     Flag bad pixels in the weight image for sextractor.
 
@@ -35,9 +87,26 @@ def wts_with_badpix(wfile, badfile, wnewfile='wts_bad.fits', flagval=-100.0):
     flagval : float, optional
         The weight to be assigned to bad pixels.
         (sextractor default threshhold = 0)
+    chunk_rows : int, optional
+        If not None, memory-map the inputs and stream the output
+        in blocks of chunk_rows rows, so that peak memory is 
+        bounded by the block size. 
     """
-    badpix = fits.getdata(badfile)
-    wfits = fits.open(wfile)[0]
-    wfits.data[badpix!=0] = flagval
-    print('writing', wnewfile)
-    fits.writeto(wnewfile, wfits.data, wfits.header, clobber=True)
+    with _stage('wts_with_badpix', [wfile, badfile], wnewfile, chunk_rows):
+        if chunk_rows is None:
+            badpix = fits.getdata(badfile)
+            wfits = fits.open(wfile)[0]
+            wfits.data[badpix!=0] = flagval
+            print('writing', wnewfile)
+            _writeto(wnewfile, wfits.data, wfits.header)
+        else:
+            with fits.open(wfile, memmap=True) as whdus, fits.open(badfile, memmap=False) as bhdus:
+                # unsigned masks are stored with BZERO, which cannot be 
+                # memory-mapped, so the rows are read from the file section
+                wts, badpix = whdus[0].data, bhdus[0].section
+                def make_chunk(r0, r1):
+                    chunk = wts[r0:r1].copy()
+                    chunk[badpix[r0:r1]!=0] = flagval
+                    return chunk
+                print('writing', wnewfile)
+                _stream_rows(wnewfile, whdus[0].header, wts.shape[0], chunk_rows, make_chunk)
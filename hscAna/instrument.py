@@ -0,0 +1,192 @@
+"""
+Lightweight per-stage instrumentation. Stages are timed with context
+managers, and bytes read and written and arrays allocated are counted
+in the innermost active stage. Each finished stage is written as one
+JSON line, so the records of many batch jobs can be concatenated and
+aggregated. When instrumentation is disabled (the default), stage and
+count return immediately.
+
+Enable it with enable('timing.jsonl', group=...), or by setting the
+HSCANA_INSTRUMENT environment variable to the output file name.
+"""
+
+from __future__ import division, print_function
+
+__all__ = ['enable', 'disable', 'is_enabled', 'stage', 'count', 'summary']
+
+import os
+import sys
+import json
+import time
+import socket
+import threading
+
+try:
+    _cpu_time = time.process_time
+except AttributeError:
+    _cpu_time = time.clock
+
+_enabled = False
+_output = None
+_context = {}
+_totals = {}
+_lock = threading.Lock()
+_local = threading.local()
+
+_counters = ['bytes_read', 'bytes_written', 'arrays', 'array_bytes']
+
+class _NullStage(object):
+    """
+    Stage returned when instrumentation is disabled.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def count(self, **counters):
+        pass
+
+_null_stage = _NullStage()
+
+class _Stage(object):
+    """
+    A timed stage. Counters added with count (or the module-level
+    count while the stage is the innermost one) are included in its
+    record, and are also added to the enclosing stages.
+    """
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        self.counters = dict((c, 0) for c in _counters)
+
+    def __enter__(self):
+        stack = _stack()
+        self.parent = stack[-1] if stack else None
+        stack.append(self)
+        self._wall0, self._cpu0 = time.time(), _cpu_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall, cpu = time.time()-self._wall0, _cpu_time()-self._cpu0
+        _stack().pop()
+        if self.parent is not None:
+            self.parent.count(**self.counters)
+        record = dict(_context)
+        record.update(self.fields)
+        record.update(self.counters)
+        record.update({'stage':self.name, 'wall':wall, 'cpu':cpu, 'start':self._wall0,
+                       'pid':os.getpid(), 'thread':threading.current_thread().name,
+                       'ok':exc_type is None})
+        _emit(record)
+        return False
+
+    def count(self, **counters):
+        for k, v in counters.items():
+            self.counters[k] = self.counters.get(k, 0) + v
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+def _emit(record):
+    with _lock:
+        total = _totals.setdefault(record['stage'], dict((c, 0) for c in ['n', 'wall', 'cpu']+_counters))
+        total['n'] += 1
+        for k in ['wall', 'cpu']+_counters:
+            total[k] += record.get(k, 0)
+        if _output is not None:
+            _output.write(json.dumps(record, sort_keys=True)+'\n')
+            _output.flush()
+
+def enable(fn=None, **context):
+    """
+    Enable instrumentation.
+
+    Parameters
+    ----------
+    fn : string or file, optional
+        JSON lines output file (appended to) or stream. If None, the
+        records are only added to the summary.
+    **context :
+        Fields added to every record (e.g., group='123', band='I').
+        The host name is always added.
+    """
+    global _enabled, _output
+    disable()
+    if isinstance(fn, str):
+        outdir = os.path.dirname(os.path.abspath(fn))
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        fn = open(fn, 'a')
+    _output = fn
+    _context.clear()
+    _context['host'] = socket.gethostname()
+    _context.update(context)
+    _enabled = True
+
+def disable():
+    """
+    Disable instrumentation and close the output file.
+    """
+    global _enabled, _output
+    _enabled = False
+    if _output is not None and _output not in (sys.stdout, sys.stderr):
+        _output.close()
+    _output = None
+
+def is_enabled():
+    return _enabled
+
+def stage(name, **fields):
+    """
+    Return a context manager that times a stage.
+
+    Parameters
+    ----------
+    name : string
+        The stage name (e.g., 'write.fits').
+    **fields :
+        Extra fields of the record (e.g., tract=9347, product='img').
+
+    Examples
+    --------
+    >>> with stage('write.fits', product='img') as st:
+    ...     fits.writeto(fn, data, header)
+    ...     st.count(bytes_written=os.path.getsize(fn))
+    """
+    if not _enabled:
+        return _null_stage
+    return _Stage(name, fields)
+
+def count(**counters):
+    """
+    Add counters (bytes_read, bytes_written, arrays, array_bytes, or
+    any other name) to the innermost active stage of this thread.
+    """
+    if not _enabled:
+        return
+    stack = _stack()
+    if stack:
+        stack[-1].count(**counters)
+
+def summary(reset=False):
+    """
+    Return the totals per stage in this process: the number of calls,
+    wall and CPU time, and the counters. Nested stages are included in
+    the totals of their parents, so the totals do not add up across
+    stages. The CPU time is that of the whole process, so it includes
+    other threads that ran during the stage.
+    """
+    with _lock:
+        totals = dict((k, dict(v)) for k, v in _totals.items())
+        if reset:
+            _totals.clear()
+    return totals
+
+if os.environ.get('HSCANA_INSTRUMENT'):
+    enable(os.environ['HSCANA_INSTRUMENT'])
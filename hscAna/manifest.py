@@ -0,0 +1,113 @@
+"""
+A durable record of the extracted products. Each (group, tract, patch,
+band, product) is recorded with its size and checksum after it is
+written, and marked again once it has been transferred, so that an
+interrupted extraction can be restarted without redoing finished work.
+"""
+
+from __future__ import division, print_function
+
+__all__ = ['Manifest', 'file_checksum']
+
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+_status_levels = {'written':0, 'transferred':1}
+
+def file_checksum(fn, blocksize=2**20):
+    """
+    Return the md5 checksum of a file.
+    """
+    md5 = hashlib.md5()
+    with open(fn, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+class Manifest(object):
+    """
+    SQLite-backed extraction manifest. Safe to use from several
+    threads of the same process.
+
+    Parameters
+    ----------
+    fn : string
+        The manifest database file. It is created if it does not exist.
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(fn, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS products ('
+                             'grp TEXT, tract INTEGER, patch TEXT, band TEXT, product TEXT, '
+                             'path TEXT, size INTEGER, checksum TEXT, status TEXT, time REAL, '
+                             'PRIMARY KEY (grp, tract, patch, band, product))')
+
+    def close(self):
+        self._db.close()
+
+    def record(self, path, tract, patch, band, product, group=''):
+        """
+        Record a product after it has been written to path.
+        """
+        row = (str(group), int(tract), patch, band.upper(), product, os.path.abspath(path),
+               os.path.getsize(path), file_checksum(path), 'written', time.time())
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO products VALUES (?,?,?,?,?,?,?,?,?,?)', row)
+
+    def mark_transferred(self, tract, patch, band, group=''):
+        """
+        Mark all products of a unit as transferred.
+        """
+        with self._lock, self._db:
+            self._db.execute("UPDATE products SET status='transferred', time=? "
+                             "WHERE grp=? AND tract=? AND patch=? AND band=?",
+                             (time.time(), str(group), int(tract), patch, band.upper()))
+
+    def get(self, tract, patch, band, group=''):
+        """
+        Return the recorded products of a unit as a dict with the
+        product names as keys and (path, size, checksum, status) as values.
+        """
+        with self._lock:
+            rows = self._db.execute('SELECT product, path, size, checksum, status FROM products '
+                                    'WHERE grp=? AND tract=? AND patch=? AND band=?',
+                                    (str(group), int(tract), patch, band.upper())).fetchall()
+        return dict((r[0], tuple(r[1:])) for r in rows)
+
+    def is_done(self, tract, patch, band, products, group='', status='written', check_files=False):
+        """
+        Check if all the products of a unit are complete.
+
+        Parameters
+        ----------
+        tract, patch, band : int, string, string
+            The unit.
+        products : list of strings
+            The products that make up the unit.
+        group : string, optional
+            The group id, if the unit belongs to a group.
+        status : string, optional
+            Minimum status of the products: 'written' or 'transferred'.
+        check_files : bool, optional
+            If True, the files must also exist with the recorded size.
+
+        Returns
+        -------
+        done : bool
+        """
+        recorded = self.get(tract, patch, band, group)
+        for product in products:
+            if product not in recorded:
+                return False
+            path, size, checksum, _status = recorded[product]
+            if _status_levels[_status] < _status_levels[status]:
+                return False
+            if check_files and not (os.path.isfile(path) and os.path.getsize(path)==size):
+                return False
+        return True
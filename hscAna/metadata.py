@@ -0,0 +1,141 @@
+"""
+Header-only access to deepCoadd_calexp metadata. The zero point, pixel
+scale and WCS are read from the FITS headers without loading any pixel
+data, and are kept in a persistent per-file index so that repeated
+queries across many patches do not touch the files at all.
+"""
+
+from __future__ import division, print_function
+
+__all__ = ['default_metadata_file', 'MetadataIndex', 'read_calexp_metadata',
+           'get_calexp_metadata', 'metadata_to_wcs']
+
+import os
+import json
+import sqlite3
+import threading
+import numpy as np
+
+default_metadata_file = os.path.join(os.path.expanduser('~'), '.hscAna', 'metadata.sqlite')
+
+_wcs_keys = ['CTYPE1', 'CTYPE2', 'CRVAL1', 'CRVAL2', 'CRPIX1', 'CRPIX2',
+             'CD1_1', 'CD1_2', 'CD2_1', 'CD2_2', 'CDELT1', 'CDELT2',
+             'PC1_1', 'PC1_2', 'PC2_1', 'PC2_2', 'CUNIT1', 'CUNIT2',
+             'RADESYS', 'EQUINOX', 'LTV1', 'LTV2']
+
+_metadata_indexes = {}
+
+def read_calexp_metadata(fn):
+    """
+    Read the metadata of a deepCoadd_calexp file from its headers only.
+
+    Parameters
+    ----------
+    fn : string
+        The calexp fits file name.
+
+    Returns
+    -------
+    meta : dict
+        fluxmag0, zptmag (2.5*log10(fluxmag0)), pixscale (arcsec/pixel
+        at the reference pixel), shape (ny, nx) of the image, and the
+        WCS header cards of the image extension.
+    """
+    from astropy.io import fits
+    primary = fits.getheader(fn, 0)
+    image = fits.getheader(fn, 1)
+    fluxmag0 = primary.get('FLUXMAG0', image.get('FLUXMAG0'))
+    if 'CD1_1' in image:
+        cd = np.array([[image['CD1_1'], image.get('CD1_2', 0.0)],
+                       [image.get('CD2_1', 0.0), image['CD2_2']]])
+    else:
+        pc = np.array([[image.get('PC1_1', 1.0), image.get('PC1_2', 0.0)],
+                       [image.get('PC2_1', 0.0), image.get('PC2_2', 1.0)]])
+        cd = np.diag([image.get('CDELT1', 1.0), image.get('CDELT2', 1.0)]).dot(pc)
+    meta = {'fluxmag0':fluxmag0,
+            'zptmag':2.5*np.log10(fluxmag0) if fluxmag0 else None,
+            'pixscale':float(np.sqrt(abs(np.linalg.det(cd))))*3600.0,
+            'shape':(image['NAXIS2'], image['NAXIS1']),
+            'wcs':dict((k, image[k]) for k in _wcs_keys if k in image)}
+    return meta
+
+def metadata_to_wcs(meta):
+    """
+    Build an astropy WCS from the header cards in meta. Pixel
+    coordinates are those of the image array (FITS convention).
+    """
+    from astropy.io import fits
+    from astropy.wcs import WCS
+    header = fits.Header()
+    for k, v in meta['wcs'].items():
+        if not k.startswith('LTV'):
+            header[k] = v
+    return WCS(header)
+
+class MetadataIndex(object):
+    """
+    Persistent SQLite index of calexp metadata, keyed by file name. An
+    entry is re-read if the file size or modification time changes.
+
+    Parameters
+    ----------
+    fn : string
+        The index database file. It is created if it does not exist.
+    """
+
+    def __init__(self, fn=default_metadata_file):
+        outdir = os.path.dirname(os.path.abspath(fn))
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        self.fn = fn
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(fn, check_same_thread=False)
+        self._memo = {}
+        with self._lock, self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS metadata ('
+                             'path TEXT PRIMARY KEY, size INTEGER, mtime REAL, meta TEXT)')
+
+    def close(self):
+        self._db.close()
+
+    def get(self, path):
+        """
+        Return the metadata for path, reading the headers only if the
+        file is not indexed or has changed.
+        """
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        if path in self._memo and self._memo[path][:2]==(st.st_size, st.st_mtime):
+            return self._memo[path][2]
+        with self._lock:
+            row = self._db.execute('SELECT size, mtime, meta FROM metadata WHERE path=?',
+                                   (path,)).fetchone()
+        if (row is not None) and (row[0]==st.st_size) and (row[1]==st.st_mtime):
+            meta = json.loads(row[2])
+        else:
+            meta = read_calexp_metadata(path)
+            with self._lock, self._db:
+                self._db.execute('INSERT OR REPLACE INTO metadata VALUES (?,?,?,?)',
+                                 (path, st.st_size, st.st_mtime, json.dumps(meta)))
+        meta['shape'] = tuple(meta['shape'])
+        self._memo[path] = (st.st_size, st.st_mtime, meta)
+        return meta
+
+def get_calexp_metadata(fn, index_file=default_metadata_file):
+    """
+    Return the metadata of a calexp file using the persistent index,
+    which is opened once per process.
+
+    Parameters
+    ----------
+    fn : string
+        The calexp fits file name.
+    index_file : string or None, optional
+        The index database file. If None, read the headers directly.
+    """
+    if index_file is None:
+        return read_calexp_metadata(fn)
+    index_file = os.path.abspath(index_file)
+    if index_file not in _metadata_indexes:
+        _metadata_indexes[index_file] = MetadataIndex(index_file)
+    return _metadata_indexes[index_file].get(fn)
@@ -0,0 +1,199 @@
+"""
+Build a single image, weight map, and mask for a sky region (e.g., a
+galaxy group's skybox) from all the patches that overlap it. The output
+arrays are memory-mapped FITS files in the pixel frame of the tract
+that contains the region center, and the patches are read one at a time (only
+the part that overlaps the region), so memory is bounded by the output
+size rather than by the number of patches.
+"""
+
+from __future__ import division, print_function
+
+__all__ = ['build_mosaic', 'read_patch_arrays']
+
+import os
+import numpy as np
+
+def read_patch_arrays(tract, patch, band, bbox, butler=None):
+    """
+    Read the image, variance, and mask of the part of a patch within
+    bbox = (xmin, ymin, xmax, ymax) in tract pixel coordinates.
+    """
+    from myPipe import MyPipe
+    mi = MyPipe(tract, patch, band=band, butler=butler, bbox=bbox).maskedImg
+    return mi.getImage().getArray(), mi.getVariance().getArray(), mi.getMask().getArray()
+
+def _tract_header(cache, idx, x0, y0):
+    """
+    FITS WCS header of tract row idx for an array whose first pixel
+    is (x0, y0) in tract pixel coordinates.
+    """
+    from astropy.io import fits
+    header = fits.Header()
+    header['CTYPE1'], header['CTYPE2'] = 'RA---TAN', 'DEC--TAN'
+    header['CRVAL1'], header['CRVAL2'] = cache.crval[idx]
+    header['CRPIX1'] = cache.crpix[idx,0] - x0 + 1.0
+    header['CRPIX2'] = cache.crpix[idx,1] - y0 + 1.0
+    (header['CD1_1'], header['CD1_2']), (header['CD2_1'], header['CD2_2']) = cache.cd[idx]
+    header['LTV1'], header['LTV2'] = -x0, -y0
+    header['TRACT'] = int(cache.tract[idx])
+    return header
+
+def _create_fits(fn, shape, dtype, header):
+    """
+    Create a FITS file of zeros without allocating the data in memory,
+    and return it opened in update mode with the data memory-mapped.
+    """
+    from astropy.io import fits
+    header = header.copy()
+    hdu = fits.PrimaryHDU(data=np.zeros((1, 1), dtype=dtype))
+    full = hdu.header
+    full['NAXIS1'], full['NAXIS2'] = shape[1], shape[0]
+    full.extend(header)
+    if os.path.isfile(fn):
+        os.remove(fn)
+    full.tofile(fn)
+    nbytes = shape[0]*shape[1]*np.dtype(dtype).itemsize
+    with open(fn, 'rb+') as f:
+        f.seek(len(full.tostring()) + int(np.ceil(nbytes/2880.0))*2880 - 1)
+        f.write(b'\0')
+    return fits.open(fn, mode='update', memmap=True)
+
+def build_mosaic(box_coords, band='I', outdir='.', prefix='mosaic', overlap='inner',
+                 butler=None, reader=read_patch_arrays, data_dir=None):
+    """
+    Build an image, weight (1/variance), and mask mosaic of a sky region.
+
+    Parameters
+    ----------
+    box_coords : list of tuples
+        The corners (ra, dec) in degrees of the region, e.g., the
+        output of utils.skybox.
+    band : string, optional
+        The photometric band (GRIZY).
+    outdir : string, optional
+        The output directory.
+    prefix : string, optional
+        Output file name prefix: prefix_img.fits, prefix_wts.fits,
+        and prefix_mask.fits.
+    overlap : string, optional
+        How pixels covered by more than one patch are resolved. 'inner':
+        each pixel comes from the patch whose inner region contains it,
+        in the tract that contains it (see SkymapCache.find_tract). 'ivw':
+        inverse-variance weighted mean of all patches, with the masks
+        combined with OR.
+    butler : Butler object, optional
+        Passed to the reader and to the skymap cache.
+    reader : function, optional
+        reader(tract, patch, band, bbox, butler) returns the image,
+        variance, and mask arrays of the patch within bbox.
+    data_dir : string, optional
+        The data directory (rerun) of the skymap cache. If None, the 
+        root of butler or the default dataDIR.
+
+    Returns
+    -------
+    files : list of strings
+        The image, weight, and mask file names.
+
+    Notes
+    -----
+    Pixels from tracts other than the reference tract are resampled
+    with nearest-neighbor interpolation.
+    """
+    from skymap import get_skymap_cache
+    from utils import get_hsc_regions
+    assert overlap in ['inner', 'ivw'], 'overlap must be inner or ivw'
+
+    band = band.upper()
+    cache = get_skymap_cache(butler=butler, data_dir=data_dir)
+    ra, dec = np.asarray(box_coords, dtype=float).reshape(-1, 2).T
+    xyz = np.array([np.cos(np.deg2rad(dec))*np.cos(np.deg2rad(ra)),
+                    np.cos(np.deg2rad(dec))*np.sin(np.deg2rad(ra)),
+                    np.sin(np.deg2rad(dec))]).mean(axis=1)
+    ra_c = np.rad2deg(np.arctan2(xyz[1], xyz[0]))%360.0
+    dec_c = np.rad2deg(np.arctan2(xyz[2], np.hypot(xyz[0], xyz[1])))
+    ref = cache.find_tract(ra_c, dec_c)[0][0]
+    if ref < 0:
+        ref = cache.find_nearest_tract(ra_c, dec_c)
+
+    # output frame in reference tract pixel coordinates
+    x, y = cache.sky_to_pixel(np.full(len(ra), ref, dtype=int), ra, dec)
+    X0, Y0 = int(np.floor(x.min()+0.5)), int(np.floor(y.min()+0.5))
+    X1, Y1 = int(np.floor(x.max()+0.5)), int(np.floor(y.max()+0.5))
+    shape = (Y1-Y0+1, X1-X0+1)
+    header = _tract_header(cache, ref, X0, Y0)
+    header['FILTER'] = 'HSC-'+band
+    print('building', shape[1], 'x', shape[0], 'mosaic in tract', cache.tract[ref])
+
+    files = [os.path.join(outdir, prefix+'_'+lab+'.fits') for lab in ['img', 'wts', 'mask']]
+    hdus = [_create_fits(fn, shape, dt, header) for fn, dt in zip(files, [np.float32, np.float32, np.int32])]
+    out_img, out_wts, out_mask = [h[0].data for h in hdus]
+
+    try:
+        for tract, patch in get_hsc_regions(box_coords, butler=butler, exact=True, data_dir=data_dir):
+            patch = patch.decode() if isinstance(patch, bytes) else patch
+            t = cache.tract_index(tract)
+            i, j = [int(p) for p in patch.split(',')]
+            bx0, by0, bx1, by1 = cache.bbox[t]
+            nx, ny = cache.patch_inner[t]
+            px0, py0 = bx0+i*nx, by0+j*ny
+            px1, py1 = min(px0+nx-1, bx1), min(py0+ny-1, by1)
+            if overlap=='ivw':
+                border = cache.patch_border[t]
+                px0, py0 = max(px0-border, bx0), max(py0-border, by0)
+                px1, py1 = min(px1+border, bx1), min(py1+border, by1)
+
+            # output pixels that this patch can cover
+            cx, cy = np.array([px0, px1, px0, px1]), np.array([py0, py0, py1, py1])
+            cra, cdec = cache.pixel_to_sky(np.full(4, t, dtype=int), cx, cy)
+            ox, oy = cache.sky_to_pixel(np.full(4, ref, dtype=int), cra, cdec)
+            ox0, ox1 = max(int(np.floor(ox.min()))-1, X0), min(int(np.ceil(ox.max()))+1, X1)
+            oy0, oy1 = max(int(np.floor(oy.min()))-1, Y0), min(int(np.ceil(oy.max()))+1, Y1)
+            if (ox0 > ox1) or (oy0 > oy1):
+                continue
+            ox, oy = np.meshgrid(np.arange(ox0, ox1+1), np.arange(oy0, oy1+1))
+            sra, sdec = cache.pixel_to_sky(np.full(ox.shape, ref, dtype=int), ox, oy)
+            if t==ref:
+                tx, ty = ox, oy
+                sel = np.ones(ox.shape, dtype=bool)
+            else:
+                tx, ty = cache.sky_to_pixel(np.full(ox.shape, t, dtype=int), sra, sdec)
+                tx, ty = np.floor(tx+0.5), np.floor(ty+0.5)
+                sel = np.isfinite(tx) & np.isfinite(ty)
+            if overlap=='inner':
+                # pixels are owned by the tract that contains them
+                sel &= cache.find_tract(sra.ravel(), sdec.ravel())[0].reshape(sra.shape)==t
+            del sra, sdec
+            with np.errstate(invalid='ignore'):
+                sel &= (tx >= px0) & (tx <= px1) & (ty >= py0) & (ty <= py1)
+            if not sel.any():
+                continue
+            tx, ty = tx[sel].astype(int), ty[sel].astype(int)
+            ox, oy = ox[sel]-X0, oy[sel]-Y0
+            bbox = (int(tx.min()), int(ty.min()), int(tx.max()), int(ty.max()))
+            print('adding', tract, patch, 'pixels', bbox)
+            img, var, mask = reader(tract, patch, band, bbox, butler)
+            img, var, mask = [a[ty-bbox[1], tx-bbox[0]] for a in (img, var, mask)]
+            del sel
+            with np.errstate(divide='ignore', invalid='ignore'):
+                w = np.where((var > 0) & np.isfinite(var), 1.0/var, 0.0)
+            if overlap=='inner':
+                out_img[oy, ox] = img
+                out_wts[oy, ox] = w
+                out_mask[oy, ox] = mask
+            else:
+                np.add.at(out_img, (oy, ox), np.where(w > 0, w*img, 0.0))
+                np.add.at(out_wts, (oy, ox), w)
+                np.bitwise_or.at(out_mask, (oy, ox), mask)
+        if overlap=='ivw':
+            for r0 in range(0, shape[0], 256):
+                rows = slice(r0, r0+256)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    out_img[rows] = np.where(out_wts[rows] > 0, out_img[rows]/out_wts[rows], 0.0)
+    finally:
+        for h in hdus:
+            h.close()
+    for fn in files:
+        print('wrote', fn)
+    return files
@@ -1,8 +1,9 @@
 
 from __future__ import division, print_function
 
-__all__ = ['dataDIR', 'MyPipe']
+__all__ = ['dataDIR', 'MyPipe', 'decode_mask_planes']
 
+import os
 import numpy as np
 dataDIR='/tigress/HSC/HSC/rerun/production-20160523/'
 
@@ -22,9 +23,30 @@ class MyPipe(object):
         If None, will create a butler at initialization.
     dataDIR : string, optional
         HSC pipeline output directory
+    use_cache : bool, optional
+        If True, get the exposure and catalog through the process-wide
+        data cache (see cache.py), so they are shared between instances
+        (and must not be modified in place).
+    bbox : tuple of ints, optional
+        Pixel bounding box (xmin, ymin, xmax, ymax), inclusive and in 
+        tract pixel coordinates. If given, only this sub-image (and its 
+        mask and variance) is read. 
+    skybox : list of tuples, optional
+        Sky coordinates (ra, dec) in degrees, e.g., the output of 
+        utils.skybox. If given, bbox is set to the pixel box that 
+        encloses them, clipped to the patch. 
+
+    Attributes
+    ----------
+    bytes_read : int
+        The bytes of the exposure read by this instance: the file size
+        for the full patch, or the pixels of the image, mask, and 
+        variance planes within bbox for a cutout. It is 0 until the 
+        exposure is loaded, and on a data cache hit.
     """
 
-    def __init__(self, tract, patch, band='I', butler=None, dataDIR=dataDIR):
+    def __init__(self, tract, patch, band='I', butler=None, dataDIR=dataDIR, use_cache=False,
+                 bbox=None, skybox=None):
 
         if butler is None:
             import lsst.daf.persistence
@@ -41,6 +63,10 @@ class MyPipe(object):
         self._calib = None
         self._wcs = None
         self._maskedImg = None
+        self._meta = None
+        self._use_cache = use_cache
+        self.bytes_read = 0
+        self.bbox = self.sky_to_bbox(skybox) if skybox is not None else bbox
 
     @property
     def butler(self):
@@ -55,7 +81,7 @@ class MyPipe(object):
         The main coadd catalog for the given dataID.
         """
         if self._cat is None:
-            self._cat = self.butler.get('deepCoadd_meas', self.dataID, immediate=True)
+            self._cat = self._get('deepCoadd_meas')[0]
         return self._cat
 
     @property
@@ -64,7 +90,19 @@ class MyPipe(object):
         The main calibrated exposure object. 
         """
         if self._calexp is None:
-            self._calexp = self.butler.get('deepCoadd_calexp', self.dataID, immediate=True)
+            if self.bbox is None:
+                self._calexp, hit = self._get('deepCoadd_calexp')
+            else:
+                import lsst.afw.geom as afwGeom
+                xmin, ymin, xmax, ymax = self.bbox
+                bbox = afwGeom.Box2I(afwGeom.Point2I(xmin, ymin), afwGeom.Point2I(xmax, ymax))
+                self._calexp, hit = self._get('deepCoadd_calexp_sub', bbox=bbox, key_extra=tuple(self.bbox))
+            if not hit and self.bbox is None:
+                self.bytes_read += os.path.getsize(self._fn)
+            elif not hit:
+                # the cutout pixels of the image, mask, and variance planes
+                mi = self._calexp.getMaskedImage()
+                self.bytes_read += sum(p.getArray().nbytes for p in (mi.getImage(), mi.getMask(), mi.getVariance()))
         return self._calexp
 
     @property
@@ -92,68 +130,171 @@ class MyPipe(object):
         """
         return self.calexp.getMaskedImage()
 
+    def _get(self, dataset, key_extra=(), **kwargs):
+        """
+        Get a dataset for this dataID from the butler or the data cache,
+        and return (obj, hit), where hit is True on a data cache hit.
+        The kwargs are passed to butler.get, and key_extra is appended
+        to the cache key.
+        """
+        import instrument
+        with instrument.stage('butler.get', dataset=dataset, **self.dataID):
+            if self._use_cache:
+                from cache import get_data_cache
+                return get_data_cache().get_with_status(self.butler, dataset, self.dataID, key_extra, **kwargs)
+            return self.butler.get(dataset, self.dataID, immediate=True, **kwargs), False
+
+    def _array(self, name, make):
+        """
+        Return make(), timed as the instrumentation stage mypipe.name, 
+        with the returned array(s) counted as allocated. 
+        """
+        import instrument
+        with instrument.stage('mypipe.'+name, **self.dataID) as st:
+            out = make()
+            arrays = list(out.values()) if isinstance(out, dict) else [out]
+            st.count(arrays=len(arrays), array_bytes=sum(a.nbytes for a in arrays))
+        return out
+
+    def get_xy0(self):
+        """
+        Return the tract pixel coordinates (x0, y0) of the first pixel 
+        of the full patch, from the headers.
+        """
+        wcs = self.get_metadata()['wcs']
+        return -int(round(wcs.get('LTV1', 0))), -int(round(wcs.get('LTV2', 0)))
+
+    def sky_to_bbox(self, coords):
+        """
+        Return the pixel bounding box (xmin, ymin, xmax, ymax) in tract
+        pixel coordinates that encloses the sky coordinates, clipped to
+        the patch. Uses the header WCS, so no pixel data are read.
+
+        Parameters
+        ----------
+        coords : list of tuples
+            Sky coordinates (ra, dec) in degrees.
+        """
+        from metadata import metadata_to_wcs
+        meta = self.get_metadata()
+        ra, dec = np.asarray(coords, dtype=float).reshape(-1, 2).T
+        x, y = metadata_to_wcs(meta).all_world2pix(ra, dec, 0)
+        x0, y0 = self.get_xy0()
+        ny, nx = meta['shape']
+        xmin = max(int(np.floor(x.min()+0.5))+x0, x0)
+        xmax = min(int(np.floor(x.max()+0.5))+x0, x0+nx-1)
+        ymin = max(int(np.floor(y.min()+0.5))+y0, y0)
+        ymax = min(int(np.floor(y.max()+0.5))+y0, y0+ny-1)
+        if (xmin > xmax) or (ymin > ymax):
+            raise ValueError('sky coordinates do not overlap '+str(self.dataID))
+        return xmin, ymin, xmax, ymax
+
     def get_fn(self):
         """
         Return the fits file name for this exposure.
         """
         return self._fn
 
+    def get_metadata(self):
+        """
+        Return the header metadata (zero point, pixel scale, image 
+        shape, and WCS cards) without reading any pixel data. 
+        """
+        if self._meta is None:
+            from metadata import get_calexp_metadata
+            self._meta = get_calexp_metadata(self._fn)
+        return self._meta
+
     def get_pixscale(self):
         """
-        Return the pixel scale.
+        Return the pixel scale. If the exposure has not been 
+        loaded, it is taken from the headers.
         """
+        if self._calexp is None:
+            return self.get_metadata()['pixscale']
         return self.wcs.pixelScale().asArcseconds()
 
     def get_zptmag(self):
         """
-        Return the zero point magnitude. 
+        Return the zero point magnitude. If the exposure has not 
+        been loaded, it is taken from the headers.
         """
+        if self._calexp is None and self.get_metadata()['zptmag'] is not None:
+            return self.get_metadata()['zptmag']
         return 2.5*np.log10(self.calib.getFluxMag0()[0])
 
     def get_psf(self):
         """
         Return the PSF as a 2D numpy array.
         """
-        return self.calexp.getPsf().computeImage().getArray().copy()
+        return self._array('get_psf', lambda: self.calexp.getPsf().computeImage().getArray().copy())
 
     def get_img(self):
         """
         Return image as a 2D numpy array.
         """
-        return self.maskedImg.getImage().getArray().copy()
+        return self._array('get_img', lambda: self.maskedImg.getImage().getArray().copy())
 
     def get_mask(self):
         """
         Return complete pipeline mask as a 2D numpy array.
         """
-        return self.maskedImg.getMask().getArray().copy()
+        return self._array('get_mask', lambda: self.maskedImg.getMask().getArray().copy())
 
     def get_badmask(self):
         """
         Return a bad pixel mask as 2D numpy array.
         """
-        mask = self.maskedImg.getMask()
-        detected = mask.getPlaneBitMask('DETECTED')
-        bad = mask.getArray().copy()
-        bad[bad==detected] = 0
-        return bad
+        def make():
+            mask = self.maskedImg.getMask()
+            detected = mask.getPlaneBitMask('DETECTED')
+            bad = mask.getArray().copy()
+            bad[bad==detected] = 0
+            return bad
+        return self._array('get_badmask', make)
 
     def get_detmask(self):
         """
         Return a detected pixel mask as a 2D numpy array.
         """
-        mask = self.maskedImg.getMask()
-        detected = mask.getPlaneBitMask('DETECTED')
-        det = mask.getArray().copy()
-        det[det!=detected] = 0
-        return det
+        def make():
+            mask = self.maskedImg.getMask()
+            detected = mask.getPlaneBitMask('DETECTED')
+            det = mask.getArray().copy()
+            det[det!=detected] = 0
+            return det
+        return self._array('get_detmask', make)
+
+    def get_mask_planes(self, planes=None, packed=False):
+        """
+        Decode mask planes (see decode_mask_planes).
+
+        Parameters
+        ----------
+        planes : list of strings, optional
+            Mask plane names (e.g., 'BAD', 'SAT', 'DETECTED'). If 
+            None, decode all planes in the mask.
+        packed : bool, optional
+            If True, return bit-packed arrays (see decode_mask_planes).
+
+        Returns
+        -------
+        planes : dict
+            Boolean (or packed) arrays with plane names as keys.
+        """
+        def make():
+            mask = self.maskedImg.getMask()
+            plane_dict = mask.getMaskPlaneDict()
+            names = sorted(plane_dict, key=plane_dict.get) if planes is None else planes
+            bits = dict((p, plane_dict[p]) for p in names)
+            return decode_mask_planes(mask.getArray(), bits, packed=packed)
+        return self._array('get_mask_planes', make)
 
     def get_sigma(self):
         """
         Return sigma image as a 2D numpy array.
         """
-        var = self.maskedImg.getVariance().getArray().copy()
-        return np.sqrt(var)
+        return self._array('get_sigma', lambda: np.sqrt(self.maskedImg.getVariance().getArray()))
 
     def write_fits(self, outfile):
         """
@@ -174,6 +315,57 @@ class MyPipe(object):
         """
         self.calexp.writeFits(outfile)
 
+def decode_mask_planes(mask, bits, packed=False, chunk_bytes=2**24):
+    """
+    Decode the bit planes of a mask array, with one broadcast test of 
+    all the planes over blocks of rows.
+
+    Parameters
+    ----------
+    mask : 2D ndarray of ints
+        The mask array.
+    bits : dict
+        Bit index of each plane, with plane names as keys.
+    packed : bool, optional
+        If True, each plane is returned packed to 1 bit per pixel 
+        along the rows (np.packbits with axis=1); use 
+        np.unpackbits(p, axis=1)[:,:mask.shape[1]] to unpack. 
+    chunk_bytes : int, optional
+        Approximate memory of the temporary arrays of each block 
+        of rows.
+
+    Returns
+    -------
+    planes : dict
+        With plane names as keys. If packed is False, the values are 
+        contiguous boolean arrays with the shape of mask. 
+
+    Notes
+    -----
+    Each block of rows is decoded as (mask & values[:, None, None]) != 0,
+    with the planes along the first axis so each one is contiguous, 
+    and copied into the preallocated output planes, so the temporary 
+    memory is bounded by chunk_bytes, whatever the mask size. Since 
+    np.packbits with axis=1 packs each row separately, packing the 
+    blocks gives the same result as packing the whole plane.
+    """
+    mask = np.asarray(mask)
+    names = list(bits)
+    values = np.array([1 << bits[name] for name in names]).astype(mask.dtype)
+    ny, nx = mask.shape
+    if packed:
+        planes = [np.empty((ny, (nx+7)//8), dtype=np.uint8) for name in names]
+    else:
+        planes = [np.empty(mask.shape, dtype=bool) for name in names]
+    nrows = max(1, chunk_bytes//max(1, nx*len(names)*(mask.dtype.itemsize+1)))
+    for r0 in range(0, ny, nrows):
+        rows = slice(r0, r0+nrows)
+        block = (mask[np.newaxis, rows] & values[:, np.newaxis, np.newaxis]) != 0
+        for plane, decoded in zip(planes, block):
+            plane[rows] = np.packbits(decoded, axis=1) if packed else decoded
+        del block
+    return dict(zip(names, planes))
+
 if __name__ == '__main__':
     tract = 9347
     patch = '5,8'
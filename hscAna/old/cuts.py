@@ -19,3 +19,17 @@ phy_cuts = {'size_min':1.5, # kpc
             'SB_min':24.0, 
             'SB_max':30.0,
             'absmag_max':-13.0}
+
+# Order in which the physical cuts are applied, as (cut name, property, 
+# comparison, needs group). The threshold of each cut is 
+# phy_cuts[cut name], and cuts with a threshold of None are skipped. 
+# Objects with a NaN property fail the cut. Cuts on properties that need 
+# a group redshift (size, absmag) are only made if one is given. 
+# nan_record lists the property whose number of NaN values is recorded 
+# just before the cut is reached. 
+phy_cut_order = [('SB_min', 'SB', '>', False), 
+                 ('SB_max', 'SB', '<', False), 
+                 ('size_min', 'size', '>', True), 
+                 ('absmag_max', 'absmag', '<', True)]
+
+nan_record = {'SB_min':'mag', 'size_min':'size'}
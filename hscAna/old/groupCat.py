@@ -29,27 +29,44 @@ class MyCat:
         If True, make all cuts to the catalog during the initialization
     butler : Butler object, optional
         If None, will create a butler at initialization
+    store : string, optional
+        If not None, read the catalog, zero point, and WCS from the 
+        columnar catalog store in this directory (see catstore.py), 
+        without the butler or the calexp. 
+    use_cache : bool, optional
+        If True, read the exposure and catalog through the process-wide
+        data cache (see hscAna/cache.py), so patches shared by nearby 
+        groups are read once. They are only read here. 
 
     Note: The kwargs may be used for the optional arguments to the 
           pipeTools.py functions.
     """
-    def __init__(self, tract, patch, band='I', group_id=None, group_z=None, usewcs=False, makecuts=False, butler=None, **kwargs):
-
-        # If creating many mycat objects, you should create one bulter object for intialization.
-        if butler is None:
-            butler = pipeTools.get_butler()
-
-        # Get catalog and exposure for this tract, patch, & band.
-        self.exp = pipeTools.get_exp(tract, patch, band, butler)
-        self.wcs = self.exp.getWcs() if usewcs else None
-        self.cat = pipeTools.get_cat(tract, patch, band, butler)
+    def __init__(self, tract, patch, band='I', group_id=None, group_z=None, usewcs=False, makecuts=False, butler=None, 
+                 store=None, use_cache=True, **kwargs):
+
+        if store is not None:
+            # memory-mapped columns; no exposure is read
+            self.exp = None
+            self.cat = pipeTools.get_cat(tract, patch, band, store=store)
+            self.wcs = self.cat.get_wcs() if usewcs else None
+            calib = self.cat.get_calib()
+        else:
+            # If creating many mycat objects, you should create one bulter object for intialization.
+            if butler is None:
+                butler = pipeTools.get_butler()
+
+            # Get catalog and exposure for this tract, patch, & band.
+            self.exp = pipeTools.get_calexp(tract, patch, band, butler, use_cache=use_cache)
+            self.wcs = self.exp.getWcs() if usewcs else None
+            self.cat = pipeTools.get_cat(tract, patch, band, butler, use_cache=use_cache)
+            calib = self.exp.getCalib()
         self.count_record = [] # record of number of objects
         self.count(update_record=True)
 
         # Calculate angular size, apparent mag,and surface 
         # brightness for all objects in the catalog.
         self.angsize = pipeTools.get_angsize(self.cat, wcs=self.wcs, **kwargs)
-        self.mag = pipeTools.get_mag(self.cat, self.exp.getCalib(), **kwargs)
+        self.mag = pipeTools.get_mag(self.cat, calib, **kwargs)
         self.SB = pipeTools.get_SB(mag=self.mag, angsize=self.angsize)
         self.ra = self.cat.get('coord.ra')*180.0/np.pi
         self.dec = self.cat.get('coord.dec')*180.0/np.pi
@@ -76,9 +93,9 @@ class MyCat:
             The galaxy group identification number.
         """
         if group_z is not None:
-            from toolbox.cosmo import Cosmology
-            cosmo = Cosmology()
-            self.D_A, self.D_L, self.group_z = cosmo.D_A(group_z), cosmo.D_L(group_z), group_z
+            from hscAna.distances import get_distance_table
+            dist = get_distance_table()
+            self.D_A, self.D_L, self.group_z = dist.D_A(group_z), dist.D_L(group_z), group_z
             self.size = self.angsize*self.D_A*(1.0/206265.)*1.0e3      # size in kpc
             self.absmag = pipeTools.get_absmag(self.D_L, mag=self.mag)  # absolute magnitude
         elif group_id is not None:
@@ -123,7 +140,7 @@ class MyCat:
         else:
             return num
 
-    def apply_cuts(self, cut):
+    def apply_cuts(self, cut, update_record=True):
         """
         Apply cuts in cut = ndarray of bools to the catalog and 
         all derived properties, and update the count record.
@@ -137,54 +154,74 @@ class MyCat:
         if self.group_id or self.group_z:
             self.size = self.size[cut]
             self.absmag = self.absmag[cut]
-        self.count(update_record=True)
+        self.count(update_record=update_record)
 
-    def make_cuts(self):
+    def cut_mask(self):
         """
-        Build the cut mask and apply cuts with above method. We keep
-        two records as dictionaries:
+        Evaluate the catalog and physical cuts in cuts.py as boolean 
+        masks over the current catalog, without modifying it. The cuts 
+        are applied in order: the catalog cuts, then the physical cuts 
+        in cuts.phy_cut_order. 
 
-        cut_record : a record of how many objects get cut by each cut 
-        nan_record : a record of how many objects get cut due to a 
-            derived property (e.g., size, magnitude) begin NaN. 
+        Returns
+        -------
+        keep : ndarray of bools
+            True for objects that pass all the cuts. 
+        cut_record : dict
+            The number of objects removed by each cut (of the objects
+            that passed the previous cuts).
+        nan_record : dict
+            The number of NaN values of the derived properties in 
+            cuts.nan_record (of the objects that passed the previous cuts).
+        counts : list of ints
+            The number of objects that remain after the catalog cuts
+            and after each physical cut. 
         """
-        from cuts import cat_cuts, phy_cuts
+        import operator
+        from cuts import cat_cuts, phy_cuts, phy_cut_order
+        from cuts import nan_record as nan_props
+        compare = {'>':operator.gt, '<':operator.lt}
+        has_group = (self.group_id is not None) or (self.group_z is not None)
 
         # source and bad pixel cuts: the "catalog cuts"
-        self.cut_record = {}
-        cut  = np.ones(len(self.cat), dtype=bool)
+        cut_record, nan_record, counts = {}, {}, []
+        keep = np.ones(len(self.cat), dtype=bool)
         for col, val in cat_cuts.iteritems():
             if val is not None:
                 _c = self.cat.get(col) == val
-                self.cut_record.update({col:(~_c).sum()})
-                cut &= _c
-        self.apply_cuts(cut)
+                cut_record.update({col:(~_c).sum()})
+                keep &= _c
+        counts.append(keep.sum())
 
         # size, abs mag, and SB cuts: the "physical cuts"
-        self.nan_record = {}
-        self.nan_record.update({'mag':np.isnan(self.mag).sum()})
-        if phy_cuts['SB_min'] is not None:
-            self.SB[np.isnan(self.SB)] = -999.
-            cut = self.SB > phy_cuts['SB_min']
-            self.apply_cuts(cut)
-            self.cut_record.update({'SB_min':(~cut).sum()})
-        if phy_cuts['SB_max'] is not None:
-            cut = self.SB < phy_cuts['SB_max']
-            self.apply_cuts(cut)
-            self.cut_record.update({'SB_max':(~cut).sum()})
+        for name, prop, op, needs_group in phy_cut_order:
+            if needs_group and not has_group:
+                continue
+            if name in nan_props:
+                nan_record.update({nan_props[name]:np.isnan(getattr(self, nan_props[name])[keep]).sum()})
+            if phy_cuts[name] is None:
+                continue
+            with np.errstate(invalid='ignore'):
+                _c = compare[op](getattr(self, prop), phy_cuts[name])
+            cut_record.update({name:(keep & ~_c).sum()})
+            keep &= _c
+            counts.append(keep.sum())
+        return keep, cut_record, nan_record, counts
+
+    def make_cuts(self):
+        """
+        Build the cut mask with the cut_mask method and apply it once.
+        We keep two records as dictionaries:
+
+        cut_record : a record of how many objects get cut by each cut 
+        nan_record : a record of how many objects get cut due to a 
+            derived property (e.g., size, magnitude) begin NaN. 
+        """
         if (self.group_id is None) and (self.group_z is None):
             print '*** no group id or redshift given, so no size or abs mag cuts'
-        else:
-            self.nan_record.update({'size':np.isnan(self.size).sum()})
-            if phy_cuts['size_min'] is not None:
-                self.size[np.isnan(self.size)] = -999.
-                cut = self.size > phy_cuts['size_min']
-                self.apply_cuts(cut)
-                self.cut_record.update({'size_min':(~cut).sum()})
-            if phy_cuts['absmag_max'] is not None:
-                cut = self.absmag < phy_cuts['absmag_max']
-                self.apply_cuts(cut)
-                self.cut_record.update({'absmag_max':(~cut).sum()})
+        keep, self.cut_record, self.nan_record, counts = self.cut_mask()
+        self.count_record.extend(counts)
+        self.apply_cuts(keep, update_record=False)
 
 if __name__=='__main__':
     group_id = 1925
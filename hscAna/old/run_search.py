@@ -3,11 +3,12 @@
 import numpy as np
 from astropy.table import Table
 import hscAna
-from hscAna.search import group_search
+from hscAna.search import group_search, parallel_group_search
 group_info = Table.read('/home/jgreco/data/groups/group_info.csv')
 print len(group_info), 'galaxy groups in catalog'
 
 gemini_cuts = True
+nproc = 1 # number of worker processes
 
 ##########################################################
 # Make cuts on group catalog
@@ -25,12 +26,15 @@ if gemini_cuts:
 ##########################################################
 # Perform UDG search within all remaining groups
 ##########################################################
-butler = hscana.get_butler()
-for ID in group_info['group_id']:
-    print '***** searching in group '+str(ID)+' *****'
-    idx = np.argwhere(group_info['group_id']==ID)[0,0]
-    ra, dec, z, Ngal = group_info['ra', 'dec', 'z', 'Ngal'][idx]
-    print 'ra dec =', ra, dec
-    print 'z =', z
-    print 'Ngal=', Ngal 
-    group_search(group_id=ID, butler=butler)
+if nproc > 1:
+    parallel_group_search(group_info['group_id'], nproc=nproc, summary_file='output/search_summary.csv')
+else:
+    butler = hscana.get_butler()
+    for ID in group_info['group_id']:
+        print '***** searching in group '+str(ID)+' *****'
+        idx = np.argwhere(group_info['group_id']==ID)[0,0]
+        ra, dec, z, Ngal = group_info['ra', 'dec', 'z', 'Ngal'][idx]
+        print 'ra dec =', ra, dec
+        print 'z =', z
+        print 'Ngal=', Ngal 
+        group_search(group_id=ID, butler=butler)
@@ -2,12 +2,12 @@ import sys
 import hscana
 import numpy as np 
 import argparse
-from toolbox.astro import angsep
 from astropy.table import Table
-from hscana.utils import get_hsc_regions, skybox
+from hscana.utils import get_hsc_regions, skybox, unique_coords_mask
 group_info = Table.read('/home/jgreco/data/groups/group_info.csv')
 
-def group_search(group_id, coords_3d=None, band='I', box_width=3.0, max_sep=2.0, butler=None):
+def group_search(group_id, coords_3d=None, band='I', box_width=3.0, max_sep=2.0, butler=None, store=None,
+                 failed=None, use_cache=True):
     """
     Search for UDG candidates near a galaxy group.
 
@@ -31,14 +31,24 @@ def group_search(group_id, coords_3d=None, band='I', box_width=3.0, max_sep=2.0,
         If None, will be created within function. If you are
         looping over many groups, you should create a butler
         once outside this function. 
+    store : string, optional
+        If not None, read the catalogs from the columnar catalog 
+        store in this directory (see catstore.py), without a butler.
+    failed : list, optional
+        If not None, the (tract, patch) pairs that could not be 
+        searched are appended to this list. 
+    use_cache : bool, optional
+        If True, read the exposures and catalogs through the data cache
+        (see hscAna/cache.py), so patches shared with other groups 
+        searched in the same process are read once. 
     """
-    if butler is None:
+    if butler is None and store is None:
         butler = hscana.get_butler()
     if coords_3d is not None:
-        from toolbox.cosmo import Cosmology
-        cosmo = Cosmology()
+        from hscAna.distances import get_distance_table
+        dist = get_distance_table()
         ra_c, dec_c, group_z = coords_3d
-        D_A, D_L = cosmo.D_A(group_z), cosmo.D_L(group_z)
+        D_A, D_L = dist.D_A(group_z), dist.D_L(group_z)
     else:
         idx = np.argwhere(group_info['group_id']==group_id)[0,0]
         ra_c, dec_c, group_z, D_A, D_L = group_info['ra', 'dec', 'z', 'D_A', 'D_L'][idx]
@@ -53,9 +63,12 @@ def group_search(group_id, coords_3d=None, band='I', box_width=3.0, max_sep=2.0,
         # some tracts and patches are missing
         print tract, patch
         try:
-            mycat = hscana.MyCat(tract, patch, band, group_id=group_id, group_z=group_z, makecuts=True, butler=butler)
-        except:
+            mycat = hscana.MyCat(tract, patch, band, group_id=group_id, group_z=group_z, makecuts=True, butler=butler, 
+                                 store=store, use_cache=use_cache)
+        except Exception:
             print '!!!!! FAILED !!!!!'
+            if failed is not None:
+                failed.append((tract, patch))
             continue
         if mycat.count()>0:
             candy.append(mycat)
@@ -68,13 +81,9 @@ def group_search(group_id, coords_3d=None, band='I', box_width=3.0, max_sep=2.0,
     coords = np.array(coords)
             
     # build mask for double entries
-    mask = np.ones(coords.shape[0], dtype=bool)
-    for i, (ra, dec) in enumerate(coords):
-        if mask[i]==True:
-            unique = angsep(ra, dec, coords[:,0], coords[:,1]) > max_sep
-            unique[i] = True
-            mask &= unique
-    coords = coords[mask]
+    if coords.shape[0]>0:
+        mask = unique_coords_mask(coords[:,0], coords[:,1], max_sep=max_sep)
+        coords = coords[mask]
     print 'number of candidates =', coords.shape[0]
 
     # output in format for hscMap
@@ -83,6 +92,92 @@ def group_search(group_id, coords_3d=None, band='I', box_width=3.0, max_sep=2.0,
                    coords, delimiter=',', header='ra,dec', fmt='%.8f')
     else:
         print 'group', group_id, 'has zero candidates'
+    return coords
+
+_worker_butler = None
+
+def _init_worker(make_butler=True):
+    """
+    Create one butler per worker process, which is reused for 
+    every group that the worker searches. 
+    """
+    global _worker_butler
+    if make_butler:
+        _worker_butler = hscana.get_butler()
+
+def _search_worker(args):
+    """
+    Run group_search for a single group in a worker process and 
+    report the outcome rather than raising. Groups with patches 
+    that could not be searched are reported as 'partial'. 
+    """
+    import time, traceback
+    group_id, kwargs = args
+    t0 = time.time()
+    failed = []
+    try:
+        coords = group_search(group_id, butler=_worker_butler, failed=failed, **kwargs)
+    except Exception:
+        return (group_id, 'failed', 0, time.time()-t0, _patch_list(failed), traceback.format_exc())
+    status = 'partial' if failed else 'ok'
+    return (group_id, status, len(coords), time.time()-t0, _patch_list(failed), '')
+
+def _patch_list(pairs):
+    """
+    Format (tract, patch) pairs as 'tract:patch tract:patch ...'.
+    """
+    return ' '.join(str(tract)+':'+str(patch) for tract, patch in pairs)
+
+def parallel_group_search(group_ids, nproc=None, summary_file=None, **kwargs):
+    """
+    Run group_search over many groups with a pool of worker processes.
+    Each worker creates its own butler once and reuses it.
+
+    Parameters
+    ----------
+    group_ids : list of ints
+        Galaxy group identification numbers.
+    nproc : int, optional
+        Number of worker processes. If None, use all cpus.
+    summary_file : string, optional
+        If not None, write the summary table to this csv file.
+    **kwargs : 
+        Optional arguments for group_search.
+
+    Returns
+    -------
+    summary : astropy Table or None
+        One row per group with columns group_id, status ('ok', 
+        'partial' if some patches failed, or 'failed'), num_candies, 
+        time (in seconds), failed_patches (tract:patch pairs that 
+        could not be searched), and error (the traceback for failed 
+        groups). None if group_ids is empty.
+    """
+    from multiprocessing import Pool
+    pool = Pool(processes=nproc, initializer=_init_worker, initargs=(kwargs.get('store') is None,))
+    try:
+        tasks = [(ID, kwargs) for ID in group_ids]
+        results = []
+        for res in pool.imap_unordered(_search_worker, tasks):
+            print '***** group', res[0], res[1], '('+str(res[2])+' candidates, '+str(round(res[3], 1))+' s) *****'
+            results.append(res)
+    finally:
+        pool.close()
+        pool.join()
+    if len(results)==0:
+        print 'no groups to search'
+        return None
+    summary = Table(rows=results, names=['group_id', 'status', 'num_candies', 'time', 'failed_patches', 'error'])
+    summary.sort('group_id')
+    nfail = (summary['status']=='failed').sum()
+    npartial = (summary['status']=='partial').sum()
+    nbad = sum(len(p.split()) for p in summary['failed_patches'])
+    print 'searched', len(summary), 'groups:', len(summary)-nfail-npartial, 'ok,', npartial, 'partial,', nfail, 'failed'
+    print nbad, 'patches could not be searched'
+    print 'total candidates =', summary['num_candies'].sum()
+    if summary_file is not None:
+        summary.write(summary_file, format='ascii.csv')
+    return summary
 
 if __name__=='__main__':
     # for usage, enter python search.py
@@ -90,26 +185,28 @@ if __name__=='__main__':
     parser.add_argument('-g', '--group_id', type=int, default=None, help='run search for single group with id=group_id')
     parser.add_argument('-n', '--Ngal', type=int, default=None, help='run search on all groups with <= Ngal galaxies')
     parser.add_argument('-z', '--z', type=float, default=None, help='run search on all groups with redshift < z')
+    parser.add_argument('-p', '--nproc', type=int, default=1, help='number of worker processes')
+    parser.add_argument('-s', '--summary', default=None, help='csv file for the search summary')
+    parser.add_argument('--store', default=None, help='read catalogs from this columnar catalog store')
     args = parser.parse_args()
     if args.group_id is not None:
         print 'running search for group', args.group_id
-        run(group_id=args.group_id)
-    elif args.Ngal is not None:
-        butler = hscana.get_butler()
-        cut = group_info['Ngal']<=args.Ngal
-        print 'running search for all groups with Ngal <=', args.Ngal
+        group_search(group_id=args.group_id, store=args.store)
+    elif (args.Ngal is not None) or (args.z is not None):
+        cut = np.ones(len(group_info), dtype=bool)
+        if args.Ngal is not None:
+            cut &= group_info['Ngal']<=args.Ngal
+            print 'running search for all groups with Ngal <=', args.Ngal
         if args.z is not None:
             cut &= group_info['z']<args.z
-            print 'and z <', args.z
-        for ID in group_info[cut]['group_id']:
-            print '***** searching in group '+str(ID)+' *****'
-            run(group_id=ID, butler=butler)
-    elif args.z is not None:
-        butler = hscana.get_butler()
-        cut = group_info['z']<args.z
-        print 'running search for all groups with z <', args.z
-        for ID in group_info[cut]['group_id']:
-            print '***** searching in group '+str(ID)+' *****'
-            run(group_id=ID, butler=butler)
+            print 'running search for all groups with z <', args.z
+        if args.nproc > 1:
+            parallel_group_search(group_info[cut]['group_id'], nproc=args.nproc, summary_file=args.summary,
+                                  store=args.store)
+        else:
+            butler = hscana.get_butler() if args.store is None else None
+            for ID in group_info[cut]['group_id']:
+                print '***** searching in group '+str(ID)+' *****'
+                group_search(group_id=ID, butler=butler, store=args.store)
     else:
         parser.print_help()
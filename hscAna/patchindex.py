@@ -0,0 +1,201 @@
+"""
+A persistent reverse index from patches to the galaxy groups whose
+boxes overlap them, so that patch-at-a-time processing can look up its
+groups (and their redshifts) without scanning the group catalog. The
+index is stored in SQLite, is loaded into a dict keyed by (tract, patch)
+when opened, and is updated incrementally when the group catalog
+changes: only new or changed groups are matched to patches again.
+"""
+
+from __future__ import division, print_function
+
+__all__ = ['default_patch_index_file', 'PatchIndex']
+
+import os
+import sqlite3
+import threading
+import numpy as np
+
+default_patch_index_file = os.path.join(os.path.expanduser('~'), '.hscAna', 'patch_index.db')
+
+class PatchIndex(object):
+    """
+    SQLite-backed patch -> groups index. Safe to use from several
+    threads of the same process.
+
+    Parameters
+    ----------
+    fn : string, optional
+        The index database file. It is created if it does not exist.
+
+    Notes
+    -----
+    Group ids are stored as strings, as in the Manifest. Patches are
+    matched to the group boxes (skybox_array with the width from
+    D_A or z) with utils.get_hsc_regions_array, so a group is listed
+    in every patch whose outer box overlaps its box.
+
+    Examples
+    --------
+    >>> index = PatchIndex()
+    >>> index.update(group_info, box_width=3.0)
+    >>> index.groups(9347, '4,5')
+    {'1234': 0.061, '2045': 0.043}
+    """
+
+    def __init__(self, fn=default_patch_index_file):
+        self.fn = fn
+        outdir = os.path.dirname(os.path.abspath(fn))
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(fn, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS groups ('
+                             'grp TEXT PRIMARY KEY, ra REAL, dec REAL, z REAL, theta REAL)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS group_patches ('
+                             'grp TEXT, tract INTEGER, patch TEXT, PRIMARY KEY (grp, tract, patch))')
+            rows = self._db.execute('SELECT grp, ra, dec, z, theta FROM groups').fetchall()
+            pairs = self._db.execute('SELECT grp, tract, patch FROM group_patches').fetchall()
+        self._groups = dict((r[0], tuple(r[1:])) for r in rows)
+        self._patches = {}
+        self._group_patches = {}
+        for group, tract, patch in pairs:
+            self._add_pair(group, tract, patch)
+
+    def close(self):
+        self._db.close()
+
+    def __len__(self):
+        return len(self._groups)
+
+    def __contains__(self, group):
+        return str(group) in self._groups
+
+    def _add_pair(self, group, tract, patch):
+        self._patches.setdefault((tract, patch), set()).add(group)
+        self._group_patches.setdefault(group, []).append((tract, patch))
+
+    def _remove(self, groups):
+        """
+        Remove groups from the dicts and the database (the caller
+        holds the lock and the transaction).
+        """
+        for group in groups:
+            for key in self._group_patches.pop(group, []):
+                members = self._patches[key]
+                members.discard(group)
+                if not members:
+                    del self._patches[key]
+            self._groups.pop(group, None)
+        self._db.executemany('DELETE FROM groups WHERE grp=?', [(g,) for g in groups])
+        self._db.executemany('DELETE FROM group_patches WHERE grp=?', [(g,) for g in groups])
+
+    def groups(self, tract, patch):
+        """
+        Return the groups that overlap a patch, as a dict with the
+        group ids as keys and redshifts as values.
+        """
+        patch = patch.decode() if isinstance(patch, bytes) else patch
+        members = self._patches.get((int(tract), patch), ())
+        return dict((g, self._groups[g][2]) for g in members)
+
+    def patches(self, group):
+        """
+        Return the (tract, patch) pairs that a group overlaps.
+        """
+        return list(self._group_patches.get(str(group), []))
+
+    def all_patches(self):
+        """
+        Return all the (tract, patch) pairs with at least one group.
+        """
+        return sorted(self._patches)
+
+    def remove_groups(self, groups):
+        """
+        Remove groups from the index.
+        """
+        groups = [str(g) for g in groups]
+        with self._lock, self._db:
+            self._remove(groups)
+
+    def update(self, group_info, box_width=3.0, remove_missing=True, butler=None):
+        """
+        Bring the index up to date with a group catalog. Groups that
+        are new, or whose position, redshift, or box width changed,
+        are matched to patches again (all in one call); unchanged
+        groups are kept.
+
+        Parameters
+        ----------
+        group_info : astropy Table
+            Group catalog with columns group_id, ra, dec, z, and
+            optionally D_A (Mpc).
+        box_width : float, optional
+            The width of the box around each group in Mpc.
+        remove_missing : bool, optional
+            If True, groups that are not in group_info are removed.
+        butler : Butler object, optional
+            Only used if the skymap cache must be built.
+
+        Returns
+        -------
+        stats : dict
+            Number of groups added, changed, removed, and unchanged.
+        """
+        from planner import _group_thetas
+        from utils import skybox_array, get_hsc_regions_array
+
+        ids = np.array([str(g) for g in group_info['group_id']], dtype=object)
+        ra = np.asarray(group_info['ra'], dtype=float)
+        dec = np.asarray(group_info['dec'], dtype=float)
+        z = np.asarray(group_info['z'], dtype=float)
+        theta = _group_thetas(group_info, box_width)
+
+        stored = [self._groups.get(g) for g in ids]
+        new = np.array([s is None for s in stored], dtype=bool)
+        old = np.array([s if s is not None else (np.nan,)*4 for s in stored], dtype=float).reshape(-1, 4)
+        same = np.isclose(old, np.column_stack((ra, dec, z, theta)), rtol=1e-10, atol=0).all(axis=1)
+        redo = np.flatnonzero(~same)
+        missing = set(self._groups) - set(ids) if remove_missing else set()
+
+        rows = []
+        if len(redo) > 0:
+            boxes = skybox_array(ra[redo], dec[redo], theta[redo])
+            regions = get_hsc_regions_array(boxes, butler=butler)
+            patches = [p.decode() for p in regions['patch']]
+            rows = list(zip(ids[redo][regions['region']], regions['tract'].tolist(), patches))
+
+        with self._lock, self._db:
+            self._remove(list(ids[redo]) + list(missing))
+            group_rows = [(ids[i], float(ra[i]), float(dec[i]), float(z[i]), float(theta[i])) for i in redo]
+            self._db.executemany('INSERT INTO groups VALUES (?,?,?,?,?)', group_rows)
+            self._db.executemany('INSERT INTO group_patches VALUES (?,?,?)', rows)
+            for row in group_rows:
+                self._groups[row[0]] = tuple(row[1:])
+            for group, tract, patch in rows:
+                self._add_pair(group, tract, patch)
+
+        stats = {'added':int(new.sum()), 'changed':int((~same & ~new).sum()),
+                 'removed':len(missing), 'unchanged':int(same.sum())}
+        print('patch index:', stats['added'], 'added,', stats['changed'], 'changed,',
+              stats['removed'], 'removed,', stats['unchanged'], 'unchanged')
+        return stats
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Update the patch -> groups index, or look up a patch')
+    parser.add_argument('-g', '--group_info', help='group catalog to index', default=None)
+    parser.add_argument('-w', '--box_width', type=float, help='box width in Mpc', default=3.0)
+    parser.add_argument('-f', '--fn', help='index file', default=default_patch_index_file)
+    parser.add_argument('-p', '--patch', nargs=2, metavar=('TRACT', 'PATCH'), help='patch to look up', default=None)
+    args = parser.parse_args()
+    index = PatchIndex(args.fn)
+    if args.group_info is not None:
+        from astropy.table import Table
+        index.update(Table.read(args.group_info), box_width=args.box_width)
+    if args.patch is not None:
+        for group, z in sorted(index.groups(int(args.patch[0]), args.patch[1]).items()):
+            print(group, z)
+    index.close()
@@ -0,0 +1,99 @@
+"""
+Patch-major planning of deepCoadd extractions for galaxy groups.
+Nearby groups share many patches, so the union of the patches that
+all groups need is built first, each patch is extracted once, and a
+group -> patch index (or symlink layout) points the groups to them.
+"""
+
+from __future__ import division, print_function
+
+__all__ = ['plan_group_patches', 'make_group_links']
+
+import os
+import numpy as np
+
+def _group_thetas(group_info, box_width):
+    """
+    Angular box widths (degrees) of the groups, from the D_A column 
+    if there is one, otherwise from z.
+    """
+    if 'D_A' in group_info.colnames:
+        return (box_width/np.asarray(group_info['D_A'], dtype=float))*180.0/np.pi
+    from distances import skybox_angle
+    return skybox_angle(np.asarray(group_info['z'], dtype=float), box_width)
+
+def plan_group_patches(group_info, box_width=3.0, butler=None):
+    """
+    Build the union of the tracts and patches needed by all groups.
+    The patches of all group boxes are found in one call, with the
+    exact overlap test of utils.get_hsc_regions_array.
+
+    Parameters
+    ----------
+    group_info : astropy Table
+        Group catalog with columns group_id, ra, dec, and D_A (Mpc)
+        or z. If there is no D_A column, the distances of all groups
+        are computed from z at once (see distances.py).
+    box_width : float, optional
+        The width of the data region around each group in Mpc.
+    butler : Butler object, optional
+        Only used if the skymap cache must be built.
+
+    Returns
+    -------
+    patches : structured ndarray
+        The unique tracts and patches, with columns 'tract' and 'patch'.
+    index : astropy Table
+        The group -> patch index, with columns group_id, tract, and patch.
+    stats : dict
+        Number of groups, group-patch pairs, unique patches, and the
+        number of duplicate extractions removed.
+    """
+    from astropy.table import Table
+    from utils import skybox_array, get_hsc_regions_array
+
+    thetas = _group_thetas(group_info, box_width)
+    boxes = skybox_array(np.asarray(group_info['ra']), np.asarray(group_info['dec']), thetas)
+    regions = get_hsc_regions_array(boxes, butler=butler)
+    index = Table([np.asarray(group_info['group_id'])[regions['region']], regions['tract'], regions['patch']],
+                  names=['group_id', 'tract', 'patch'])
+    pairs = np.zeros(len(index), dtype=[('tract', int), ('patch', 'S4')])
+    pairs['tract'], pairs['patch'] = index['tract'], index['patch']
+    patches = np.unique(pairs)
+
+    stats = {'groups':len(group_info), 'group_patches':len(index), 'patches':len(patches),
+             'duplicates_removed':len(index)-len(patches)}
+    print(stats['groups'], 'groups need', stats['group_patches'], 'group-patch extractions')
+    print(stats['patches'], 'unique patches;', stats['duplicates_removed'], 'duplicate extractions removed')
+    return patches, index, stats
+
+def make_group_links(index, patch_dir, group_dir, band='I'):
+    """
+    Make a per-group directory tree of relative symlinks to patches
+    that were extracted once in patch-major layout:
+
+        patch_dir/HSC-band/tract/patch
+        group_dir/HSC-band/group_id/tract/patch -> patch_dir/...
+
+    Parameters
+    ----------
+    index : astropy Table
+        The group -> patch index from plan_group_patches.
+    patch_dir : string
+        Root directory of the patch-major layout.
+    group_dir : string
+        Root directory of the group symlink layout.
+    band : string, optional
+        The photometric band (GRIZY).
+    """
+    band = 'HSC-'+band.upper()
+    for group_id, tract, patch in index['group_id', 'tract', 'patch']:
+        patch = patch.decode() if isinstance(patch, bytes) else patch
+        patch = patch[0]+'-'+patch[-1]
+        link_dir = os.path.join(group_dir, band, 'group_'+str(group_id), str(tract))
+        if not os.path.isdir(link_dir):
+            os.makedirs(link_dir)
+        link = os.path.join(link_dir, patch)
+        target = os.path.join(patch_dir, band, str(tract), patch)
+        if not os.path.lexists(link):
+            os.symlink(os.path.relpath(target, link_dir), link)
@@ -0,0 +1,603 @@
+"""
+A NumPy-backed cache of the deepCoadd skymap geometry. The tract
+centers, tract WCSs (TAN), tract bounding boxes and patch layouts
+are extracted from the Butler's skymap once, saved to disk, and
+loaded once per process. Lookups do not need the LSST stack.
+"""
+
+from __future__ import division, print_function
+
+__all__ = ['default_skymap_dir', 'skymap_cache_file', 'SkymapCache', 'butler_root', 
+           'get_skymap_cache', 'make_synthetic_skymap']
+
+import os
+import numpy as np
+
+default_skymap_dir = os.path.join(os.path.expanduser('~'), '.hscAna')
+
+_skymap_caches = {}
+
+def _unit_vectors(ra, dec):
+    """
+    Return 3D unit vectors for ra and dec in degrees.
+    """
+    ra, dec = np.deg2rad(ra), np.deg2rad(dec)
+    return np.stack((np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)), axis=-1)
+
+def _edge_normals(verts, ctr=None):
+    """
+    Return the normals of the great circles through consecutive
+    vertices of spherical polygons (shape = (..., K, 3)), pointing
+    to the inside of the polygons (the side of ctr, or of the vertex
+    mean if ctr is None).
+    """
+    normals = np.cross(verts, np.roll(verts, -1, axis=-2))
+    if ctr is None:
+        ctr = verts.mean(axis=-2)
+    sign = np.sign(np.einsum('...ei,...i->...e', normals, ctr))
+    return normals*sign[...,np.newaxis]
+
+class SkymapCache(object):
+    """
+    Geometry of a skymap stored as arrays with one row per tract.
+
+    Parameters
+    ----------
+    tract : ndarray of ints
+        Tract ids.
+    ctr : ndarray, shape = (N tracts, 2)
+        Tract centers (ra, dec) in degrees.
+    crval : ndarray, shape = (N tracts, 2)
+        Tangent points (ra, dec) of the tract TAN WCSs in degrees.
+    crpix : ndarray, shape = (N tracts, 2)
+        Reference pixels of the tract WCSs (LSST 0-indexed convention).
+    cd : ndarray, shape = (N tracts, 2, 2)
+        CD matrices of the tract WCSs in degrees/pixel.
+    bbox : ndarray of ints, shape = (N tracts, 4)
+        Tract bounding boxes (xmin, ymin, xmax, ymax), inclusive.
+    patch_inner : ndarray of ints, shape = (N tracts, 2)
+        Inner dimensions of the patches in pixels.
+    patch_border : ndarray of ints
+        Patch border in pixels.
+    num_patches : ndarray of ints, shape = (N tracts, 2)
+        The number of patches along x and y.
+    source : string, optional
+        Identifier of the skymap (the data directory it was read from).
+    """
+
+    _columns = ['tract', 'ctr', 'crval', 'crpix', 'cd', 'bbox',
+                'patch_inner', 'patch_border', 'num_patches']
+
+    def __init__(self, tract, ctr, crval, crpix, cd, bbox, patch_inner, patch_border, num_patches, source=''):
+        self.source = str(source)
+        self.tract = np.asarray(tract, dtype=int)
+        self.ctr = np.asarray(ctr, dtype=float)
+        self.crval = np.asarray(crval, dtype=float)
+        self.crpix = np.asarray(crpix, dtype=float)
+        self.cd = np.asarray(cd, dtype=float)
+        self.bbox = np.asarray(bbox, dtype=int)
+        self.patch_inner = np.asarray(patch_inner, dtype=int)
+        self.patch_border = np.asarray(patch_border, dtype=int)
+        self.num_patches = np.asarray(num_patches, dtype=int)
+        self._cdinv = np.linalg.inv(self.cd)
+        self._ctr_xyz = _unit_vectors(self.ctr[:,0], self.ctr[:,1])
+        self._index = dict((t, i) for i, t in enumerate(self.tract))
+        self._tree = None
+        self._radius = None
+        self._footprints = {}
+
+    def __len__(self):
+        return len(self.tract)
+
+    @classmethod
+    def from_skymap(cls, skymap, source=''):
+        """
+        Build the cache from an LSST skymap object.
+        """
+        cols = dict((c, []) for c in cls._columns)
+        for tractInfo in skymap:
+            wcs = tractInfo.getWcs()
+            ctr = tractInfo.getCtrCoord()
+            origin = wcs.getSkyOrigin()
+            bbox = tractInfo.getBBox()
+            cols['tract'].append(tractInfo.getId())
+            cols['ctr'].append((ctr.getLongitude().asDegrees(), ctr.getLatitude().asDegrees()))
+            cols['crval'].append((origin.getLongitude().asDegrees(), origin.getLatitude().asDegrees()))
+            cols['crpix'].append(tuple(wcs.getPixelOrigin()))
+            cols['cd'].append(np.asarray(wcs.getCDMatrix()))
+            cols['bbox'].append((bbox.getMinX(), bbox.getMinY(), bbox.getMaxX(), bbox.getMaxY()))
+            cols['patch_inner'].append(tuple(tractInfo.getPatchInnerDimensions()))
+            cols['patch_border'].append(tractInfo.getPatchBorder())
+            cols['num_patches'].append(tuple(tractInfo.getNumPatches()))
+        return cls(source=source, **cols)
+
+    @classmethod
+    def load(cls, fn):
+        """
+        Load the cache from a .npz file written by save.
+        """
+        with np.load(fn) as data:
+            source = str(data['source']) if 'source' in data.files else ''
+            return cls(source=source, **dict((c, data[c]) for c in cls._columns))
+
+    def save(self, fn):
+        """
+        Save the cache to a .npz file.
+        """
+        outdir = os.path.dirname(os.path.abspath(fn))
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        np.savez(fn, source=self.source, **dict((c, getattr(self, c)) for c in self._columns))
+
+    def tract_index(self, tract):
+        """
+        Return the row index of the given tract id.
+        """
+        return self._index[tract]
+
+    def find_nearest_tract(self, ra, dec):
+        """
+        Find the tract with the center nearest to each coordinate.
+
+        The nearest tract does not always contain the coordinate: in
+        the overlap between tract rings, the nearest center can be in 
+        the other ring. Use find_tract to find the tract that contains
+        a coordinate.
+
+        Parameters
+        ----------
+        ra, dec : float or ndarray
+            Coordinates in degrees.
+
+        Returns
+        -------
+        idx : int or ndarray of ints
+            Row index (not tract id) of the nearest tract.
+        """
+        xyz = _unit_vectors(np.asarray(ra, dtype=float), np.asarray(dec, dtype=float))
+        if xyz.ndim==1:
+            return np.argmax(np.dot(self._ctr_xyz, xyz))
+        return self._query(xyz.reshape(-1, 3), 1)[:,0].reshape(xyz.shape[:-1])
+
+    def _query(self, xyz, k):
+        """
+        Row indices of the k nearest tract centers of unit vectors xyz 
+        (shape = (N, 3)), nearest first, with shape (N, k).
+        """
+        if self._tree is None:
+            from scipy.spatial import cKDTree
+            self._tree = cKDTree(self._ctr_xyz)
+        k = min(k, len(self))
+        idx = self._tree.query(xyz, k=k)[1]
+        return idx.reshape(len(xyz), k)
+
+    def find_tract(self, ra, dec, k=8):
+        """
+        Find the tract that contains each coordinate: of the k tracts
+        with the nearest centers, the first (nearest) one whose 
+        bounding box contains the coordinate, which is the tract that
+        skymap.findTract(coord) returns.
+
+        Parameters
+        ----------
+        ra, dec : float or ndarray
+            Coordinates in degrees.
+        k : int, optional
+            The number of nearest tracts to test. 
+
+        Returns
+        -------
+        idx : ndarray of ints
+            Row index (not tract id) of the tract, or -1 for 
+            coordinates that are in none of the tracts.
+        x, y : ndarray
+            Pixel positions in that tract (NaN if idx is -1).
+        """
+        ra = np.atleast_1d(np.asarray(ra, dtype=float))
+        dec = np.atleast_1d(np.asarray(dec, dtype=float))
+        xyz = _unit_vectors(ra, dec)
+        idx = np.full(len(ra), -1, dtype=int)
+        x, y = np.full(len(ra), np.nan), np.full(len(ra), np.nan)
+        todo = np.arange(len(ra))
+        # most coordinates are in the nearest tract, so the k nearest 
+        # are only queried for the others
+        candidates = self._query(xyz, 1)
+        for j in range(min(k, len(self))):
+            if j==1:
+                candidates = self._query(xyz[todo], k)
+            c = candidates[:,j]
+            cx, cy = self.sky_to_pixel(c, ra[todo], dec[todo])
+            inside = self.patch_index(c, cx, cy)[0] >= 0
+            found = todo[inside]
+            idx[found], x[found], y[found] = c[inside], cx[inside], cy[inside]
+            todo, candidates = todo[~inside], candidates[~inside]
+            if len(todo)==0:
+                break
+        return idx, x, y
+
+    def sky_to_pixel(self, idx, ra, dec):
+        """
+        Gnomonic projection of ra and dec (degrees) into the pixel frame
+        of the tract(s) with row index idx. Points more than 90 degrees
+        from the tangent point are returned as NaN.
+        """
+        idx = np.asarray(idx)
+        ra, dec = np.deg2rad(ra), np.deg2rad(dec)
+        ra0, dec0 = np.deg2rad(self.crval[idx,0]), np.deg2rad(self.crval[idx,1])
+        cosc = np.sin(dec0)*np.sin(dec) + np.cos(dec0)*np.cos(dec)*np.cos(ra-ra0)
+        cosc = np.where(cosc > 0, cosc, np.nan)
+        xi = np.rad2deg(np.cos(dec)*np.sin(ra-ra0)/cosc)
+        eta = np.rad2deg((np.cos(dec0)*np.sin(dec) - np.sin(dec0)*np.cos(dec)*np.cos(ra-ra0))/cosc)
+        cdinv = self._cdinv[idx]
+        x = self.crpix[idx,0] + cdinv[...,0,0]*xi + cdinv[...,0,1]*eta
+        y = self.crpix[idx,1] + cdinv[...,1,0]*xi + cdinv[...,1,1]*eta
+        return x, y
+
+    def pixel_to_sky(self, idx, x, y):
+        """
+        Inverse of sky_to_pixel. Returns ra and dec in degrees.
+        """
+        idx = np.asarray(idx)
+        cd = self.cd[idx]
+        dx, dy = np.asarray(x)-self.crpix[idx,0], np.asarray(y)-self.crpix[idx,1]
+        xi = np.deg2rad(cd[...,0,0]*dx + cd[...,0,1]*dy)
+        eta = np.deg2rad(cd[...,1,0]*dx + cd[...,1,1]*dy)
+        ra0, dec0 = np.deg2rad(self.crval[idx,0]), np.deg2rad(self.crval[idx,1])
+        denom = np.cos(dec0) - eta*np.sin(dec0)
+        ra = ra0 + np.arctan2(xi, denom)
+        dec = np.arctan2(np.sin(dec0) + eta*np.cos(dec0), np.hypot(xi, denom))
+        return np.rad2deg(ra)%360.0, np.rad2deg(dec)
+
+    def patch_index(self, idx, x, y):
+        """
+        Return the patch indices (ix, iy) of the pixel positions x, y in
+        the tract(s) with row index idx. Positions outside the tract
+        bounding box get indices of -1.
+        """
+        idx = np.asarray(idx)
+        px, py = np.floor(np.asarray(x)+0.5), np.floor(np.asarray(y)+0.5)
+        bbox = self.bbox[idx]
+        inside = (px >= bbox[...,0]) & (px <= bbox[...,2]) & (py >= bbox[...,1]) & (py <= bbox[...,3])
+        with np.errstate(invalid='ignore'):
+            ix = np.where(inside, (px-bbox[...,0])//self.patch_inner[idx,0], -1).astype(int)
+            iy = np.where(inside, (py-bbox[...,1])//self.patch_inner[idx,1], -1).astype(int)
+        return ix, iy
+
+    def find_tract_patch(self, ra, dec):
+        """
+        Find the tract and patch of the given coordinate, like
+        skymap.findTract(coord).findPatch(coord) (see find_tract).
+
+        Returns
+        -------
+        tract : int
+            Tract id.
+        patch : tuple of ints
+            Patch index (ix, iy).
+        """
+        tract, ix, iy = self.find_tract_patch_array(ra, dec)
+        if ix[0] < 0:
+            raise LookupError('coordinate ({}, {}) is not in any tract'.format(ra, dec))
+        return int(tract[0]), (int(ix[0]), int(iy[0]))
+
+    def find_tract_patch_array(self, ra, dec):
+        """
+        Vectorized find_tract_patch for arrays of coordinates.
+
+        Returns
+        -------
+        tract : ndarray of ints
+            Tract ids.
+        ix, iy : ndarray of ints
+            Patch indices. Coordinates that are not in any tract get 
+            a tract id and indices of -1.
+        """
+        idx, x, y = self.find_tract(ra, dec)
+        ix, iy = self.patch_index(idx, x, y)
+        tract = np.where(idx >= 0, self.tract[idx], -1)
+        return tract, np.where(idx >= 0, ix, -1), np.where(idx >= 0, iy, -1)
+
+    def find_patch_list(self, idx, ra, dec):
+        """
+        Find the patches of tract row idx whose outer bounding boxes
+        overlap the pixel box enclosing the given coordinates, like
+        tractInfo.findPatchList(coordList).
+
+        Returns
+        -------
+        patches : list of tuples
+            Patch indices (ix, iy).
+        """
+        x, y = self.sky_to_pixel(np.full(np.shape(ra), idx, dtype=int), ra, dec)
+        good = np.isfinite(x) & np.isfinite(y)
+        if not good.any():
+            return []
+        border = self.patch_border[idx]
+        xmin, ymin, xmax, ymax = self.bbox[idx]
+        lo_x = max(int(np.floor(x[good].min()+0.5))-border, xmin)
+        hi_x = min(int(np.floor(x[good].max()+0.5))+border, xmax)
+        lo_y = max(int(np.floor(y[good].min()+0.5))-border, ymin)
+        hi_y = min(int(np.floor(y[good].max()+0.5))+border, ymax)
+        if (lo_x > hi_x) or (lo_y > hi_y):
+            return []
+        nx, ny = self.patch_inner[idx]
+        return [(int(i), int(j)) for i in range((lo_x-xmin)//nx, (hi_x-xmin)//nx+1)
+                                 for j in range((lo_y-ymin)//ny, (hi_y-ymin)//ny+1)]
+
+    def find_closest_tract_patch_list(self, coords):
+        """
+        For each coordinate, find the tract that contains it (see 
+        find_tract; the nearest tract if none does) and the patches of
+        that tract overlapping the coordinates, like
+        skymap.findClosestTractPatchList(coordList).
+
+        Parameters
+        ----------
+        coords : list of tuples
+            Coordinates (ra, dec) in degrees.
+
+        Returns
+        -------
+        tract_patch_list : list of (int, list of tuples)
+            Tract ids and their patch indices.
+        """
+        ra, dec = np.asarray(coords, dtype=float).reshape(-1, 2).T
+        tracts = self.find_tract(ra, dec)[0]
+        tracts = np.where(tracts >= 0, tracts, self.find_nearest_tract(ra, dec))
+        result = []
+        for idx in tracts:
+            patches = self.find_patch_list(idx, ra, dec)
+            item = (int(self.tract[idx]), patches)
+            if patches and item not in result:
+                result.append(item)
+        return result
+
+    def tract_radius(self):
+        """
+        Return the angular distance (degrees) from each tract center to
+        the farthest corner of its bounding box.
+        """
+        if self._radius is None:
+            corners = self._box_corners(np.arange(len(self)), *self.bbox.T)
+            dots = np.einsum('tci,ti->tc', corners, self._ctr_xyz)
+            self._radius = np.rad2deg(np.arccos(np.clip(dots.min(axis=1), -1, 1)))
+        return self._radius
+
+    def _box_corners(self, idx, x0, y0, x1, y1):
+        """
+        Unit vectors (shape = (..., 4, 3)) of the corners of inclusive
+        pixel boxes in the tract(s) with row index idx, in order around
+        the boxes. Straight lines in a TAN projection are great circles,
+        so the boxes are exact spherical quadrilaterals.
+        """
+        x = np.stack((x0-0.5, x1+0.5, x1+0.5, x0-0.5), axis=-1)
+        y = np.stack((y0-0.5, y0-0.5, y1+0.5, y1+0.5), axis=-1)
+        idx = np.broadcast_to(np.asarray(idx)[...,np.newaxis], x.shape)
+        ra, dec = self.pixel_to_sky(idx, x, y)
+        return _unit_vectors(ra, dec)
+
+    def patch_footprints(self, idx):
+        """
+        Return the patch indices and the corners of the outer (with
+        border) patch boxes of tract row idx. Footprints are computed
+        once per tract.
+
+        Returns
+        -------
+        ix, iy : ndarray of ints
+            Patch indices.
+        corners : ndarray, shape = (N patches, 4, 3)
+            Unit vectors of the patch corners.
+        """
+        if idx not in self._footprints:
+            xmin, ymin, xmax, ymax = self.bbox[idx]
+            nx, ny = self.patch_inner[idx]
+            border = self.patch_border[idx]
+            npx, npy = self.num_patches[idx]
+            ix, iy = [a.ravel() for a in np.meshgrid(np.arange(npx), np.arange(npy), indexing='ij')]
+            x0 = np.maximum(xmin+ix*nx-border, xmin)
+            y0 = np.maximum(ymin+iy*ny-border, ymin)
+            x1 = np.minimum(xmin+(ix+1)*nx-1+border, xmax)
+            y1 = np.minimum(ymin+(iy+1)*ny-1+border, ymax)
+            corners = self._box_corners(np.full(len(ix), idx, dtype=int), x0, y0, x1, y1)
+            self._footprints[idx] = ix, iy, corners, _edge_normals(corners)
+        return self._footprints[idx][:3]
+
+    def find_polygon_patches(self, polygons):
+        """
+        Find all patches, in all tracts, whose outer boxes overlap
+        convex spherical polygons (e.g., boxes from utils.skybox_array).
+        Unlike find_closest_tract_patch_list, this is exact for regions
+        larger than a tract and at any declination.
+
+        Parameters
+        ----------
+        polygons : ndarray, shape = (N polygons, K vertices, 2)
+            The (ra, dec) vertices in degrees, in order around each
+            polygon, joined by great circle arcs. Polygons must be
+            convex and smaller than a hemisphere.
+
+        Returns
+        -------
+        polygon : ndarray of ints
+            The polygon index of each overlapping patch.
+        tract : ndarray of ints
+            Tract ids.
+        ix, iy : ndarray of ints
+            Patch indices.
+
+        Notes
+        -----
+        Two convex polygons in a hemisphere are disjoint if and only if
+        the great circle of an edge of one of them has all the vertices
+        of the other on its outer side (the separating axis theorem in
+        the gnomonic projection). Candidate tracts are found with a
+        KD-tree on the tract centers.
+        """
+        from scipy.spatial import cKDTree
+        polygons = np.asarray(polygons, dtype=float)
+        verts = _unit_vectors(polygons[...,0], polygons[...,1])
+        ctr = verts.sum(axis=1)
+        ctr /= np.linalg.norm(ctr, axis=1)[:,np.newaxis]
+        normals = _edge_normals(verts, ctr)
+        radius = np.arccos(np.clip(np.einsum('pvi,pi->pv', verts, ctr).min(axis=1), -1, 1))
+        if self._tree is None:
+            self._tree = cKDTree(self._ctr_xyz)
+        tract_radius = np.deg2rad(self.tract_radius())
+        search = np.minimum(radius + tract_radius.max(), np.pi)
+        candidates = self._tree.query_ball_point(ctr, 2*np.sin(search/2))
+        by_tract = {}
+        for p, tracts in enumerate(candidates):
+            for idx in tracts:
+                by_tract.setdefault(idx, []).append(p)
+
+        result = []
+        for idx in sorted(by_tract):
+            p = np.array(by_tract[idx])
+            dist = np.arccos(np.clip(ctr[p].dot(self._ctr_xyz[idx]), -1, 1))
+            p = p[dist <= radius[p] + tract_radius[idx]]
+            if len(p)==0:
+                continue
+            ix, iy, corners = self.patch_footprints(idx)
+            patch_normals = self._footprints[idx][3]
+            npoly, npatch = len(p), len(ix)
+            # dot products with shape (polygon, edge, patch, vertex)
+            dots = normals[p].reshape(-1, 3).dot(corners.reshape(-1, 3).T)
+            sep = (dots.reshape(npoly, -1, npatch, 4) < 0).all(axis=3).any(axis=1)
+            # shape (patch, edge, polygon, vertex)
+            dots = patch_normals.reshape(-1, 3).dot(verts[p].reshape(-1, 3).T)
+            sep |= (dots.reshape(npatch, 4, npoly, -1) < 0).all(axis=3).any(axis=1).T
+            a, b = np.nonzero(~sep)
+            result.append((p[a], np.full(len(a), self.tract[idx], dtype=int), ix[b], iy[b]))
+        if not result:
+            return tuple(np.zeros(0, dtype=int) for i in range(4))
+        polygon, tract, ix, iy = [np.concatenate(r) for r in zip(*result)]
+        order = np.lexsort((iy, ix, tract, polygon))
+        return polygon[order], tract[order], ix[order], iy[order]
+
+def skymap_cache_file(data_dir=None):
+    """
+    Return the default cache file of the skymap of a data directory 
+    (rerun). The file name includes a hash of the directory, so each 
+    data directory has its own cache. 
+    """
+    import hashlib
+    if data_dir is None:
+        from myPipe import dataDIR as data_dir
+    key = hashlib.md5(os.path.abspath(data_dir).encode()).hexdigest()[:12]
+    return os.path.join(default_skymap_dir, 'skymap_'+key+'.npz')
+
+def butler_root(butler):
+    """
+    Return the repository root (data directory) of a Gen2 butler, or 
+    None if it cannot be found.
+    """
+    for attrs in [('root',), ('mapper', 'root'), ('_mapper', 'root')]:
+        obj = butler
+        for attr in attrs:
+            obj = getattr(obj, attr, None)
+        if isinstance(obj, str):
+            return obj
+    repos = getattr(butler, '_repos', None)
+    if repos is not None:
+        for repo in list(repos.outputs()) + list(repos.inputs()):
+            root = getattr(getattr(repo, 'cfg', None), 'root', None)
+            if isinstance(root, str):
+                return root
+    return None
+
+def get_skymap_cache(fn=None, butler=None, data_dir=None):
+    """
+    Get the skymap geometry cache. The cache is loaded from fn once per
+    process. If fn does not exist, or was built from another data 
+    directory, the cache is built from the Butler's deepCoadd_skyMap 
+    and saved to fn.
+
+    Parameters
+    ----------
+    fn : string, optional
+        The cache file. If None, skymap_cache_file(data_dir).
+    butler : Butler object, optional
+        Used to build the cache. If None, a butler will be created 
+        for data_dir.
+    data_dir : string, optional
+        The data directory (rerun) of the skymap. If None, the root 
+        of butler, or the default dataDIR of myPipe.py if no butler 
+        is given. A ValueError is raised if the root of butler cannot
+        be found, since the cache of another rerun could be used.
+
+    Returns
+    -------
+    cache : SkymapCache
+    """
+    if data_dir is None and butler is not None:
+        data_dir = butler_root(butler)
+        if data_dir is None:
+            raise ValueError('cannot find the repository root of the butler; pass data_dir')
+    if data_dir is None:
+        from myPipe import dataDIR as data_dir
+    source = os.path.abspath(data_dir)
+    fn = os.path.abspath(skymap_cache_file(data_dir) if fn is None else fn)
+    if fn not in _skymap_caches:
+        cache = None
+        if os.path.isfile(fn):
+            cache = SkymapCache.load(fn)
+            if cache.source and cache.source!=source:
+                print('skymap cache', fn, 'is for', cache.source, '; rebuilding for', source)
+                cache = None
+        if cache is None:
+            if butler is None:
+                import lsst.daf.persistence
+                butler = lsst.daf.persistence.Butler(data_dir)
+            skymap = butler.get('deepCoadd_skyMap', immediate=True)
+            cache = SkymapCache.from_skymap(skymap, source=source)
+            print('saving skymap cache to', fn)
+            cache.save(fn)
+        _skymap_caches[fn] = cache
+    return _skymap_caches[fn]
+
+def make_synthetic_skymap(dec_min=-10.0, dec_max=10.0, tract_width=1.7, overlap=1.0/60,
+                          pixscale=0.168, patch_inner=4000, patch_border=100, first_tract=0):
+    """
+    Build a synthetic ring-style skymap for offline use. Tracts are laid
+    out in rings of constant dec, with TAN WCSs centered on the tracts.
+
+    Parameters
+    ----------
+    dec_min, dec_max : float, optional
+        Declination range of the ring centers in degrees.
+    tract_width : float, optional
+        Spacing between tract centers in degrees.
+    overlap : float, optional
+        Extra width (degrees) on each side of the tract.
+    pixscale : float, optional
+        Pixel scale in arcsec/pixel.
+    patch_inner : int, optional
+        Inner dimension of the patches in pixels.
+    patch_border : int, optional
+        Patch border in pixels.
+    first_tract : int, optional
+        Id of the first tract.
+
+    Returns
+    -------
+    cache : SkymapCache
+    """
+    cols = dict((c, []) for c in SkymapCache._columns)
+    npatch = int(np.ceil((tract_width+2*overlap)*3600.0/pixscale/patch_inner))
+    npix = npatch*patch_inner
+    tract = first_tract
+    for dec in np.arange(dec_min, dec_max+tract_width/2, tract_width):
+        nra = max(int(np.ceil(360.0*np.cos(np.deg2rad(dec))/tract_width)), 1)
+        for ra in np.arange(nra)*360.0/nra:
+            cols['tract'].append(tract)
+            cols['ctr'].append((ra, dec))
+            cols['crval'].append((ra, dec))
+            cols['crpix'].append(((npix-1)/2.0, (npix-1)/2.0))
+            cols['cd'].append(np.array([[-pixscale, 0.0], [0.0, pixscale]])/3600.0)
+            cols['bbox'].append((0, 0, npix-1, npix-1))
+            cols['patch_inner'].append((patch_inner, patch_inner))
+            cols['patch_border'].append(patch_border)
+            cols['num_patches'].append((npatch, npatch))
+            tract += 1
+    return SkymapCache(**cols)
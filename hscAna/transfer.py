@@ -0,0 +1,187 @@
+"""
+Background transfer of extracted files. Output directories are handed
+to a bounded queue, copied to the target by worker threads, and deleted
+locally only after a successful transfer, so the next patch can be
+extracted while the previous one is being copied.
+"""
+
+from __future__ import division, print_function
+
+__all__ = ['TransferQueue']
+
+import os
+import time
+import shutil
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+class TransferQueue(object):
+    """
+    Copy directories to a target with a pool of worker threads.
+
+    Parameters
+    ----------
+    target : string
+        The rsync destination (e.g., 'user@host:/path') or a local
+        directory.
+    nworkers : int, optional
+        Number of transfer threads.
+    maxsize : int, optional
+        Maximum number of directories waiting in the queue. submit
+        blocks when the queue is full, which bounds local disk usage.
+    method : string, optional
+        'rsync' to use rsync -avcR, or 'copy' to copy into a local
+        target directory without rsync.
+    delete : bool, optional
+        If True, delete each directory after it is transferred.
+    """
+
+    def __init__(self, target, nworkers=2, maxsize=4, method='rsync', delete=True):
+        assert method in ['rsync', 'copy'], 'method must be rsync or copy'
+        self.target = target
+        self.method = method
+        self.delete = delete
+        self.failed = []
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._stats = {'submitted':0, 'done':0, 'failed':0, 'bytes':0,
+                       'busy_time':0.0, 'max_queue_depth':0}
+        self._t0 = time.time()
+        self._workers = []
+        for i in range(nworkers):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self._workers.append(t)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def submit(self, path, root=None, callback=None):
+        """
+        Queue a directory for transfer.
+
+        Parameters
+        ----------
+        path : string
+            The directory to transfer.
+        root : string, optional
+            The path relative to root is recreated under the target.
+            If None, the directory is copied to target/basename(path).
+        callback : callable, optional
+            Called with no arguments after a successful transfer, 
+            before the directory is deleted.
+        """
+        path = os.path.abspath(path)
+        root = os.path.dirname(path) if root is None else os.path.abspath(root)
+        self._queue.put((path, root, callback))
+        with self._lock:
+            self._stats['submitted'] += 1
+            depth = self._queue.qsize()
+            self._stats['max_queue_depth'] = max(self._stats['max_queue_depth'], depth)
+
+    def close(self):
+        """
+        Wait for all transfers to finish and stop the workers.
+        """
+        for t in self._workers:
+            self._queue.put(None)
+        for t in self._workers:
+            t.join()
+        self._workers = []
+
+    def queue_depth(self):
+        """
+        Return the number of directories waiting to be transferred.
+        """
+        return self._queue.qsize()
+
+    def stats(self):
+        """
+        Return transfer statistics: number of directories submitted,
+        done and failed, bytes transferred, elapsed time, throughput
+        in MB/s, and the current and maximum queue depth.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats['elapsed'] = time.time()-self._t0
+        stats['throughput'] = stats['bytes']/1.0e6/stats['elapsed'] if stats['elapsed'] > 0 else 0.0
+        stats['queue_depth'] = self.queue_depth()
+        return stats
+
+    def _work(self):
+        import instrument
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            path, root, callback = item
+            t0 = time.time()
+            # any error is counted as a failed transfer, so that the 
+            # worker keeps running and submit and close cannot block
+            try:
+                nbytes = _dir_size(path)
+                with instrument.stage('transfer.'+self.method, path=path) as st:
+                    ok = self._transfer(path, root)
+                    st.count(bytes_written=nbytes if ok else 0)
+                if ok and callback is not None:
+                    callback()
+                if ok and self.delete:
+                    print('deleting', path)
+                    shutil.rmtree(path)
+            except Exception as e:
+                print(repr(e))
+                ok = False
+            with self._lock:
+                self._stats['busy_time'] += time.time()-t0
+                if ok:
+                    self._stats['done'] += 1
+                    self._stats['bytes'] += nbytes
+                else:
+                    self._stats['failed'] += 1
+                    self.failed.append(path)
+            if not ok:
+                print('***** transfer failed:', path, '*****')
+
+    def _transfer(self, path, root):
+        rel = os.path.relpath(path, root)
+        try:
+            if self.method=='rsync':
+                import subprocess
+                src = os.path.join(root, '.', rel)
+                return subprocess.call(['rsync', '-avcR', src, self.target]) == 0
+            dest = os.path.join(self.target, rel)
+            # symlinks (e.g., the group link tree of the planner) are 
+            # copied as links, like rsync -a
+            for dirpath, dirnames, filenames in os.walk(path, followlinks=False):
+                outdir = os.path.join(dest, os.path.relpath(dirpath, path))
+                if not os.path.isdir(outdir):
+                    os.makedirs(outdir)
+                for fn in dirnames + filenames:
+                    src, dst = os.path.join(dirpath, fn), os.path.join(outdir, fn)
+                    if os.path.islink(src):
+                        if os.path.lexists(dst):
+                            os.remove(dst)
+                        os.symlink(os.readlink(src), dst)
+                    elif fn in filenames:
+                        shutil.copy2(src, dst)
+            return True
+        except (IOError, OSError) as e:
+            print(e)
+            return False
+
+def _dir_size(path):
+    """
+    Return the total size in bytes of the files in path (symlinks
+    are not followed).
+    """
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        size += sum(os.lstat(os.path.join(dirpath, fn)).st_size for fn in filenames)
+    return size
@@ -1,7 +1,8 @@
 
 from __future__ import division, print_function
 
-__all__ = ['skybox', 'get_hsc_regions', 'radec_to_tractpatch']
+__all__ = ['skybox', 'skybox_array', 'get_hsc_regions', 'get_hsc_regions_array', 'radec_to_tractpatch', 'radec_to_tractpatch_array',
+           'group_by_tractpatch', 'unique_coords_mask']
 
 import numpy as np
 
@@ -30,7 +31,8 @@ def skybox(ra_c, dec_c, width, height=None):
     Note
     ----
     This calculation is only an approximation, as it 
-    assumes the angular separation is small. 
+    assumes the angular separation is small. See skybox_array 
+    for exact boxes.
     """
     if height is None:
         height = width
@@ -46,7 +48,43 @@ def skybox(ra_c, dec_c, width, height=None):
                   (ra_max_lo, dec_lo)]
     return box_coords
 
-def get_hsc_regions(box_coords, butler=None):
+def skybox_array(ra_c, dec_c, width, height=None):
+    """
+    Calculate the four corners of boxes centered at arrays of 
+    coordinates. The boxes are exact spherical quadrilaterals: 
+    the sides are great circles at angular distances width/2 and 
+    height/2 from the center (squares in the tangent plane at the 
+    center), so they are valid for large boxes and near the poles. 
+
+    Parameters
+    ----------
+    ra_c, dec_c : float or ndarray
+        The centers of the boxes in degrees.
+    width : float or ndarray
+        The angular widths of the boxes in degrees.
+    height : float or ndarray, optional
+        The angular heights of the boxes in degrees.
+        If None, will set height=width. 
+
+    Returns
+    -------
+    box_coords : ndarray, shape = (N boxes, 4, 2)
+        The (ra, dec) of the box corners, in the same order as 
+        skybox, so box_coords[i] can be passed to get_hsc_regions.
+    """
+    if height is None:
+        height = width
+    ra_c, dec_c, width, height = np.broadcast_arrays(*[np.atleast_1d(np.asarray(a, dtype=float)) 
+                                                       for a in (ra_c, dec_c, width, height)])
+    xi = np.tan(np.deg2rad(width)/2)[:,np.newaxis]*np.array([-1, -1, 1, 1])
+    eta = np.tan(np.deg2rad(height)/2)[:,np.newaxis]*np.array([-1, 1, 1, -1])
+    ra0, dec0 = np.deg2rad(ra_c)[:,np.newaxis], np.deg2rad(dec_c)[:,np.newaxis]
+    denom = np.cos(dec0) - eta*np.sin(dec0)
+    ra = np.rad2deg(ra0 + np.arctan2(xi, denom))%360.0
+    dec = np.rad2deg(np.arctan2(np.sin(dec0) + eta*np.cos(dec0), np.hypot(xi, denom)))
+    return np.stack((ra, dec), axis=-1)
+
+def get_hsc_regions(box_coords, butler=None, use_cache=True, exact=False, data_dir=None):
     """
     Get hsc regions within a polygonal region (box) of the sky. Here, 
     hsc regions means the tracts and patches within the 'skybox'. 
@@ -60,6 +98,16 @@ def get_hsc_regions(box_coords, butler=None):
     butler : Butler object, optional
         If None, then a will be created in this function.
         Default is None.
+    use_cache : bool, optional
+        If True, use the skymap geometry cache (see skymap.py), 
+        which does not need the LSST stack once it exists. 
+    exact : bool, optional
+        If True, return all patches (in all tracts) whose outer 
+        boxes overlap the polygon, with the exact spherical overlap 
+        test of SkymapCache.find_polygon_patches. Uses the cache.
+    data_dir : string, optional
+        The data directory (rerun). If None, the root of butler or 
+        the default dataDIR (see skymap.get_skymap_cache).
 
     Returns
     -------
@@ -69,22 +117,29 @@ def get_hsc_regions(box_coords, butler=None):
 
     Note
     ----
-    This may give incorrect answers on regions that are larger than a tract, 
-    which is ~1.5 degree = 90 arcminute.
+    Unless exact is True, this may give incorrect answers on regions 
+    that are larger than a tract, which is ~1.5 degree = 90 arcminute.
     """
-    import lsst.afw.coord as afwCoord
-    import lsst.afw.geom as afwGeom
-    if butler is None:
-        import lsst.daf.persistence
-        from myPipe import dataDIR
-        butler = lsst.daf.persistence.Butler(dataDIR)
+    if exact and len(box_coords) > 2:
+        regions = get_hsc_regions_array(np.asarray(box_coords, dtype=float)[np.newaxis], butler=butler, data_dir=data_dir)
+        return regions[['tract', 'patch']]
     if len(box_coords)==4:
-        from toolbox.astro import angsep
         (ra1, dec1), (ra2, dec2) = box_coords[0], box_coords[2]
-        if angsep(ra1, dec1, ra2, dec2, sepunits='arcmin') > 90.0:
+        if _angsep_arcmin(ra1, dec1, ra2, dec2) > 90.0:
             print('\n********* WARNING *********')
             print('Region larger than a tract')
             print('***************************\n')
+    if use_cache:
+        from skymap import get_skymap_cache
+        tractPatchList = get_skymap_cache(butler=butler, data_dir=data_dir).find_closest_tract_patch_list(box_coords)
+        regions = [(tract, str(i)+','+str(j)) for tract, patches in tractPatchList for i, j in patches]
+        return np.array(regions, dtype=[('tract', int), ('patch', 'S4')])
+    import lsst.afw.coord as afwCoord
+    import lsst.afw.geom as afwGeom
+    if butler is None:
+        import lsst.daf.persistence
+        from myPipe import dataDIR
+        butler = lsst.daf.persistence.Butler(dataDIR if data_dir is None else data_dir)
     skymap = butler.get('deepCoadd_skyMap', immediate=True)
     coordList = [afwCoord.IcrsCoord(afwGeom.Angle(ra, afwGeom.degrees),\
                  afwGeom.Angle(dec, afwGeom.degrees)) for ra, dec in box_coords]
@@ -96,7 +151,40 @@ def get_hsc_regions(box_coords, butler=None):
             regions.append((tractInfo.getId(), str(patchIndex[0])+','+str(patchIndex[1])))
     return np.array(regions, dtype=[('tract', int), ('patch', 'S4')])
 
-def radec_to_tractpatch(ra, dec, butler=None, patch_as_str=True):
+def get_hsc_regions_array(boxes, butler=None, data_dir=None):
+    """
+    Get the hsc regions of many polygonal regions (e.g., from 
+    skybox_array) in one call, with an exact spherical overlap 
+    test between the regions and the precomputed outer boxes of 
+    the patches. This is correct for regions larger than a tract 
+    and at high declination. 
+
+    Parameters
+    ----------
+    boxes : ndarray, shape = (N regions, K vertices, 2)
+        The (ra, dec) vertices of convex regions in degrees.
+    butler : Butler object, optional
+        Only used if the skymap cache must be built.
+    data_dir : string, optional
+        The data directory (rerun). If None, the root of butler or 
+        the default dataDIR (see skymap.get_skymap_cache).
+
+    Returns
+    -------
+    regions : structured ndarray
+        The overlapping tracts and patches of all regions, sorted 
+        by region, with columns 'region' (index into boxes), 'tract', 
+        and 'patch'. A patch is listed in every tract whose outer 
+        boxes overlap the region. 
+    """
+    from skymap import get_skymap_cache
+    region, tract, ix, iy = get_skymap_cache(butler=butler, data_dir=data_dir).find_polygon_patches(boxes)
+    regions = np.zeros(len(region), dtype=[('region', int), ('tract', int), ('patch', 'S4')])
+    regions['region'], regions['tract'] = region, tract
+    regions['patch'] = np.char.add(np.char.add(ix.astype('S2'), b','), iy.astype('S2'))
+    return regions
+
+def radec_to_tractpatch(ra, dec, butler=None, patch_as_str=True, use_cache=True, data_dir=None):
     """
     Get the tract and patch associated with the given ra and dec.
 
@@ -112,6 +200,12 @@ def radec_to_tractpatch(ra, dec, butler=None, patch_as_str=True):
     patch_as_str : bool, optional
         If True, return patch as a string (e.g., '0,1').
         Otherwise, return patch as tuple (defualt = True).
+    use_cache : bool, optional
+        If True, use the skymap geometry cache (see skymap.py), 
+        which does not need the LSST stack once it exists. 
+    data_dir : string, optional
+        The data directory (rerun). If None, the root of butler or 
+        the default dataDIR (see skymap.get_skymap_cache).
 
     Returns
     -------
@@ -120,18 +214,150 @@ def radec_to_tractpatch(ra, dec, butler=None, patch_as_str=True):
     patch : string or tuple
         HSC patch
     """
-    import lsst.afw.coord as afwCoord
-    import lsst.afw.geom as afwGeom
-    if butler is None:
-        import lsst.daf.persistence
-        from myPipe import dataDIR
-        butler = lsst.daf.persistence.Butler(dataDIR)
-    skymap = butler.get('deepCoadd_skyMap', immediate=True)
-    coord = afwCoord.IcrsCoord(afwGeom.Angle(ra, afwGeom.degrees), afwGeom.Angle(dec, afwGeom.degrees))
-    tractInfo = skymap.findTract(coord)
-    patchInfo = tractInfo.findPatch(coord)
-    tract = tractInfo.getId()
-    patch = patchInfo.getIndex()
+    if use_cache:
+        from skymap import get_skymap_cache
+        tract, patch = get_skymap_cache(butler=butler, data_dir=data_dir).find_tract_patch(ra, dec)
+    else:
+        import lsst.afw.coord as afwCoord
+        import lsst.afw.geom as afwGeom
+        if butler is None:
+            import lsst.daf.persistence
+            from myPipe import dataDIR
+            butler = lsst.daf.persistence.Butler(dataDIR if data_dir is None else data_dir)
+        skymap = butler.get('deepCoadd_skyMap', immediate=True)
+        coord = afwCoord.IcrsCoord(afwGeom.Angle(ra, afwGeom.degrees), afwGeom.Angle(dec, afwGeom.degrees))
+        tractInfo = skymap.findTract(coord)
+        patchInfo = tractInfo.findPatch(coord)
+        tract = tractInfo.getId()
+        patch = patchInfo.getIndex()
     if patch_as_str:
         patch = str(patch[0])+','+str(patch[1])
     return tract, patch
+
+def radec_to_tractpatch_array(ra, dec, butler=None, strict=False, data_dir=None):
+    """
+    Get the tracts and patches associated with arrays of ra and dec,
+    using the skymap geometry cache.
+
+    Parameters
+    ----------
+    ra : ndarray
+        Right ascensions in degrees.
+    dec : ndarray
+        Declinations in degrees.
+    butler : Bulter object, optional
+        Only used if the skymap cache must be built.
+    strict : bool, optional
+        If True, raise a LookupError if any coordinate is not in a 
+        tract. Otherwise, the number of such coordinates is printed. 
+    data_dir : string, optional
+        The data directory (rerun). If None, the root of butler or 
+        the default dataDIR (see skymap.get_skymap_cache).
+
+    Returns
+    -------
+    regions : structured ndarray
+        The tract and patch of each coordinate, with columns 
+        'tract' and 'patch'. Coordinates that are not in any tract 
+        have tract = -1 and patch = ''.
+    """
+    from skymap import get_skymap_cache
+    tract, ix, iy = get_skymap_cache(butler=butler, data_dir=data_dir).find_tract_patch_array(ra, dec)
+    regions = np.zeros(len(tract), dtype=[('tract', int), ('patch', 'S4')])
+    regions['tract'] = tract
+    good = ix >= 0
+    regions['patch'][good] = np.char.add(np.char.add(ix[good].astype('S2'), b','), iy[good].astype('S2'))
+    if not good.all():
+        bad = np.flatnonzero(~good)
+        ra, dec = np.atleast_1d(ra), np.atleast_1d(dec)
+        msg = '{} of {} coordinates are not in any tract, e.g., ({}, {})'.format(
+              len(bad), len(good), ra[bad[0]], dec[bad[0]])
+        if strict:
+            raise LookupError(msg)
+        print('***** WARNING:', msg, '*****')
+    return regions
+
+def group_by_tractpatch(ra, dec, butler=None, strict=False, data_dir=None):
+    """
+    Group coordinates by the tract and patch they fall in, so that 
+    each patch only needs to be processed once. 
+
+    Parameters
+    ----------
+    ra : ndarray
+        Right ascensions in degrees.
+    dec : ndarray
+        Declinations in degrees.
+    butler : Bulter object, optional
+        Only used if the skymap cache must be built.
+    strict : bool, optional
+        If True, raise a LookupError if any coordinate is not in a 
+        tract. Otherwise, such coordinates are left out of the groups,
+        and their number is printed (see radec_to_tractpatch_array).
+    data_dir : string, optional
+        The data directory (rerun). If None, the root of butler or 
+        the default dataDIR (see skymap.get_skymap_cache).
+
+    Returns
+    -------
+    regions : structured ndarray
+        The unique tracts and patches, with columns 'tract' and 'patch'.
+    indices : list of ndarrays
+        indices[i] are the indices of the coordinates in regions[i].
+    """
+    regions = radec_to_tractpatch_array(ra, dec, butler=butler, strict=strict, data_dir=data_dir)
+    index = np.flatnonzero(regions['patch']!=b'')
+    if len(index)==0:
+        return regions[index], []
+    unique, inverse = np.unique(regions[index], return_inverse=True)
+    order = np.argsort(inverse, kind='mergesort')
+    splits = np.cumsum(np.bincount(inverse.ravel(), minlength=len(unique)))[:-1]
+    return unique, np.split(index[order], splits)
+
+def _angsep_arcmin(ra1, dec1, ra2, dec2):
+    """
+    Angular separation in arcmin between two coordinates in degrees.
+    """
+    ra1, dec1, ra2, dec2 = [np.deg2rad(a) for a in (ra1, dec1, ra2, dec2)]
+    hav = np.sin((dec2-dec1)/2)**2 + np.cos(dec1)*np.cos(dec2)*np.sin((ra2-ra1)/2)**2
+    return np.rad2deg(2*np.arcsin(np.sqrt(hav)))*60.0
+
+def unique_coords_mask(ra, dec, max_sep=2.0):
+    """
+    Build a mask that removes duplicate coordinates. Coordinates are
+    visited in order, and every coordinate within max_sep of a kept
+    coordinate is flagged as a duplicate. Neighbors are found with a 
+    KD-tree on 3D unit vectors, so this scales as ~N log N.
+
+    Parameters
+    ----------
+    ra : ndarray
+        Right ascensions in degrees.
+    dec : ndarray
+        Declinations in degrees.
+    max_sep : float, optional
+        Maximum separation in arcsec for which two coordinates are 
+        considered to be the same object.
+
+    Returns
+    -------
+    mask : ndarray of bools
+        True for coordinates to keep.
+    """
+    from scipy.spatial import cKDTree
+    ra = np.deg2rad(np.atleast_1d(np.asarray(ra, dtype=float)))
+    dec = np.deg2rad(np.atleast_1d(np.asarray(dec, dtype=float)))
+    mask = np.ones(len(ra), dtype=bool)
+    if len(ra) < 2:
+        return mask
+    xyz = np.column_stack((np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)))
+    chord = 2.0*np.sin(np.deg2rad(max_sep/3600.0)/2.0)
+    pairs = cKDTree(xyz).query_pairs(chord, output_type='ndarray')
+    if len(pairs)==0:
+        return mask
+    # pairs are (i, j) with i < j; visit them in order of i
+    pairs = pairs[np.lexsort((pairs[:,1], pairs[:,0]))]
+    for i, j in pairs:
+        if mask[i]:
+            mask[j] = False
+    return mask
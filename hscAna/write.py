@@ -1,38 +1,61 @@
 
 from __future__ import division, print_function
 
-__all__ = ['make_default_outdir', 'write_deepCoadd_fits']
+__all__ = ['make_default_outdir', 'write_deepCoadd_fits', 'write_deepCoadd_bands',
+           'default_compression']
 
-def make_default_outdir(tract, patch, band):
+# tile-compression settings (astropy CompImageHDU keyword arguments) for 
+# the image (img), the noise images (sig, wts, wts_bad), and the integer 
+# masks (bad, det, planes). RICE with quantization is lossy for floats, so 
+# it is only used for the image; the noise images are compressed 
+# losslessly (GZIP_2 without quantization), like the integer masks. 
+default_compression = {'image':{'compression_type':'RICE_1', 'quantize_level':16.0},
+                       'noise':{'compression_type':'GZIP_2', 'quantize_level':0},
+                       'mask':{'compression_type':'RICE_1'}}
+
+def make_default_outdir(tract, patch, band, root=None):
     """
     Make the default output directory for the deepCoadd
     fits files that are the output of write_deepCoadd_fits. 
     The default directory has the following structure:
-    ../output/deepCoadds/HSC-band/tract/patch.
+    ../output/deepCoadds/HSC-band/tract/patch, or 
+    root/HSC-band/tract/patch if root is given.
     """
     import os
 
-    # output directory is in previous directory 
-    outdir = os.path.dirname(os.path.abspath(__file__))
-    outdir = os.path.dirname(outdir)
+    if root is None:
+        # output directory is in previous directory 
+        outdir = os.path.dirname(os.path.abspath(__file__))
+        outdir = os.path.dirname(outdir)
+        dirs = ['output', 'deepCoadds']
+    else:
+        outdir, dirs = os.path.dirname(os.path.abspath(root)), [os.path.basename(os.path.abspath(root))]
 
-    dirs = ['output', 'deepCoadds', 'HSC-'+band.upper(),
-            str(tract), patch[0]+'-'+patch[-1]]
+    dirs += ['HSC-'+band.upper(), str(tract), patch[0]+'-'+patch[-1]]
 
     # build path, make directories if they don't exist
     for d in dirs:
         outdir = os.path.join(outdir, d)
         if not os.path.isdir(outdir):
             print('created', outdir)
-            os.mkdir(outdir)
+            try:
+                os.mkdir(outdir)
+            except OSError:
+                # created by another band worker
+                if not os.path.isdir(outdir):
+                    raise
 
     return outdir
 
-def write_deepCoadd_fits(tract, patch, band='I', outdir='default', butler=None, prefix=None):
+def write_deepCoadd_fits(tract, patch, band='I', outdir='default', butler=None, prefix=None, 
+                         weights=False, flagval=-100.0, planes=None, manifest=None, group='',
+                         bbox=None, skybox=None, compress=False, compact=False, nwriters=None,
+                         use_cache=True):
     """
     Write deepCoadd fits images for the given tract, patch, and band.
     Will write individual files for the image, bad pixel mask, detected
-    pixel mask, and sigma map. 
+    pixel mask, and sigma map. The masked image is read once, and each 
+    product is built in memory and written once. 
 
     Parameters
     ----------
@@ -49,6 +72,56 @@ def write_deepCoadd_fits(tract, patch, band='I', outdir='default', butler=None,
         If None, a Butler object will be created. 
     prefix : string, optional
         File name prefix. 
+    weights : bool, optional
+        If True, also write the weights image (1/sigma**2) and 
+        the weights image with bad pixels flagged. 
+    flagval : float, optional
+        The weight assigned to bad pixels in the flagged weights image.
+    planes : list of strings, optional
+        Mask planes (e.g., 'SAT', 'BRIGHT_OBJECT') to write as separate
+        uint8 (0 or 1) images named after the plane in lower case. All 
+        planes are decoded in one pass over the mask. 
+    manifest : Manifest object, optional
+        If not None, each product is recorded in the manifest after it
+        is written, and the patch is skipped if all of its products are
+        already recorded and present in outdir. 
+    group : string, optional
+        Group id under which the products are recorded in the manifest.
+    bbox : tuple of ints, optional
+        Pixel bounding box (xmin, ymin, xmax, ymax) in tract pixel 
+        coordinates. If given, only this cutout is read and written, 
+        with the header WCS adjusted to match. 
+    skybox : list of tuples, optional
+        Sky coordinates (ra, dec) in degrees. If given, the cutout is 
+        the pixel box that encloses them, clipped to the patch. 
+    compress : bool or dict, optional
+        If True, write tile-compressed images (in extension 1) using 
+        default_compression. A dict with keys 'image', 'noise', and/or 
+        'mask' overrides the defaults for the image, the sigma and 
+        weights images, and the masks; a value of None leaves that kind 
+        uncompressed. 
+    compact : bool, optional
+        If True, write the bad and det masks as uint8 flags (1 = bad or 
+        detected) instead of the full mask bits. 
+    nwriters : int, optional
+        If greater than 1, the products are written concurrently by a 
+        pool of nwriters threads, since the writes mostly wait on the 
+        file system. Each product is then handed to the pool as a 
+        big-endian copy (astropy would otherwise byte-swap the arrays in 
+        place, including the image array of the calexp, which may be 
+        shared; see cache.py), which needs up to one more image of 
+        memory for each pending write. 
+    use_cache : bool, optional
+        If True, read the exposure through the process-wide data cache
+        (see cache.py). It is only read here, and the image is written 
+        from a big-endian copy, so the cached exposure is not modified.
+
+    Returns
+    -------
+    io_stats : dict
+        The number of bytes read and written for this patch, the write 
+        time of each product ('write_times'), and the wall time from 
+        the first write to the last ('write_wall'). 
     
     Notes
     -----
@@ -58,47 +131,334 @@ def write_deepCoadd_fits(tract, patch, band='I', outdir='default', butler=None,
     3) det.fits (detection pixel mask)
     4) sig.fits (sigma image)
     5) psf.fits (point spread function)
+    6) wts.fits (weights image, if weights=True)
+    7) wts_bad.fits (weights with bad pixels flagged, if weights=True)
+    8) plane.fits for each plane in planes (e.g., sat.fits)
+
+    Each file is written to a temporary file in outdir and renamed when 
+    complete, so partial files never appear under the product names. 
     """
     import os
+    import time
+    import threading
+    import numpy as np
+    import instrument
     from astropy.io import fits
-    from myPipe import MyPipe
+    from myPipe import MyPipe, decode_mask_planes
 
     band = band.upper()
-    pipe = MyPipe(tract, patch, band=band, butler=butler)
 
     if outdir=='default':
         outdir = make_default_outdir(tract, patch, band)
 
-    # get headers: 0=image, 1=mask, 2=variance
-    hdulist= fits.open(pipe.get_fn())
-    headers = [hdulist[i].header for i in range(1,4)]
-    headers[0].set('PIXSCALE', pipe.get_pixscale())
-    headers[0].set('ZP_PHOT', pipe.get_zptmag())
-
-    # write images
-    getters = [pipe.get_img, pipe.get_badmask, pipe.get_detmask, pipe.get_sigma]
-    labels = ['img', 'bad', 'det', 'sig']
-    if prefix is not None:
-        for i in range(len(labels)):
-            labels[i] = prefix+'_'+labels[i]
-    headnums = [0, 1, 1, 2]
-    for get, lab, num in zip(getters, labels, headnums):
-        print('writing', lab+'.fits')
-        fn = os.path.join(outdir, lab+'.fits')
-        fits.writeto(fn, get(), headers[num], clobber=True)
-
-    # write psf fits file
-    psf_file = prefix+'_psf.fits' if prefix else 'psf.fits'
-    fn = os.path.join(outdir, psf_file)
-    print('writing', psf_file)
-    pipe.calexp.getPsf().computeImage().writeFits(fn)
+    io_stats = {'bytes_read':0, 'bytes_written':0, 'write_times':{}, 'write_wall':0.0}
+    lock = threading.Lock()
+
+    def name(lab):
+        return prefix+'_'+lab if prefix else lab
+
+    def fn(lab):
+        return os.path.join(outdir, name(lab)+'.fits')
+
+    def written(lab):
+        nbytes = os.path.getsize(fn(lab))
+        with lock:
+            io_stats['bytes_written'] += nbytes
+        instrument.count(bytes_written=nbytes)
+        if manifest is not None:
+            manifest.record(fn(lab), tract, patch, band, name(lab), group=group)
+
+    compression = _get_compression(compress)
+    pool = None
+    pending = []
+
+    def timed_write(lab, compressed, func):
+        print('writing', os.path.basename(fn(lab)))
+        t0 = time.time()
+        with instrument.stage('write.fits', product=lab, compressed=compressed):
+            func()
+            written(lab)
+        io_stats['write_times'][lab] = time.time() - t0
+
+    def submit(lab, compressed, func):
+        if pool is None:
+            timed_write(lab, compressed, func)
+        else:
+            pending.append(pool.apply_async(timed_write, (lab, compressed, func)))
+
+    def write(lab, data, header, kind='image', shared=False):
+        if pool is not None or shared:
+            # fits are big-endian, so astropy writes this copy as it is
+            data = data.astype(data.dtype.newbyteorder('>'), copy=False)
+        submit(lab, compression[kind] is not None, lambda: _writeto(fn(lab), data, header, compression[kind]))
+
+    planes = [] if planes is None else [p.upper() for p in planes]
+    labels = ['img', 'bad', 'det', 'sig', 'psf'] + (['wts', 'wts_bad'] if weights else [])
+    labels += [p.lower() for p in planes]
+    if manifest is not None:
+        if manifest.is_done(tract, patch, band, [name(lab) for lab in labels], group=group, check_files=True):
+            print('already written:', 'HSC-'+band, tract, patch)
+            return io_stats
+
+    cutout = (bbox is not None) or (skybox is not None)
+    with instrument.stage('write.patch', tract=tract, patch=patch, band=band, cutout=cutout):
+        pipe = MyPipe(tract, patch, band=band, butler=butler, bbox=bbox, skybox=skybox, use_cache=use_cache)
+
+        # get headers: 0=image, 1=mask, 2=variance
+        # (header-only reads; the zero point and pixel scale come from the 
+        # metadata index, so the exposure is not needed for them)
+        with instrument.stage('write.headers'):
+            with fits.open(pipe.get_fn()) as hdulist:
+                headers = [hdulist[i].header.copy() for i in range(1,4)]
+            headers[0].set('PIXSCALE', pipe.get_pixscale())
+            headers[0].set('ZP_PHOT', pipe.get_zptmag())
+        if pipe.bbox is not None:
+            x0, y0 = pipe.get_xy0()
+            print('cutout', pipe.bbox, 'of', pipe.dataID)
+            for header in headers:
+                _shift_header(header, pipe.bbox[0]-x0, pipe.bbox[1]-y0)
+
+        # single read of the masked image; the arrays below are views
+        with instrument.stage('write.read'):
+            maskedImg = pipe.maskedImg
+            io_stats['bytes_read'] += pipe.bytes_read
+            instrument.count(bytes_read=pipe.bytes_read)
+        mask = maskedImg.getMask().getArray()
+        detected = maskedImg.getMask().getPlaneBitMask('DETECTED')
+
+        if nwriters is not None and nwriters > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(nwriters)
+        t_write = time.time()
+        try:
+            write('img', maskedImg.getImage().getArray(), headers[0], shared=use_cache)
+
+            bad = _badmask(mask, detected, compact)
+            instrument.count(arrays=1, array_bytes=bad.nbytes)
+            write('bad', bad, headers[1], 'mask')
+            del bad
+
+            det = _detmask(mask, detected, compact)
+            instrument.count(arrays=1, array_bytes=det.nbytes)
+            write('det', det, headers[1], 'mask')
+            del det
+
+            if planes:
+                plane_dict = maskedImg.getMask().getMaskPlaneDict()
+                decoded = decode_mask_planes(mask, dict((p, plane_dict[p]) for p in planes))
+                for p in planes:
+                    write(p.lower(), decoded[p].view(np.uint8), headers[1], 'mask')
+                del decoded
+
+            sig = np.sqrt(maskedImg.getVariance().getArray())
+            instrument.count(arrays=1, array_bytes=sig.nbytes)
+            write('sig', sig, headers[2], 'noise')
+            if weights:
+                # weight = 1/sigma**2, computed in place of sigma
+                wts = np.square(sig, out=sig)
+                np.divide(1.0, wts, out=wts)
+                write('wts', wts, headers[2], 'noise')
+                wts[(mask!=0) & (mask!=detected)] = flagval
+                write('wts_bad', wts, headers[2], 'noise')
+            del sig
+
+            psf = pipe.calexp.getPsf().computeImage()
+            submit('psf', False, lambda: _atomic_write(fn('psf'), psf.writeFits))
+
+            for result in pending:
+                result.get()
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        io_stats['write_wall'] = time.time() - t_write
+        if pool is not None:
+            # the write.fits stages of the pool threads are not nested here
+            instrument.count(bytes_written=io_stats['bytes_written'])
+
+    times = io_stats['write_times']
+    print('write times (s):', ', '.join(lab+' '+str(round(times[lab], 3)) for lab in labels if lab in times)+';',
+          'total', round(sum(times.values()), 3), 'in', round(io_stats['write_wall'], 3), 'wall')
+    return io_stats
+
+def write_deepCoadd_bands(tract, patch, bands='GRIZY', root=None, nworkers=None, **kwargs):
+    """
+    Write deepCoadd fits images for several bands of the same tract
+    and patch, with the bands extracted concurrently in a thread pool.
+
+    Parameters
+    ----------
+    tract : int
+        HSC tract.
+    patch : sting
+        HSC patch. 
+    bands : string or list of strings, optional
+        HSC filters, e.g., 'GRIZY' or ['G', 'I'].
+    root : string, optional
+        The files of each band are written to root/HSC-band/tract/patch.
+        If None, the default output directory is used. 
+    nworkers : int, optional
+        The number of band workers. If None, one per band. 
+    **kwargs : 
+        Passed to write_deepCoadd_fits (e.g., butler, weights, manifest,
+        use_cache).
+
+    Notes
+    -----
+    The Gen2 Butler is not thread-safe, so if a butler is given, the 
+    workers share it through a lock on butler.get (the reads are 
+    serialized and the FITS writes run concurrently). If butler is 
+    None, each band creates its own butler.
+
+    Returns
+    -------
+    stats : dict
+        io_stats of each band (with bands as keys), and the wall time, 
+        the summed time of the bands (which is about the time of one 
+        call per band in series), and their ratio, the speedup. 
+    """
+    import time
+    from multiprocessing.pool import ThreadPool
+
+    bands = [b.upper() for b in bands]
+    nworkers = len(bands) if nworkers is None else nworkers
+    if kwargs.get('butler') is not None:
+        kwargs['butler'] = _LockedButler(kwargs['butler'])
+
+    def work(band):
+        t0 = time.time()
+        outdir = make_default_outdir(tract, patch, band, root=root)
+        io_stats = write_deepCoadd_fits(tract, patch, band, outdir=outdir, **kwargs)
+        return band, io_stats, time.time()-t0
+
+    t0 = time.time()
+    pool = ThreadPool(nworkers)
+    try:
+        results = pool.map(work, bands)
+    finally:
+        pool.close()
+        pool.join()
+    wall_time = time.time() - t0
+
+    stats = dict((band, io_stats) for band, io_stats, _ in results)
+    stats['wall_time'] = wall_time
+    stats['band_time'] = sum(r[2] for r in results)
+    stats['speedup'] = stats['band_time']/wall_time if wall_time > 0 else 1.0
+    print('wrote', len(bands), 'bands of', tract, patch, 'in', round(wall_time, 2), 
+          's (speedup', round(stats['speedup'], 2), 'over serial bands)')
+    return stats
+
+class _LockedButler(object):
+    """
+    Butler proxy that serializes the get calls with a lock, so that 
+    threads can share a butler. Other attributes are the butler's.
+    """
+
+    def __init__(self, butler):
+        import threading
+        self._butler = butler
+        self._lock = threading.Lock()
+
+    def get(self, *args, **kwargs):
+        with self._lock:
+            return self._butler.get(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._butler, name)
+
+def _get_compression(compress):
+    """
+    Return the compression settings for the 'image' and 'mask' 
+    kinds from the compress argument of write_deepCoadd_fits.
+    """
+    if not compress:
+        return {'image':None, 'noise':None, 'mask':None}
+    compression = dict(default_compression)
+    if isinstance(compress, dict):
+        compression.update(compress)
+    return compression
+
+def _atomic_write(fn, write):
+    """
+    Call write with the name of a temporary file next to fn, and rename 
+    it to fn (replacing fn) when write returns, so fn is never a partial 
+    file. The temporary file is removed if write fails. 
+    """
+    import os
+    import threading
+    tmp = os.path.join(os.path.dirname(fn), '.'+os.path.basename(fn)+'.'+str(os.getpid())+
+                       '.'+str(threading.current_thread().ident)+'.tmp')
+    try:
+        write(tmp)
+        os.rename(tmp, fn)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def _writeto(fn, data, header, compression=None):
+    """
+    Write an image to fn, overwriting it atomically. If compression 
+    (CompImageHDU keyword arguments) is not None, the image is 
+    tile-compressed in extension 1 of the file. 
+    """
+    from astropy.io import fits
+    if compression is None:
+        _atomic_write(fn, lambda tmp: fits.writeto(tmp, data, header))
+    else:
+        hdu = fits.CompImageHDU(data, header, **compression)
+        _atomic_write(fn, fits.HDUList([fits.PrimaryHDU(), hdu]).writeto)
+
+def _badmask(mask, detected, compact=False):
+    """
+    Bad pixel mask: the mask bits of pixels flagged with anything 
+    other than (only) DETECTED, or a uint8 flag if compact. 
+    """
+    import numpy as np
+    if compact:
+        return ((mask!=0) & (mask!=detected)).view(np.uint8)
+    bad = mask.copy()
+    bad[bad==detected] = 0
+    return bad
+
+def _detmask(mask, detected, compact=False):
+    """
+    Detected pixel mask: the mask bits of pixels flagged with only 
+    DETECTED, or a uint8 flag if compact. 
+    """
+    import numpy as np
+    if compact:
+        return (mask==detected).view(np.uint8)
+    det = mask.copy()
+    det[det!=detected] = 0
+    return det
+
+def _shift_header(header, dx, dy):
+    """
+    Update the WCS and pixel-origin keywords of a header for a cutout 
+    whose first pixel is (dx, dy) in the array of the original image.
+    """
+    for ax, d in [('1', dx), ('2', dy)]:
+        for key in ['CRPIX'+ax, 'LTV'+ax]:
+            if key in header:
+                header[key] = header[key] - d
+        if 'CRVAL'+ax+'A' in header:
+            header['CRVAL'+ax+'A'] = header['CRVAL'+ax+'A'] + d
 
 if __name__=='__main__':
     import argparse
     parser = argparse.ArgumentParser(description='Get and save deepCoadd image in given tract and patch')
     parser.add_argument('tract', type=int, help='tract of observation')
     parser.add_argument('patch', type=str, help='patch of observation')
-    parser.add_argument('-b', '--band', help='observation band', default='I')
+    parser.add_argument('-b', '--band', help='observation band(s), e.g., I or GRIZY', default='I')
     parser.add_argument('-o', '--outdir', help='output directory', default='default')
+    parser.add_argument('-z', '--compress', action='store_true', help='write tile-compressed images')
+    parser.add_argument('--compact', action='store_true', help='write the bad and det masks as uint8 flags')
+    parser.add_argument('-w', '--nwriters', type=int, help='number of threads writing the products', default=None)
     args = parser.parse_args()
-    write_deepCoadd_fits(args.tract, args.patch, band=args.band, outdir=args.outdir)
+    if len(args.band) > 1:
+        root = None if args.outdir=='default' else args.outdir
+        write_deepCoadd_bands(args.tract, args.patch, args.band, root=root, 
+                              compress=args.compress, compact=args.compact, nwriters=args.nwriters)
+    else:
+        write_deepCoadd_fits(args.tract, args.patch, band=args.band, outdir=args.outdir, 
+                             compress=args.compress, compact=args.compact, nwriters=args.nwriters)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the deepCoadd fits output modes of write_deepCoadd_fits on a
+synthetic patch served by the FakeButler in scripts/fakes.py: bytes
+written, write time, and read-back time of the img, bad, det, sig, psf,
+wts, and wts_bad products in the default format, with compact (uint8)
+bad and det masks (compact=True), with tile compression (compress=True),
+and with both.
+"""
+
+from __future__ import division, print_function
+
+import os, sys, time, shutil, tempfile
+from astropy.io import fits
+repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(repo_dir, 'hscAna'))
+import fakes
+from write import write_deepCoadd_fits
+
+import argparse
+parser = argparse.ArgumentParser(description='Benchmark the fits output modes of write_deepCoadd_fits')
+parser.add_argument('-r', '--repeat', type=int, help='number of repeats (the minimum is kept)', default=3)
+parser.add_argument('-n', '--nsources', type=int, help='number of sources per patch', default=20000)
+parser.add_argument('-d', '--datadir', help='synthetic data directory (reused between runs)',
+                    default=os.path.join(tempfile.gettempdir(), 'hscAna_bench_data'))
+args = parser.parse_args()
+
+tract, patch, band = 10, '4,4', 'I'
+butler = fakes.install_fakes(os.path.join(args.datadir, 'n'+str(args.nsources)), nsources=args.nsources)
+
+modes = [('default', False, False), ('compact', False, True),
+         ('compressed', True, False), ('compact+compressed', True, True)]
+
+results = []
+reference = None
+for mode, compress, compact in modes:
+    t_write, t_read = [], []
+    for i in range(args.repeat):
+        outdir = tempfile.mkdtemp()
+        try:
+            # the exposure is read through the data cache, so only the
+            # first call reads it, and write_wall times the writes alone
+            io_stats = write_deepCoadd_fits(tract, patch, band, outdir=outdir, butler=butler,
+                                            weights=True, compress=compress, compact=compact)
+            t_write.append(io_stats['write_wall'])
+            files = [os.path.join(outdir, f) for f in sorted(os.listdir(outdir))]
+            t0 = time.time()
+            for f in files:
+                data = fits.getdata(f)
+                data.sum()
+            t_read.append(time.time() - t0)
+        finally:
+            shutil.rmtree(outdir)
+    nbytes = io_stats['bytes_written']
+    reference = nbytes if reference is None else reference
+    results.append((mode, nbytes, reference/nbytes, min(t_write), min(t_read)))
+
+print('\n{:>20} {:>12} {:>8} {:>10} {:>10}'.format('mode', 'bytes', 'ratio', 'write (s)', 'read (s)'))
+for result in results:
+    print('{:>20} {:>12} {:>8.2f} {:>10.2f} {:>10.2f}'.format(*result))
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+"""
+Offline benchmark suite. Synthetic HSC-like deepCoadds are served by the
+FakeButler in scripts/fakes.py on a synthetic skymap, so the MyPipe
+getters, write_deepCoadd_fits, the imtools conversions, region lookup,
+and candidate dedup can be timed without the HSC data or the LSST stack.
+
+Each run is appended to a JSON history file (in ~/.hscAna by default,
+outside the repository), and the timings are compared with the previous
+run of the same configuration, so that regressions show up between
+versions.
+"""
+
+from __future__ import division, print_function
+
+import os, sys, time, json, shutil, platform, tempfile, subprocess
+import numpy as np
+from collections import OrderedDict
+repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(repo_dir, 'hscAna'))
+import fakes, imtools, utils, write, catstore
+from myPipe import MyPipe
+from cache import get_data_cache
+
+import argparse
+parser = argparse.ArgumentParser(description='Run the offline hscAna benchmarks')
+parser.add_argument('-r', '--repeat', type=int, help='number of repeats (the minimum is kept)', default=3)
+parser.add_argument('-n', '--nsources', type=int, help='number of sources per patch', default=20000)
+parser.add_argument('-d', '--datadir', help='synthetic data directory (reused between runs)',
+                    default=os.path.join(tempfile.gettempdir(), 'hscAna_bench_data'))
+parser.add_argument('-o', '--history', help='JSON history file',
+                    default=os.path.join(os.path.expanduser('~'), '.hscAna', 'bench_history.json'))
+parser.add_argument('-t', '--threshold', type=float, help='slowdown fraction flagged as a regression', default=0.2)
+parser.add_argument('-b', '--bench', nargs='*', help='only run these benchmarks', default=None)
+args = parser.parse_args()
+
+tract, patch, band = 10, '4,4', 'I'
+butler = fakes.install_fakes(os.path.join(args.datadir, 'n'+str(args.nsources)), nsources=args.nsources)
+dataID = {'tract':tract, 'patch':patch, 'filter':'HSC-'+band}
+print('synthetic patch:', butler.get('deepCoadd_calexp_filename', dataID)[0])
+workdir = tempfile.mkdtemp()
+
+# inputs for the imtools and search benchmarks
+write.write_deepCoadd_fits(tract, patch, band, butler=butler, outdir=workdir, prefix='ref')
+rng = np.random.RandomState(42)
+t = butler.skymap.tract_index(tract)
+ra_c, dec_c = butler.skymap.ctr[t]
+ra = ra_c + rng.uniform(-0.7, 0.7, 100000)/np.cos(np.deg2rad(dec_c))
+dec = dec_c + rng.uniform(-0.7, 0.7, 100000)
+# candidate lists overlap, so about half of the coordinates are duplicates
+ra_dup = np.concatenate([ra[:50000], ra[:50000]+rng.normal(0, 0.2/3600, 50000)])
+dec_dup = np.concatenate([dec[:50000], dec[:50000]+rng.normal(0, 0.2/3600, 50000)])
+boxes = [utils.skybox(r, d, 0.2) for r, d in zip(ra[:200], dec[:200])]
+box_array = utils.skybox_array(ra[:2000], dec[:2000], 0.2)
+cat_columns = ['id', 'parent', 'coord_ra', 'coord_dec', 'base_ClassificationExtendedness_value',
+               'cmodel_flux', 'base_SdssShape_xx', 'base_SdssShape_yy', 'base_SdssShape_xy']
+store = os.path.join(workdir, 'catstore')
+catstore.ingest_patch(tract, patch, band, butler=butler, root=store, columns=cat_columns)
+
+def mypipe_getters(use_cache=True):
+    if not use_cache:
+        get_data_cache().clear()
+    pipe = MyPipe(tract, patch, band, butler=butler, use_cache=use_cache)
+    pipe.get_zptmag(), pipe.get_pixscale()
+    pipe.get_img(), pipe.get_mask(), pipe.get_sigma(), pipe.get_psf()
+    pipe.get_badmask(), pipe.get_detmask(), pipe.get_mask_planes()
+
+def write_fits(**kwargs):
+    outdir = os.path.join(workdir, 'write')
+    if os.path.isdir(outdir):
+        shutil.rmtree(outdir)
+    os.mkdir(outdir)
+    get_data_cache().clear()
+    write.write_deepCoadd_fits(tract, patch, band, butler=butler, outdir=outdir, weights=True, **kwargs)
+
+def read_catalog(use_store=False):
+    if use_store:
+        cat = catstore.open_catalog(tract, patch, band, root=store)
+    else:
+        cat = butler.get('deepCoadd_meas', dataID, immediate=True)
+    return [np.asarray(cat.get(col)).sum() for col in cat_columns]
+
+def imtools_wts(chunk_rows=None):
+    sig, bad = os.path.join(workdir, 'ref_sig.fits'), os.path.join(workdir, 'ref_bad.fits')
+    wts, wts_bad = os.path.join(workdir, 'wts.fits'), os.path.join(workdir, 'wts_bad.fits')
+    imtools.sig_to_wts(sig, wts, chunk_rows=chunk_rows)
+    imtools.wts_with_badpix(wts, bad, wts_bad, chunk_rows=chunk_rows)
+
+benchmarks = OrderedDict([
+    ('mypipe_getters_cold', lambda: mypipe_getters(use_cache=False)),
+    ('mypipe_getters_cached', lambda: mypipe_getters(use_cache=True)),
+    ('write_deepCoadd_fits', write_fits),
+    ('write_deepCoadd_fits_compressed', lambda: write_fits(compress=True, compact=True)),
+    ('write_deepCoadd_fits_threaded', lambda: write_fits(nwriters=4)),
+    ('catalog_butler', read_catalog),
+    ('catalog_store', lambda: read_catalog(use_store=True)),
+    ('imtools_wts', imtools_wts),
+    ('imtools_wts_chunked', lambda: imtools_wts(chunk_rows=512)),
+    ('get_hsc_regions_200_boxes', lambda: [utils.get_hsc_regions(box) for box in boxes]),
+    ('get_hsc_regions_array_2000_boxes', lambda: utils.get_hsc_regions_array(box_array)),
+    ('radec_to_tractpatch_100k', lambda: utils.radec_to_tractpatch_array(ra, dec)),
+    ('group_by_tractpatch_100k', lambda: utils.group_by_tractpatch(ra, dec)),
+    ('unique_coords_mask_100k', lambda: utils.unique_coords_mask(ra_dup, dec_dup)),
+])
+if args.bench:
+    benchmarks = OrderedDict((k, v) for k, v in benchmarks.items() if k in args.bench)
+
+# silence the per-file progress messages of the timed functions
+results = OrderedDict()
+stdout = sys.stdout
+try:
+    for name, func in benchmarks.items():
+        times = []
+        for i in range(args.repeat):
+            sys.stdout = open(os.devnull, 'w')
+            try:
+                t0 = time.time()
+                func()
+                times.append(time.time()-t0)
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+        results[name] = {'min':min(times), 'median':float(np.median(times))}
+        print('{:>35}: {:8.3f} s (median {:.3f} s)'.format(name, min(times), np.median(times)))
+finally:
+    sys.stdout = stdout
+    shutil.rmtree(workdir)
+
+try:
+    rev = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_dir).decode().strip()
+except (OSError, subprocess.CalledProcessError):
+    rev = None
+config = {'nsources':args.nsources, 'repeat':args.repeat}
+record = OrderedDict([('date', time.strftime('%Y-%m-%d %H:%M:%S')), ('git', rev),
+                      ('python', platform.python_version()), ('numpy', np.__version__),
+                      ('host', platform.node()), ('config', config), ('results', results)])
+
+history = []
+if os.path.isfile(args.history):
+    with open(args.history) as f:
+        history = json.load(f)
+previous = [r for r in history if r['config']==config]
+if previous:
+    last = previous[-1]
+    print('\ncompared with', last['git'], 'from', last['date']+':')
+    for name, res in results.items():
+        if name not in last['results']:
+            continue
+        ratio = res['min']/last['results'][name]['min']
+        flag = '  <-- REGRESSION' if ratio > 1+args.threshold else ''
+        print('{:>35}: {:6.2f}x{}'.format(name, ratio, flag))
+
+history.append(record)
+if not os.path.isdir(os.path.dirname(os.path.abspath(args.history))):
+    os.makedirs(os.path.dirname(os.path.abspath(args.history)))
+with open(args.history, 'w') as f:
+    json.dump(history, f, indent=1)
+print('\nappended results to', args.history)
@@ -0,0 +1,400 @@
+"""
+A local stand-in for the LSST Butler that serves synthetic deepCoadds,
+so that hscAna can be run and timed without the HSC data or the LSST
+stack. Each patch is written once to a calexp-like fits file (image,
+mask, and variance extensions, with the tract WCS of a synthetic
+skymap), with HSC-like dimensions, mask planes, and source counts.
+
+This is test scaffolding, not part of the package: it imports the
+hscAna modules directly (skymap, metadata, mosaic), so the hscAna
+directory must be on sys.path, as in bench_suite.py.
+"""
+
+from __future__ import division, print_function
+
+__all__ = ['hsc_mask_planes', 'FakeButler', 'install_fakes', 'make_calexp_file']
+
+import os
+import numpy as np
+
+# mask plane bits of the HSC production coadds
+hsc_mask_planes = {'BAD':0, 'SAT':1, 'INTRP':2, 'CR':3, 'EDGE':4, 'DETECTED':5,
+                   'DETECTED_NEGATIVE':6, 'SUSPECT':7, 'NO_DATA':8, 'BRIGHT_OBJECT':9,
+                   'CLIPPED':10, 'CROSSTALK':11, 'NOT_DEBLENDED':12, 'UNMASKEDNAN':13}
+
+_zptmag = 27.0
+
+class _Array(object):
+    """
+    Image, mask, or variance plane of a masked image.
+    """
+
+    def __init__(self, array):
+        self._array = array
+
+    def getArray(self):
+        return self._array
+
+    def writeFits(self, fn):
+        from astropy.io import fits
+        if os.path.isfile(fn):
+            os.remove(fn)
+        fits.writeto(fn, self._array)
+
+class _Mask(_Array):
+
+    def getMaskPlaneDict(self):
+        return dict(hsc_mask_planes)
+
+    def getPlaneBitMask(self, planes):
+        if isinstance(planes, str):
+            planes = [planes]
+        return sum(1 << hsc_mask_planes[p] for p in planes)
+
+class _MaskedImage(object):
+
+    def __init__(self, img, mask, var):
+        self._planes = _Array(img), _Mask(mask), _Array(var)
+
+    def getImage(self):
+        return self._planes[0]
+
+    def getMask(self):
+        return self._planes[1]
+
+    def getVariance(self):
+        return self._planes[2]
+
+class _Angle(object):
+
+    def __init__(self, arcsec):
+        self._arcsec = arcsec
+
+    def asArcseconds(self):
+        return self._arcsec
+
+class _Wcs(object):
+
+    def __init__(self, header):
+        self.header = header
+
+    def pixelScale(self):
+        cd = np.array([[self.header['CD1_1'], self.header['CD1_2']],
+                       [self.header['CD2_1'], self.header['CD2_2']]])
+        return _Angle(np.sqrt(abs(np.linalg.det(cd)))*3600.0)
+
+class _Calib(object):
+
+    def __init__(self, fluxmag0):
+        self._fluxmag0 = fluxmag0
+
+    def getFluxMag0(self):
+        return self._fluxmag0, 0.0
+
+class _Psf(object):
+
+    def __init__(self, sigma):
+        self.sigma = sigma
+
+    def computeImage(self):
+        y, x = np.mgrid[-20:21, -20:21]
+        psf = np.exp(-(x**2+y**2)/(2*self.sigma**2))
+        return _Array((psf/psf.sum()).astype(np.float64))
+
+class _Exposure(object):
+    """
+    Calibrated exposure read from a synthetic calexp file.
+    """
+
+    def __init__(self, fn, bbox=None):
+        from astropy.io import fits
+        with fits.open(fn) as hdulist:
+            fluxmag0 = hdulist[0].header['FLUXMAG0']
+            self._header = hdulist[1].header.copy()
+            planes = [hdulist[i].data for i in range(1, 4)]
+            if bbox is not None:
+                x0, y0 = -self._header['LTV1'], -self._header['LTV2']
+                xmin, ymin, xmax, ymax = bbox
+                planes = [p[ymin-y0:ymax-y0+1, xmin-x0:xmax-x0+1] for p in planes]
+            planes = [p.copy() for p in planes]
+        self._mi = _MaskedImage(*planes)
+        self._calib = _Calib(fluxmag0)
+
+    def getMaskedImage(self):
+        return self._mi
+
+    def getWcs(self):
+        return _Wcs(self._header)
+
+    def getCalib(self):
+        return self._calib
+
+    def getPsf(self):
+        return _Psf(2.5)
+
+class _Schema(object):
+
+    def __init__(self, dtype):
+        self.dtype = dtype
+
+    def getNames(self):
+        return set(self.dtype.names)
+
+    def getRecordSize(self):
+        return self.dtype.itemsize
+
+class _Record(object):
+
+    def __init__(self, row):
+        self._row = row
+
+    def get(self, name):
+        return self._row[name]
+
+    def __getitem__(self, name):
+        return self._row[name]
+
+class _Catalog(object):
+    """
+    Source catalog backed by a numpy structured array, with the
+    column and record access of an afw SourceCatalog.
+    """
+
+    def __init__(self, data):
+        self._data = data
+
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        for row in self._data:
+            yield _Record(row)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self._data[key]
+        return _Record(self._data[key])
+
+    def get(self, name):
+        return self._data[name]
+
+    def getX(self):
+        return self._data['base_SdssCentroid_x']
+
+    def getY(self):
+        return self._data['base_SdssCentroid_y']
+
+    def getSchema(self):
+        return _Schema(self._data.dtype)
+
+    def getColumnView(self):
+        return self
+
+def _patch_geometry(skymap, tract, patch):
+    """
+    Return the tract row, and the first pixel (x0, y0) and shape (ny, nx)
+    of the patch including its border, in tract pixel coordinates.
+    """
+    t = skymap.tract_index(tract)
+    i, j = [int(p) for p in patch.split(',')]
+    bx0, by0, bx1, by1 = skymap.bbox[t]
+    nx, ny = skymap.patch_inner[t]
+    border = skymap.patch_border[t]
+    x0, y0 = max(bx0+i*nx-border, bx0), max(by0+j*ny-border, by0)
+    x1, y1 = min(bx0+(i+1)*nx-1+border, bx1), min(by0+(j+1)*ny-1+border, by1)
+    return t, (x0, y0), (y1-y0+1, x1-x0+1)
+
+def make_calexp_file(fn, skymap, tract, patch, band='I', nsources=20000, seed=0):
+    """
+    Write a synthetic deepCoadd_calexp fits file: sky noise and gaussian
+    sources, with DETECTED footprints, saturated cores, cosmic rays, bad
+    columns, EDGE and NO_DATA borders, and BRIGHT_OBJECT masks.
+
+    Parameters
+    ----------
+    fn : string
+        The output file name.
+    skymap : SkymapCache
+        The skymap that defines the patch WCS and dimensions.
+    tract, patch, band : int, string, string
+        The patch to make.
+    nsources : int, optional
+        The number of sources.
+    seed : int, optional
+        The random seed (the tract, patch, and band are added to it).
+
+    Returns
+    -------
+    sources : ndarray
+        The x, y (tract pixels), flux, and size of the sources.
+    """
+    from astropy.io import fits
+    from mosaic import _tract_header
+
+    t, (x0, y0), shape = _patch_geometry(skymap, tract, patch)
+    rng = np.random.RandomState((seed + 1000*tract + 37*x0 + y0 + ord(band[0]))%(2**32))
+    bit = dict((p, 1 << b) for p, b in hsc_mask_planes.items())
+
+    sky_sigma = 0.05
+    img = rng.normal(0.0, sky_sigma, shape).astype(np.float32)
+    var = np.full(shape, sky_sigma**2, dtype=np.float32)
+    mask = np.zeros(shape, dtype=np.uint16)
+
+    x = rng.uniform(0, shape[1], nsources)
+    y = rng.uniform(0, shape[0], nsources)
+    flux = 10**rng.uniform(-0.5, 3.5, nsources)
+    size = rng.uniform(1.5, 4.0, nsources)
+    for xs, ys, fs, ss in zip(x, y, flux, size):
+        r = int(np.ceil(4*ss))
+        xi, yi = int(xs), int(ys)
+        sx = slice(max(xi-r, 0), min(xi+r+1, shape[1]))
+        sy = slice(max(yi-r, 0), min(yi+r+1, shape[0]))
+        yy, xx = np.ogrid[sy, sx]
+        stamp = fs/(2*np.pi*ss**2)*np.exp(-((xx-xs)**2+(yy-ys)**2)/(2*ss**2))
+        img[sy, sx] += stamp
+        var[sy, sx] += stamp*1e-3
+        mask[sy, sx] |= np.where(stamp > 5*sky_sigma, bit['DETECTED'], 0).astype(np.uint16)
+        if fs > 2000:
+            mask[sy, sx] |= np.where(stamp > 200, bit['SAT']|bit['INTRP'], 0).astype(np.uint16)
+
+    # cosmic rays, bad columns, bright object masks, and borders
+    ncr = shape[0]*shape[1]//20000
+    cr = (rng.randint(0, shape[0], ncr), rng.randint(0, shape[1], ncr))
+    mask[cr] |= bit['CR']|bit['INTRP']
+    for col in rng.randint(0, shape[1], 3):
+        mask[:, col] |= bit['BAD']
+    yy, xx = np.ogrid[:shape[0], :shape[1]]
+    for xb, yb, rb in zip(rng.uniform(0, shape[1], 2), rng.uniform(0, shape[0], 2), rng.uniform(50, 200, 2)):
+        mask[(xx-xb)**2+(yy-yb)**2 < rb**2] |= bit['BRIGHT_OBJECT']
+    mask[:10], mask[-10:], mask[:, :10], mask[:, -10:] = [m|bit['EDGE'] for m in
+                                                         (mask[:10], mask[-10:], mask[:, :10], mask[:, -10:])]
+    nodata = rng.randint(0, shape[0]//10)
+    mask[:nodata, :nodata] |= bit['NO_DATA']
+    img[:nodata, :nodata] = np.nan
+
+    header = _tract_header(skymap, t, x0, y0)
+    header['FILTER'] = 'HSC-'+band
+    primary = fits.PrimaryHDU()
+    primary.header['FLUXMAG0'] = 10**(0.4*_zptmag)
+    hdus = [primary] + [fits.ImageHDU(a, header) for a in (img, mask, var)]
+    outdir = os.path.dirname(os.path.abspath(fn))
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    if os.path.isfile(fn):
+        os.remove(fn)
+    fits.HDUList(hdus).writeto(fn)
+
+    sources = np.empty(nsources, dtype=[('x', float), ('y', float), ('flux', float), ('size', float)])
+    sources['x'], sources['y'], sources['flux'], sources['size'] = x+x0, y+y0, flux, size
+    return sources
+
+class FakeButler(object):
+    """
+    Butler stand-in that serves synthetic deepCoadd_calexp,
+    deepCoadd_calexp_sub, deepCoadd_meas, and deepCoadd_calexp_filename
+    datasets. Patch files are made on first use in root and reused.
+
+    Parameters
+    ----------
+    root : string
+        Directory of the synthetic data repository.
+    skymap : SkymapCache
+        The synthetic skymap (see skymap.make_synthetic_skymap).
+    nsources : int, optional
+        The number of sources per patch (HSC Wide patches have
+        ~10,000 - 30,000).
+    nextra : int, optional
+        The number of extra float64 columns in the catalogs, so that
+        the record size is close to that of the HSC deepCoadd_meas
+        schema.
+    seed : int, optional
+        The random seed.
+    """
+
+    def __init__(self, root, skymap, nsources=20000, nextra=400, seed=0):
+        self.root = root
+        self.skymap = skymap
+        self.nsources = nsources
+        self.nextra = nextra
+        self.seed = seed
+        self.calls = {}
+
+    def _fn(self, dataID, kind='calexp'):
+        tract, patch, band = dataID['tract'], dataID['patch'], dataID['filter']
+        return os.path.join(self.root, 'deepCoadd', band, str(tract), patch,
+                            kind+'-'+band+'-'+str(tract)+'-'+patch+'.fits')
+
+    def _make(self, dataID):
+        fn = self._fn(dataID)
+        if not os.path.isfile(fn):
+            sources = make_calexp_file(fn, self.skymap, dataID['tract'], dataID['patch'],
+                                       dataID['filter'][-1], self.nsources, self.seed)
+            np.save(self._fn(dataID, 'src')[:-5]+'.npy', sources)
+        return fn
+
+    def _catalog(self, dataID):
+        self._make(dataID)
+        sources = np.load(self._fn(dataID, 'src')[:-5]+'.npy')
+        t = self.skymap.tract_index(dataID['tract'])
+        ra, dec = self.skymap.pixel_to_sky(np.full(len(sources), t, dtype=int), sources['x'], sources['y'])
+        dtype = [('id', np.int64), ('parent', np.int64), ('deblend_nChild', np.int32),
+                 ('coord_ra', float), ('coord_dec', float),
+                 ('base_SdssCentroid_x', float), ('base_SdssCentroid_y', float),
+                 ('base_SdssShape_xx', float), ('base_SdssShape_yy', float), ('base_SdssShape_xy', float),
+                 ('base_PsfFlux_flux', float), ('base_CircularApertureFlux_12_0_flux', float),
+                 ('cmodel_flux', float), ('base_ClassificationExtendedness_value', float),
+                 ('extra', float, (self.nextra,))]
+        cat = np.zeros(len(sources), dtype=dtype)
+        cat['id'] = np.arange(1, len(sources)+1)
+        cat['coord_ra'], cat['coord_dec'] = np.deg2rad(ra), np.deg2rad(dec)
+        cat['base_SdssCentroid_x'], cat['base_SdssCentroid_y'] = sources['x'], sources['y']
+        cat['base_SdssShape_xx'] = cat['base_SdssShape_yy'] = sources['size']**2
+        for col in ['base_PsfFlux_flux', 'base_CircularApertureFlux_12_0_flux', 'cmodel_flux']:
+            cat[col] = sources['flux']
+        cat['base_ClassificationExtendedness_value'] = (sources['size'] > 2.5).astype(float)
+        return _Catalog(cat)
+
+    def get(self, dataset, dataID=None, immediate=True, bbox=None, **kwargs):
+        self.calls[dataset] = self.calls.get(dataset, 0) + 1
+        if dataset=='deepCoadd_calexp_filename':
+            return [self._make(dataID)]
+        if dataset=='deepCoadd_calexp':
+            return _Exposure(self._make(dataID))
+        if dataset=='deepCoadd_calexp_sub':
+            if hasattr(bbox, 'getMinX'):
+                bbox = (bbox.getMinX(), bbox.getMinY(), bbox.getMaxX(), bbox.getMaxY())
+            return _Exposure(self._make(dataID), bbox=bbox)
+        if dataset=='deepCoadd_meas':
+            return self._catalog(dataID)
+        if dataset=='deepCoadd_skyMap':
+            return self.skymap
+        raise KeyError('no synthetic dataset '+dataset)
+
+def install_fakes(root, skymap=None, **kwargs):
+    """
+    Set up an offline environment in root: the synthetic skymap is
+    installed as the process-wide skymap cache (for the default data
+    directory and for root, the root of the butler), the header metadata
+    index is kept in root, and a FakeButler is returned.
+
+    Parameters
+    ----------
+    root : string
+        Directory for the synthetic data and indexes.
+    skymap : SkymapCache, optional
+        If None, skymap.make_synthetic_skymap() is used.
+    **kwargs :
+        Passed to FakeButler.
+    """
+    import skymap as _skymap
+    import metadata
+    if skymap is None:
+        skymap = _skymap.make_synthetic_skymap()
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    # the cache of the default data directory and of the butler root
+    for data_dir in [None, root]:
+        _skymap._skymap_caches[os.path.abspath(_skymap.skymap_cache_file(data_dir))] = skymap
+    index = metadata.MetadataIndex(os.path.join(root, 'metadata.sqlite'))
+    metadata._metadata_indexes[os.path.abspath(metadata.default_metadata_file)] = index
+    return FakeButler(root, skymap, **kwargs)
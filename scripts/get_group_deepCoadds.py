@@ -36,34 +36,55 @@ box_width = 3.0 # Mpc
 
 copydir = sys.argv[1]
 deepCoadds_dir = '/home/jgreco/projects/hscAna/output/deepCoadds'
-cmd = 'rsync -avc '+deepCoadds_dir+' '+copydir
-
-for group_id, ra, dec, D_A in group_info['group_id', 'ra','dec', 'D_A']:
-    theta = (box_width/D_A)*180.0/np.pi
-    group_regions = hscAna.get_hsc_regions(hscAna.skybox(ra, dec, theta), butler=butler)
-
-    for tract, patch in group_regions:
-        print('getting deepCoadds for:', 'HSC-'+band+':', tract, patch)
-        outdir = deepCoadds_dir
-
-        # make output directories if they don't exist
-        # path will be {outdir}/HSC-band/group_id/tract/patch
-        dirs = ['', 'HSC-'+band, 'group_'+str(group_id), 
-                str(tract), patch[0]+'-'+patch[-1]]
-        for d in dirs:
-            outdir = os.path.join(outdir, d)
-            if not os.path.isdir(outdir):
-                print('created', outdir)
-                os.mkdir(outdir)
-
-        hscAna.write_deepCoadd_fits(tract, patch, band, butler=butler, outdir=outdir)
-
-        # rsync fits files to different machine due to limited disk space
-        os.system(cmd)
-
-        # *carefully* delete the output directory
-        if (deepCoadds_dir.split('/')[-2]=='output') and (deepCoadds_dir.split('/')[-1]=='deepCoadds'):
-            print('deleting', deepCoadds_dir)
-            shutil.rmtree(deepCoadds_dir)
-        else:
-            print('***** Careful! ***** \n The deepCoadds_dir is not what you think!')
+
+# rsync fits files to different machine due to limited disk space,
+# while the next patch is extracted
+transfer = hscAna.TransferQueue(copydir)
+
+# record of finished patches, so an interrupted run can be restarted
+manifest = hscAna.Manifest(os.path.join(os.path.dirname(deepCoadds_dir), 'manifest.sqlite'))
+products = ['img', 'bad', 'det', 'sig', 'psf']
+
+# each patch is extracted once, no matter how many groups need it
+patches, group_patches, plan_stats = hscAna.plan_group_patches(group_info, box_width, butler=butler)
+patch_dir = os.path.join(deepCoadds_dir, 'patches')
+group_dir = os.path.join(deepCoadds_dir, 'groups')
+
+for tract, patch in patches:
+    if manifest.is_done(tract, patch, band, products, status='transferred'):
+        print('already transferred:', 'HSC-'+band+':', tract, patch)
+        continue
+    print('getting deepCoadds for:', 'HSC-'+band+':', tract, patch)
+    outdir = deepCoadds_dir
+
+    # make output directories if they don't exist
+    # path will be {outdir}/patches/HSC-band/tract/patch
+    dirs = ['', 'patches', 'HSC-'+band, str(tract), patch[0]+'-'+patch[-1]]
+    for d in dirs:
+        outdir = os.path.join(outdir, d)
+        if not os.path.isdir(outdir):
+            print('created', outdir)
+            os.mkdir(outdir)
+
+    hscAna.write_deepCoadd_fits(tract, patch, band, butler=butler, outdir=outdir, manifest=manifest)
+
+    # patch files are deleted after a successful transfer
+    transfer.submit(outdir, root=os.path.dirname(deepCoadds_dir), 
+                    callback=lambda tract=tract, patch=patch: manifest.mark_transferred(tract, patch, band))
+
+# group layout: {outdir}/groups/HSC-band/group_id/tract/patch -> patches
+hscAna.make_group_links(group_patches, patch_dir, group_dir, band)
+group_patches.write(os.path.join(group_dir, 'group_patches_HSC-'+band+'.csv'), format='ascii.csv')
+transfer.submit(group_dir, root=os.path.dirname(deepCoadds_dir))
+
+transfer.close()
+print('transfer stats:', transfer.stats())
+
+# *carefully* delete the output directory
+if transfer.failed:
+    print('***** transfer failed for', len(transfer.failed), 'patches *****')
+elif (deepCoadds_dir.split('/')[-2]=='output') and (deepCoadds_dir.split('/')[-1]=='deepCoadds'):
+    print('deleting', deepCoadds_dir)
+    shutil.rmtree(deepCoadds_dir)
+else:
+    print('***** Careful! ***** \n The deepCoadds_dir is not what you think!')
@@ -1,8 +1,8 @@
 #!/usr/bin/env python 
 
 """
-Get HSC deepCoadd fits files in a tract and patch that
-contains a UDG candidate. 
+Get HSC deepCoadd fits cutouts around UDG candidates, 
+one per tract and patch that contains candidates. 
 """
 
 from __future__ import print_function
@@ -13,26 +13,47 @@ import hscAna as ha
 from lsst.daf.persistence import Butler
 butler = Butler(ha.dataDIR)
 band = 'I'
+cutout_width = 2.0/60.0 # deg, box around each candidate
 
 coords = np.loadtxt('../input/udg_candies.txt', skiprows=1, usecols=(0,1))
 
 copydir = sys.argv[1]
 outdir = '/home/jgreco/projects/hscAna/output/deepCoadds'
 
-cmd = 'rsync -avc '+outdir+' '+copydir
-
-for (ra, dec) in coords:
-    tract, patch = ha.radec_to_tractpatch(ra, dec, butler=butler)
-
-    print('getting deepCoadds for:', 'HSC-'+band+':', tract, patch)
-    ha.write_deepCoadd_fits(tract, patch, band, butler=butler)
-
-    # rsync fits files to different machine due to limited disk space
-    os.system(cmd)
-
-    # *carefully* delete the output directory
-    if (outdir.split('/')[-2]=='output') and (outdir.split('/')[-1]=='deepCoadds'):
-        print('deleting', outdir)
-        shutil.rmtree(outdir)
-    else:
-        print('Careful!\n The output directory is not what you think!')
+# rsync fits files to different machine due to limited disk space,
+# while the next patch is extracted
+transfer = ha.TransferQueue(copydir)
+
+# record of finished patches, so an interrupted run can be restarted
+manifest = ha.Manifest(os.path.join(os.path.dirname(outdir), 'manifest.sqlite'))
+products = ['img', 'bad', 'det', 'sig', 'psf']
+
+# extract each patch once, no matter how many candidates it contains
+regions, indices = ha.group_by_tractpatch(coords[:,0], coords[:,1], butler=butler)
+print(sum(len(idx) for idx in indices), 'of', len(coords), 'candidates in', len(regions), 'patches')
+
+for (tract, patch), idx in zip(regions, indices):
+    if manifest.is_done(tract, patch, band, products, status='transferred'):
+        print('already transferred:', 'HSC-'+band+':', tract, patch)
+        continue
+    print('getting deepCoadds for:', 'HSC-'+band+':', tract, patch, '('+str(len(idx))+' candidates)')
+    patch_dir = ha.make_default_outdir(tract, patch, band)
+    # only write the cutout that encloses the candidates in this patch
+    box = [c for ra, dec in coords[idx] for c in ha.skybox(ra, dec, cutout_width)]
+    ha.write_deepCoadd_fits(tract, patch, band, butler=butler, outdir=patch_dir, manifest=manifest, skybox=box)
+
+    # patch files are deleted after a successful transfer
+    transfer.submit(patch_dir, root=os.path.dirname(outdir),
+                    callback=lambda tract=tract, patch=patch: manifest.mark_transferred(tract, patch, band))
+
+transfer.close()
+print('transfer stats:', transfer.stats())
+
+# *carefully* delete the output directory
+if transfer.failed:
+    print('Transfer failed for', len(transfer.failed), 'patches')
+elif (outdir.split('/')[-2]=='output') and (outdir.split('/')[-1]=='deepCoadds'):
+    print('deleting', outdir)
+    shutil.rmtree(outdir)
+else:
+    print('Careful!\n The output directory is not what you think!')
@@ -0,0 +1,77 @@
+"""
+Offline tests of the skymap geometry cache on the synthetic skymap, and 
+against the LSST skymap if the LSST stack is installed.
+"""
+
+from __future__ import division, print_function
+
+import os
+import sys
+import numpy as np
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'hscAna'))
+from skymap import SkymapCache, make_synthetic_skymap
+
+@pytest.fixture(scope='module')
+def skymap():
+    return make_synthetic_skymap()
+
+def _random_coords(n, dec_min=-10.0, dec_max=10.0, seed=42):
+    rng = np.random.RandomState(seed)
+    return rng.uniform(0, 360, n), rng.uniform(dec_min, dec_max, n)
+
+def test_find_tract_contains(skymap):
+    ra, dec = _random_coords(50000)
+    idx, x, y = skymap.find_tract(ra, dec)
+    assert (idx >= 0).all()
+    # the tract contains the coordinate 
+    assert (skymap.patch_index(idx, x, y)[0] >= 0).all()
+    # and is the first containing tract of many more candidates
+    ref = skymap.find_tract(ra, dec, k=50)[0]
+    np.testing.assert_array_equal(idx, ref)
+
+def test_nearest_tract_overlap(skymap):
+    # in the overlap between rings, the nearest tract does not contain
+    # this coordinate, but another tract does
+    ra, dec = 218.27860619519893, -3.8811201142720364
+    nearest = skymap.find_nearest_tract(ra, dec)
+    x, y = skymap.sky_to_pixel(nearest, ra, dec)
+    assert skymap.patch_index(nearest, x, y)[0] < 0
+    assert skymap.find_tract_patch(ra, dec) == (970, (9, 1))
+
+def test_find_tract_patch_array(skymap):
+    ra, dec = _random_coords(1000, seed=1)
+    tract, ix, iy = skymap.find_tract_patch_array(ra, dec)
+    for i in range(0, 1000, 50):
+        assert skymap.find_tract_patch(ra[i], dec[i]) == (tract[i], (ix[i], iy[i]))
+    with pytest.raises(LookupError):
+        skymap.find_tract_patch(0.0, 60.0)
+    tract, ix, iy = skymap.find_tract_patch_array([0.0], [60.0])
+    assert tract[0] == -1 and ix[0] == -1 and iy[0] == -1
+
+def test_lsst_find_tract():
+    """
+    Compare with skymap.findTract(coord).findPatch(coord) of an LSST 
+    rings skymap. Where tracts overlap, both tracts contain the 
+    coordinate and the two lookups may choose different ones, so the 
+    tract found by the cache must contain the coordinate, and the patch 
+    must match whenever the tracts agree.
+    """
+    lsst_skymap = pytest.importorskip('lsst.skymap')
+    afwCoord = pytest.importorskip('lsst.afw.coord')
+    afwGeom = pytest.importorskip('lsst.afw.geom')
+    config = lsst_skymap.RingsSkyMap.ConfigClass()
+    config.numRings = 20
+    rings = lsst_skymap.RingsSkyMap(config)
+    cache = SkymapCache.from_skymap(rings)
+    ra, dec = _random_coords(2000, dec_min=-30.0, dec_max=30.0, seed=2)
+    tract, ix, iy = cache.find_tract_patch_array(ra, dec)
+    agree = 0
+    for i in range(len(ra)):
+        coord = afwCoord.IcrsCoord(afwGeom.Angle(ra[i], afwGeom.degrees), afwGeom.Angle(dec[i], afwGeom.degrees))
+        assert rings[int(tract[i])].contains(coord)
+        tractInfo = rings.findTract(coord)
+        if tractInfo.getId() == tract[i]:
+            agree += 1
+            assert tuple(tractInfo.findPatch(coord).getIndex()) == (ix[i], iy[i])
+    assert agree > 0.9*len(ra)